@@ -1,18 +1,49 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory
-from openai import OpenAI
+from flask import Flask, Request, request, jsonify, render_template, send_from_directory, send_file, Response, stream_with_context, g, has_request_context
+from openai import OpenAI, APITimeoutError, APIConnectionError, RateLimitError, InternalServerError
 import os
 import base64
 from datetime import datetime, timedelta
 import json
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import get_input_stream
 import sqlite3
 import logging
 from functools import wraps
 import time
 import threading
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
 import psutil
 import traceback
+import uuid
+import queue
+import math
+from contextlib import contextmanager
+import hashlib
+import io
+import re
+import tempfile
+from PIL import Image, ImageOps
+import cProfile
+import pstats
+import random
+import glob
+import html
+import gzip
+import zlib
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# resource はUnix系のみ（プロセスの最大RSSの取得に使う）
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# brotli は入っていれば使う（なければ gzip のみ）
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # ログ設定
 logging.basicConfig(
@@ -23,11 +54,135 @@ logger = logging.getLogger(__name__)
 
 # Flaskアプリ
 app = Flask(__name__, static_folder='static', template_folder='templates')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+MAX_UPLOAD_BYTES = 16 * 1024 * 1024  # 16MB max file size
+# まとめてアップロードする場合だけ複数枚分を受け付ける
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', 10))
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_MB', 64)) * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+# 本文の上限をエンドポイントごとに決める（Content-Length のない chunked の送信も読みながら打ち切られる）
+class UploadRequest(Request):
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'upload_batch':
+            return BATCH_MAX_BYTES
+        return super().max_content_length
+
+app.request_class = UploadRequest
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-here')
 
-# OpenAIクライアント
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# OpenAIクライアント（OPENAI_BASE_URL でベンチマーク用のローカルサーバーなどに向けられる）
+# 再試行は vision_guard で期限内に行うので、SDK自身の再試行は止めておく
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=os.getenv("OPENAI_BASE_URL") or None, max_retries=0)
+
+# レイテンシのヒストグラム（固定バケットなのでトラフィック量に関係なくメモリは一定）
+# 各ワーカーは手元で集計し、数秒ごとにSQLiteへ足し込む。読み出しはDBから全ワーカー分をまとめて行う
+class LatencyHistograms:
+    GROWTH = 1.1            # バケット幅の比率（誤差は約5%）
+    MAX_BUCKET = 140        # 約 1.1^140 ms ≒ 20分まで
+    
+    def __init__(self, window_seconds, report_window_seconds, retention_seconds):
+        self.window_seconds = window_seconds
+        self.report_window_seconds = report_window_seconds
+        self.retention_seconds = retention_seconds
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_prune = 0
+        
+    def bucket_for(self, seconds):
+        ms = seconds * 1000
+        if ms <= 1:
+            return 0
+        return min(self.MAX_BUCKET, 1 + int(math.log(ms) / math.log(self.GROWTH)))
+    
+    def bucket_upper_seconds(self, bucket):
+        return (self.GROWTH ** bucket) / 1000
+    
+    def record(self, name, seconds):
+        window_start = int(time.time() // self.window_seconds * self.window_seconds)
+        bucket = self.bucket_for(seconds)
+        with self.lock:
+            entry = self.pending.get((window_start, name))
+            if entry is None:
+                entry = self.pending[(window_start, name)] = {"buckets": defaultdict(int), "count": 0, "total": 0.0, "max": 0.0}
+            entry["buckets"][bucket] += 1
+            entry["count"] += 1
+            entry["total"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+            
+    def flush(self):
+        """手元の集計をDBへ足し込む"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        
+        bucket_rows = []
+        summary_rows = []
+        for (window_start, name), entry in pending.items():
+            for bucket, count in entry["buckets"].items():
+                bucket_rows.append((window_start, name, bucket, count))
+            summary_rows.append((window_start, name, entry["count"], entry["total"], entry["max"]))
+        
+        with get_db_connection() as conn:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO latency_histograms (window_start, name, bucket, count) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(window_start, name, bucket) DO UPDATE SET count = count + excluded.count",
+                    bucket_rows
+                )
+                conn.executemany(
+                    "INSERT INTO latency_summaries (window_start, name, count, total, max) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(window_start, name) DO UPDATE SET count = count + excluded.count, "
+                    "total = total + excluded.total, max = MAX(max, excluded.max)",
+                    summary_rows
+                )
+                
+                # 保持期間を過ぎたウィンドウは時々まとめて消す
+                now = time.time()
+                if now - self.last_prune > 3600:
+                    self.last_prune = now
+                    conn.execute("DELETE FROM latency_histograms WHERE window_start < ?", (now - self.retention_seconds,))
+                    conn.execute("DELETE FROM latency_summaries WHERE window_start < ?", (now - self.retention_seconds,))
+                    
+    def percentiles(self, since=None, until=None):
+        """全ワーカー分を合算した p50/p90/p99/max を名前ごとに返す"""
+        since = since if since is not None else time.time() - self.report_window_seconds
+        until = until if until is not None else time.time()
+        
+        with get_db_connection() as conn:
+            bucket_rows = conn.execute(
+                "SELECT name, bucket, SUM(count) AS count FROM latency_histograms "
+                "WHERE window_start >= ? AND window_start < ? GROUP BY name, bucket ORDER BY name, bucket",
+                (since - self.window_seconds, until)
+            ).fetchall()
+            summary_rows = conn.execute(
+                "SELECT name, SUM(count) AS count, SUM(total) AS total, MAX(max) AS max FROM latency_summaries "
+                "WHERE window_start >= ? AND window_start < ? GROUP BY name",
+                (since - self.window_seconds, until)
+            ).fetchall()
+        
+        buckets_by_name = defaultdict(list)
+        for row in bucket_rows:
+            buckets_by_name[row['name']].append((row['bucket'], row['count']))
+        
+        result = {}
+        for row in summary_rows:
+            buckets = buckets_by_name.get(row['name'], [])
+            summary = {"count": row['count'], "max": row['max'], "mean": row['total'] / row['count'] if row['count'] else 0.0}
+            for label, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+                summary[label] = min(self._quantile(buckets, row['count'], q), row['max'])
+            result[row['name']] = summary
+        return result
+    
+    def _quantile(self, buckets, total, q):
+        rank = max(1, math.ceil(total * q))
+        cumulative = 0
+        for bucket, count in buckets:
+            cumulative += count
+            if cumulative >= rank:
+                return self.bucket_upper_seconds(bucket)
+        return self.bucket_upper_seconds(buckets[-1][0]) if buckets else 0.0
 
 # 監視用のメトリクス保存
 class MetricsCollector:
@@ -35,7 +190,22 @@ class MetricsCollector:
         self.request_count = defaultdict(int)
         self.error_count = defaultdict(int)
         self.response_times = defaultdict(lambda: deque(maxlen=100))
+        self.time_to_first_token = defaultdict(lambda: deque(maxlen=100))
         self.api_calls = defaultdict(int)
+        self.cache_stats = defaultdict(int)
+        self.preprocess_totals = defaultdict(int)
+        self.preprocess_stage_times = defaultdict(lambda: deque(maxlen=100))
+        self.job_counts = defaultdict(int)
+        self.job_wait_times = deque(maxlen=100)
+        self.job_run_times = deque(maxlen=100)
+        self.request_memory = defaultdict(lambda: deque(maxlen=200))
+        self.gauges = {}
+        self.system_sampler = None
+        self.latency = LatencyHistograms(
+            window_seconds=60,
+            report_window_seconds=int(os.getenv('METRICS_PERCENTILE_WINDOW_SECONDS', 300)),
+            retention_seconds=int(os.getenv('METRICS_HISTOGRAM_RETENTION_HOURS', 48)) * 3600
+        )
         self.start_time = datetime.now()
         
     def record_request(self, endpoint):
@@ -46,12 +216,123 @@ class MetricsCollector:
         
     def record_response_time(self, endpoint, duration):
         self.response_times[endpoint].append(duration)
+        self.latency.record(f"endpoint:{endpoint}", duration)
+        
+    def record_time_to_first_token(self, endpoint, duration):
+        self.time_to_first_token[endpoint].append(duration)
+        self.latency.record(f"ttft:{endpoint}", duration)
+        
+    def record_api_latency(self, api_name, duration):
+        self.latency.record(f"api:{api_name}", duration)
+        
+    def get_latency_percentiles(self):
+        grouped = {"endpoints": {}, "api": {}, "time_to_first_token": {}, "spans": {}}
+        groups = {"endpoint": "endpoints", "api": "api", "ttft": "time_to_first_token", "span": "spans"}
+        try:
+            for name, summary in self.latency.percentiles().items():
+                kind, _, label = name.partition(':')
+                if kind in groups:
+                    grouped[groups[kind]][label] = summary
+        except Exception as e:
+            logger.error(f"Error reading latency histograms: {str(e)}")
+        return grouped
+        
+    def record_span(self, trace_name, span_name, duration):
+        self.latency.record(f"span:{trace_name}.{span_name}", duration)
         
     def record_api_call(self, api_name):
         self.api_calls[api_name] += 1
         
+    def record_cache_lookup(self, result):
+        # result: "exact" / "similar" / "miss"
+        self.cache_stats[result] += 1
+        
+    def get_cache_metrics(self):
+        hits = self.cache_stats["exact"] + self.cache_stats["similar"]
+        lookups = hits + self.cache_stats["miss"]
+        return {
+            "hits": hits,
+            "exact_hits": self.cache_stats["exact"],
+            "similar_hits": self.cache_stats["similar"],
+            "misses": self.cache_stats["miss"],
+            "hit_rate": hits / lookups if lookups else 0.0
+        }
+        
+    def record_preprocessing(self, stats):
+        self.preprocess_totals["images"] += 1
+        self.preprocess_totals["bytes_in"] += stats["bytes_in"]
+        self.preprocess_totals["bytes_out"] += stats["bytes_out"]
+        for stage, duration in stats["stage_times"].items():
+            self.preprocess_stage_times[stage].append(duration)
+            
+    def get_preprocessing_metrics(self):
+        average_stage_ms = {}
+        for stage, times in self.preprocess_stage_times.items():
+            if times:
+                average_stage_ms[stage] = sum(times) / len(times) * 1000
+        
+        return {
+            "images": self.preprocess_totals["images"],
+            "bytes_in": self.preprocess_totals["bytes_in"],
+            "bytes_out": self.preprocess_totals["bytes_out"],
+            "bytes_saved": self.preprocess_totals["bytes_in"] - self.preprocess_totals["bytes_out"],
+            "average_stage_ms": average_stage_ms
+        }
+        
+    def record_request_memory(self, name, peak_bytes):
+        self.request_memory[name].append(peak_bytes)
+        
+    def get_memory_metrics(self):
+        """リクエストごとの大きなバッファのピーク（ワーカー数を決める目安）とプロセスの最大RSS"""
+        requests = {}
+        for name, values in self.request_memory.items():
+            if not values:
+                continue
+            ordered = sorted(values)
+            requests[name] = {
+                "count": len(ordered),
+                "average_mb": sum(ordered) / len(ordered) / 1024 / 1024,
+                "p95_mb": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] / 1024 / 1024,
+                "max_mb": ordered[-1] / 1024 / 1024
+            }
+        # Linux の ru_maxrss はKB単位
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else None
+        return {"requests": requests, "process_peak_rss_mb": peak_rss_mb}
+        
+    def record_job(self, status, wait_time, run_time):
+        self.job_counts[status] += 1
+        self.job_wait_times.append(wait_time)
+        self.job_run_times.append(run_time)
+        
+    def get_job_metrics(self):
+        return {
+            "completed": self.job_counts["done"],
+            "failed": self.job_counts["error"],
+            "retried": self.job_counts["retry"],
+            "deferred": self.job_counts["deferred"],
+            "average_wait_seconds": sum(self.job_wait_times) / len(self.job_wait_times) if self.job_wait_times else 0.0,
+            "average_run_seconds": sum(self.job_run_times) / len(self.job_run_times) if self.job_run_times else 0.0
+        }
+        
+    def register_gauge(self, name, func):
+        """get_metrics() の時点で値を取りに行く項目（キューの長さなど）を登録する"""
+        self.gauges[name] = func
+        
+    def get_gauges(self):
+        values = {}
+        for name, func in self.gauges.items():
+            try:
+                values[name] = func()
+            except Exception as e:
+                logger.error(f"Error reading gauge {name}: {str(e)}")
+                values[name] = None
+        return values
+        
+    def get_uptime_seconds(self):
+        return (datetime.now() - self.start_time).total_seconds()
+        
     def get_metrics(self):
-        uptime = (datetime.now() - self.start_time).total_seconds()
+        uptime = self.get_uptime_seconds()
         
         # 平均レスポンスタイムの計算
         avg_response_times = {}
@@ -59,45 +340,297 @@ class MetricsCollector:
             if times:
                 avg_response_times[endpoint] = sum(times) / len(times)
         
-        # システムリソース情報
-        cpu_percent = psutil.cpu_percent(interval=1)
-        memory = psutil.virtual_memory()
+        avg_time_to_first_token = {}
+        for endpoint, times in self.time_to_first_token.items():
+            if times:
+                avg_time_to_first_token[endpoint] = sum(times) / len(times)
+        
+        # システムリソース情報（バックグラウンドで採取した最新値を使うので待ち時間なし）
+        system = self.system_sampler.latest() if self.system_sampler else {}
         
         return {
             "uptime_seconds": uptime,
             "request_counts": dict(self.request_count),
             "error_counts": dict(self.error_count),
             "average_response_times": avg_response_times,
+            "average_time_to_first_token": avg_time_to_first_token,
+            "latency_percentiles": self.get_latency_percentiles(),
             "api_calls": dict(self.api_calls),
-            "system": {
-                "cpu_percent": cpu_percent,
-                "memory_percent": memory.percent,
-                "memory_available_mb": memory.available / 1024 / 1024
-            },
+            "explanation_cache": self.get_cache_metrics(),
+            "image_preprocessing": self.get_preprocessing_metrics(),
+            "jobs": self.get_job_metrics(),
+            "memory": self.get_memory_metrics(),
+            "gauges": self.get_gauges(),
+            "system": system,
             "timestamp": datetime.now().isoformat()
         }
 
 metrics = MetricsCollector()
 
-# レート制限用のデコレーター
-def rate_limit(max_calls=10, period=60):
-    calls = defaultdict(lambda: deque())
+# リクエスト内の処理段階ごとの時間（ファイル読み込み・前処理・API呼び出し・DB保存など）
+SLOW_REQUEST_THRESHOLD = float(os.getenv('SLOW_REQUEST_THRESHOLD_MS', 2000)) / 1000
+_trace_local = threading.local()
+
+class RequestTrace:
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time.time()
+        self.spans = {}
+        self.finished = False
+        # 画像・base64・リクエスト本文など、大きなバッファの合計とそのピーク（まとめてアップロードでは複数スレッドから使う）
+        self.memory_bytes = 0
+        self.peak_memory_bytes = 0
+        self.lock = threading.Lock()
+        
+    def add(self, span_name, duration):
+        # 同じ名前の段階が複数回あれば合計する
+        with self.lock:
+            self.spans[span_name] = self.spans.get(span_name, 0.0) + duration
+        if self.finished:
+            # ストリーミングの続きなど、レスポンスを返した後の段階は集計だけ行う
+            metrics.record_span(self.name, span_name, duration)
+            
+    def track_memory(self, nbytes):
+        with self.lock:
+            self.memory_bytes += nbytes
+            self.peak_memory_bytes = max(self.peak_memory_bytes, self.memory_bytes)
+            
+    def release_memory(self, nbytes):
+        with self.lock:
+            self.memory_bytes -= nbytes
+            
+    def server_timing(self, total):
+        parts = [f"{re.sub(r'[^A-Za-z0-9_-]', '_', name)};dur={duration * 1000:.1f}" for name, duration in self.spans.items()]
+        parts.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(parts)
+    
+    def finish(self, status=None):
+        """段階ごとの時間を集計に送り、遅ければ内訳を記録する"""
+        self.finished = True
+        duration = time.time() - self.start_time
+        for span_name, span_duration in self.spans.items():
+            metrics.record_span(self.name, span_name, span_duration)
+        if self.peak_memory_bytes:
+            metrics.record_request_memory(self.name, self.peak_memory_bytes)
+        
+        if duration >= SLOW_REQUEST_THRESHOLD:
+            breakdown = ", ".join(f"{name}={value * 1000:.0f}ms" for name, value in self.spans.items())
+            logger.warning(f"Slow request {self.name}: {duration:.3f}s ({breakdown})")
+            save_slow_request(self.name, duration, self.spans, status)
+        return duration
+
+def current_trace():
+    if has_request_context():
+        return g.get('trace')
+    return getattr(_trace_local, 'trace', None)
+
+@contextmanager
+def trace_span(name):
+    """with trace_span('preprocess'): ... で処理段階の時間を記録する（トレース外では何もしない）"""
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        trace.add(name, time.time() - start_time)
+
+def hold_buffer(nbytes):
+    """リクエストの終わりまで持ち続けるバッファを記録する"""
+    trace = current_trace()
+    if trace is not None:
+        trace.track_memory(nbytes)
+
+@contextmanager
+def track_buffer(nbytes):
+    """with の間だけ持つバッファを記録する"""
+    trace = current_trace()
+    if trace is not None:
+        trace.track_memory(nbytes)
+    try:
+        yield
+    finally:
+        if trace is not None:
+            trace.release_memory(nbytes)
+
+@contextmanager
+def use_trace(trace):
+    """別スレッド（まとめてアップロードのワーカーなど）で呼び出し元のトレースに記録する"""
+    previous = getattr(_trace_local, 'trace', None)
+    _trace_local.trace = trace
+    try:
+        yield
+    finally:
+        _trace_local.trace = previous
+
+@contextmanager
+def background_trace(name):
+    """リクエスト外（ジョブワーカーなど）で段階ごとの時間を記録する"""
+    trace = RequestTrace(name)
+    _trace_local.trace = trace
+    status = "ok"
+    try:
+        yield trace
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        _trace_local.trace = None
+        trace.finish(status)
+
+def save_slow_request(name, duration, spans, status):
+    try:
+        path = request.path if has_request_context() else None
+        method = request.method if has_request_context() else None
+        with get_db_connection() as conn:
+            with conn:
+                conn.execute(
+                    "INSERT INTO slow_requests (endpoint, method, path, status, duration, spans, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (name, method, path, str(status) if status is not None else None, duration,
+                     json.dumps(spans), datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                )
+    except Exception as e:
+        logger.error(f"Failed to save slow request: {str(e)}")
+
+# 管理者が有効にしたときだけ、一部のリクエストを cProfile で計測する
+# 設定はDBに置いて全ワーカーで共有し、結果はワーカーごとのファイルに書き出してダウンロード時にまとめる
+class RequestProfiler:
+    SETTINGS_KEY = 'profiling'
+    
+    def __init__(self, output_dir, settings_ttl=5.0):
+        self.output_dir = output_dir
+        self.settings_ttl = settings_ttl
+        self.settings = None
+        self.settings_loaded_at = 0
+        self.stats = None
+        self.samples = 0
+        self.dirty = False
+        self.session = None
+        self.lock = threading.Lock()
+        # cProfile は同時に1つしか動かせないので、計測中のリクエストがあれば他はスキップする
+        self.active = threading.Lock()
+        
+    def get_settings(self):
+        now = time.time()
+        if now - self.settings_loaded_at > self.settings_ttl:
+            try:
+                with get_db_connection() as conn:
+                    row = conn.execute("SELECT value FROM admin_settings WHERE key = ?", (self.SETTINGS_KEY,)).fetchone()
+                self.settings = json.loads(row['value']) if row else None
+            except Exception as e:
+                logger.error(f"Error loading profiling settings: {str(e)}")
+                self.settings = None
+            self.settings_loaded_at = now
+        return self.settings
+    
+    def configure(self, enabled, sample_rate, duration_seconds, endpoints):
+        settings = {
+            "enabled": enabled,
+            "sample_rate": sample_rate,
+            "endpoints": endpoints,
+            "session": uuid.uuid4().hex if enabled else None,
+            "started_at": time.time(),
+            "enabled_until": time.time() + duration_seconds if enabled else None
+        }
+        current = self.get_settings()
+        if not enabled and current:
+            # 停止しても結果は残してダウンロードできるようにする
+            settings["session"] = current.get("session")
+        with get_db_connection() as conn:
+            with conn:
+                conn.execute(
+                    "INSERT INTO admin_settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (self.SETTINGS_KEY, json.dumps(settings))
+                )
+        self.settings_loaded_at = 0
+        return settings
+    
+    def should_sample(self, endpoint_name):
+        settings = self.get_settings()
+        if not settings or not settings.get("enabled") or time.time() > settings["enabled_until"]:
+            return False
+        if settings.get("endpoints") and endpoint_name not in settings["endpoints"]:
+            return False
+        return random.random() < settings["sample_rate"]
+    
+    def profile(self, func, *args, **kwargs):
+        if not self.active.acquire(blocking=False):
+            return func(*args, **kwargs)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.disable()
+        finally:
+            self.active.release()
+            self._add(profiler)
+            
+    def _add(self, profiler):
+        session = (self.get_settings() or {}).get("session")
+        with self.lock:
+            if session != self.session:
+                # 新しい計測が始まったら前回分は捨てる
+                self.stats = None
+                self.samples = 0
+                self.session = session
+            if self.stats is None:
+                self.stats = pstats.Stats(profiler)
+            else:
+                self.stats.add(profiler)
+            self.samples += 1
+            self.dirty = True
+            
+    def flush(self):
+        with self.lock:
+            if not self.dirty or self.stats is None:
+                return
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, f"{self.session}-{os.getpid()}.prof")
+            self.stats.dump_stats(path + ".tmp")
+            os.replace(path + ".tmp", path)
+            self.dirty = False
+            
+    def session_files(self):
+        session = (self.get_settings() or {}).get("session")
+        if not session:
+            return []
+        return sorted(glob.glob(os.path.join(self.output_dir, f"{session}-*.prof")))
     
+    def merged_stats(self):
+        files = self.session_files()
+        return pstats.Stats(*files) if files else None
+
+request_profiler = RequestProfiler(os.path.join(os.getenv('RENDER_DISK_PATH', '.'), 'profiles'))
+
+# レート制限用のデコレーター
+# ユーザー単位（と指定があれば学校単位）のトークンバケットで、状態はSQLiteに置くので全ワーカーで共通
+# cost を渡すと1リクエストで消費する回数をリクエストから決める（まとめてアップロードの枚数など）
+def rate_limit(max_calls=10, period=60, school_max_calls=None, school_period=60, cost=None, unit="回"):
     def decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             user_id = request.form.get('user_id', request.args.get('user_id', 'default_user'))
-            now = time.time()
             
-            # 期限切れの呼び出しを削除
-            while calls[user_id] and calls[user_id][0] < now - period:
-                calls[user_id].popleft()
+            limits = [("user", f"{f.__name__}:user:{user_id}", max_calls, period)]
+            if school_max_calls:
+                school_id = request.form.get('school_id', request.args.get('school_id', 'default_school'))
+                limits.append(("school", f"{f.__name__}:school:{school_id}", school_max_calls, school_period))
             
             # レート制限チェック
-            if len(calls[user_id]) >= max_calls:
-                return jsonify({"error": f"{period}秒間に{max_calls}回までしかリクエストできません"}), 429
+            allowed, denied_scope, retry_after = rate_limiter.check(limits, cost=cost() if cost else 1)
+            if not allowed:
+                if denied_scope == "school":
+                    message = f"学校全体で{school_period}秒間に{school_max_calls}{unit}までしかリクエストできません"
+                else:
+                    message = f"{period}秒間に{max_calls}{unit}までしかリクエストできません"
+                response = jsonify({"error": message})
+                response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+                return response, 429
             
-            calls[user_id].append(now)
             return f(*args, **kwargs)
         return wrapper
     return decorator
@@ -109,17 +642,29 @@ def monitor_performance(endpoint_name):
         def wrapper(*args, **kwargs):
             start_time = time.time()
             metrics.record_request(endpoint_name)
+            g.trace = RequestTrace(endpoint_name)
+            status = None
             
             try:
-                result = f(*args, **kwargs)
-                return result
+                if request_profiler.should_sample(endpoint_name):
+                    result = request_profiler.profile(f, *args, **kwargs)
+                else:
+                    result = f(*args, **kwargs)
+                
+                # 段階ごとの時間をブラウザの開発者ツールで見られるようにする
+                response = app.make_response(result)
+                response.headers['Server-Timing'] = g.trace.server_timing(time.time() - start_time)
+                status = response.status_code
+                return response
             except Exception as e:
+                status = 500
                 metrics.record_error(endpoint_name)
                 logger.error(f"Error in {endpoint_name}: {str(e)}\n{traceback.format_exc()}")
                 raise
             finally:
                 duration = time.time() - start_time
                 metrics.record_response_time(endpoint_name, duration)
+                g.trace.finish(status)
                 logger.info(f"{endpoint_name} - Response time: {duration:.3f}s")
                 
         return wrapper
@@ -128,141 +673,1477 @@ def monitor_performance(endpoint_name):
 # データベース関連
 DATABASE_PATH = os.path.join(os.getenv('RENDER_DISK_PATH', '.'), 'history.db')
 
+# システムリソースの定期採取（CPU使用率などを毎回1秒待って測らないようにする）
+class SystemSampler:
+    def __init__(self, interval, history_size, db_path):
+        self.interval = interval
+        self.db_path = db_path
+        self.samples = deque(maxlen=history_size)
+        self.process = psutil.Process()
+        # cpu_percent(interval=None) は前回呼び出しからの値を返すので、最初に一度呼んでおく
+        psutil.cpu_percent(interval=None)
+        self.process.cpu_percent(interval=None)
+        
+    def start(self):
+        self.sample()
+        threading.Thread(target=self._run, name="system-sampler", daemon=True).start()
+        
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error(f"Error sampling system metrics: {str(e)}")
+                
+    def sample(self):
+        memory = psutil.virtual_memory()
+        with self.process.oneshot():
+            rss = self.process.memory_info().rss
+            threads = self.process.num_threads()
+            process_cpu = self.process.cpu_percent(interval=None)
+            open_fds = self.process.num_fds() if hasattr(self.process, 'num_fds') else self.process.num_handles()
+        
+        # DB本体とWALファイルの合計サイズ
+        db_size = 0
+        for suffix in ('', '-wal'):
+            try:
+                db_size += os.path.getsize(self.db_path + suffix)
+            except OSError:
+                pass
+        
+        snapshot = {
+            "cpu_percent": psutil.cpu_percent(interval=None),
+            "memory_percent": memory.percent,
+            "memory_available_mb": memory.available / 1024 / 1024,
+            "process_cpu_percent": process_cpu,
+            "process_rss_mb": rss / 1024 / 1024,
+            "open_fds": open_fds,
+            "threads": threads,
+            "db_size_mb": db_size / 1024 / 1024,
+            "sampled_at": datetime.now().isoformat()
+        }
+        self.samples.append(snapshot)
+        return snapshot
+    
+    def latest(self):
+        return self.samples[-1] if self.samples else {}
+    
+    def history(self):
+        return list(self.samples)
+
+system_sampler = SystemSampler(
+    interval=float(os.getenv('SYSTEM_SAMPLE_INTERVAL', 5)),
+    history_size=int(os.getenv('SYSTEM_SAMPLE_HISTORY', 720)),
+    db_path=DATABASE_PATH
+)
+metrics.system_sampler = system_sampler
+system_sampler.start()
+
+# SQLite接続プール（接続を使い回し、WALなどの設定は接続時に一度だけ行う）
+class ConnectionPool:
+    def __init__(self, path, size, timeout, busy_timeout_ms, mmap_size, cache_size_kb):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.busy_timeout_ms = busy_timeout_ms
+        self.mmap_size = mmap_size
+        self.cache_size_kb = cache_size_kb
+        # 直近に返された接続から使う（ページキャッシュが温まっている）
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.wait_times = deque(maxlen=1000)
+        
+    def _connect(self):
+        # 接続ごとにプリペアドステートメントをキャッシュして再利用する
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+            cached_statements=256
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+    
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self.lock:
+            can_create = self.created < self.size
+            if can_create:
+                self.created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        
+        # 上限まで使用中なら返却を待つ
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self.lock:
+                self.timeouts += 1
+            raise RuntimeError(f"データベース接続の取得が{self.timeout}秒以内にできませんでした")
+        
+    @contextmanager
+    def connection(self):
+        start = time.perf_counter()
+        conn = self._acquire()
+        wait_time = time.perf_counter() - start
+        
+        with self.lock:
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            self.acquired += 1
+            self.wait_times.append(wait_time)
+        
+        broken = False
+        try:
+            yield conn
+        finally:
+            with self.lock:
+                self.in_use -= 1
+            try:
+                # 途中で例外が出た場合のトランザクションは破棄してから返す
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                broken = True
+            
+            if broken:
+                conn.close()
+                with self.lock:
+                    self.created -= 1
+            else:
+                self.idle.put(conn)
+                
+    def close(self):
+        """使われていない接続を閉じる（使用中の接続は返却後にガベージコレクションで閉じられる）"""
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self.lock:
+                self.created -= 1
+                
+    def stats(self):
+        with self.lock:
+            wait_times = list(self.wait_times)
+            return {
+                "size": self.size,
+                "open_connections": self.created,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "idle": self.idle.qsize(),
+                "acquired": self.acquired,
+                "timeouts": self.timeouts,
+                "average_wait_ms": sum(wait_times) / len(wait_times) * 1000 if wait_times else 0.0,
+                "max_wait_ms": max(wait_times) * 1000 if wait_times else 0.0
+            }
+
+db_pool = ConnectionPool(
+    DATABASE_PATH,
+    size=int(os.getenv('DB_POOL_SIZE', 16)),
+    timeout=float(os.getenv('DB_POOL_TIMEOUT', 10)),
+    busy_timeout_ms=int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000)),
+    mmap_size=int(os.getenv('DB_MMAP_SIZE', 256 * 1024 * 1024)),
+    cache_size_kb=int(os.getenv('DB_CACHE_SIZE_KB', 16 * 1024))
+)
+metrics.register_gauge('db_pool', db_pool.stats)
+
 def get_db_connection():
-    """データベース接続を取得する"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """データベース接続をプールから取得する（with文で使い、抜けるとプールに返る）"""
+    return db_pool.connection()
+
+# トークンバケット方式のレート制限（1キー1行、判定はキーごとにO(1)）
+# 状態は本体DBとは別の小さなSQLiteファイルに置き、履歴やジョブの書き込みと書き込みロックを取り合わない
+class RateLimiter:
+    def __init__(self, path, max_keys, sweep_interval, pool_size, busy_timeout_ms):
+        self.max_keys = max_keys
+        self.sweep_interval = sweep_interval
+        self.last_sweep = 0
+        self.longest_period = 60
+        self.lock = threading.Lock()
+        self.decisions = defaultdict(int)
+        self.evicted = 0
+        self.pool = ConnectionPool(
+            path,
+            size=pool_size,
+            timeout=db_pool.timeout,
+            busy_timeout_ms=busy_timeout_ms,
+            mmap_size=0,
+            cache_size_kb=1024
+        )
+        self._init_db()
+        
+    def _init_db(self):
+        with self.pool.connection() as conn:
+            with conn:
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                ) WITHOUT ROWID
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_rate_limit_updated ON rate_limit_buckets(updated_at)')
+                # キー数をトリガーで数えておき、新しいキーを入れるときに上限を毎回確認できるようにする
+                conn.execute('CREATE TABLE IF NOT EXISTS rate_limit_key_count (id INTEGER PRIMARY KEY CHECK (id = 1), total INTEGER NOT NULL)')
+                conn.execute("INSERT OR IGNORE INTO rate_limit_key_count (id, total) SELECT 1, COUNT(*) FROM rate_limit_buckets")
+                conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS rate_limit_buckets_ai AFTER INSERT ON rate_limit_buckets BEGIN
+                    UPDATE rate_limit_key_count SET total = total + 1 WHERE id = 1;
+                END
+                ''')
+                conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS rate_limit_buckets_ad AFTER DELETE ON rate_limit_buckets BEGIN
+                    UPDATE rate_limit_key_count SET total = total - 1 WHERE id = 1;
+                END
+                ''')
+        
+    def check(self, limits, cost=1):
+        """limits: (scope, key, 上限回数, 期間秒) のリスト。(許可, 拒否したscope, 再試行までの秒数) を返す"""
+        now = time.time()
+        try:
+            with self.pool.connection() as conn:
+                # 読んでから書くまでを他のワーカーに割り込ませない（トランザクション内では計算と数行の読み書きだけ）
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    updates = []
+                    new_keys = 0
+                    for scope, key, capacity, period in limits:
+                        self.longest_period = max(self.longest_period, period)
+                        rate = capacity / period
+                        # 上限より多く消費するリクエストも、満タンなら通す（ずっと拒否し続けない）
+                        bucket_cost = min(cost, capacity)
+                        row = conn.execute(
+                            "SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?",
+                            (key,)
+                        ).fetchone()
+                        tokens = capacity if row is None else min(capacity, row['tokens'] + (now - row['updated_at']) * rate)
+                        
+                        if tokens < bucket_cost:
+                            conn.rollback()
+                            self._record(f"denied_{scope}")
+                            return False, scope, (bucket_cost - tokens) / rate
+                        updates.append((key, tokens - bucket_cost, now))
+                        new_keys += row is None
+                    
+                    # キー数の上限は掃除を待たずにここで守る（超える分は最終更新が古いキーから消す）
+                    evicted = 0
+                    if new_keys:
+                        total = conn.execute("SELECT total FROM rate_limit_key_count WHERE id = 1").fetchone()['total']
+                        overflow = total + new_keys - self.max_keys
+                        if overflow > 0:
+                            evicted = conn.execute(
+                                "DELETE FROM rate_limit_buckets WHERE key IN ("
+                                "SELECT key FROM rate_limit_buckets ORDER BY updated_at LIMIT ?)",
+                                (overflow,)
+                            ).rowcount
+                    
+                    conn.executemany(
+                        "INSERT INTO rate_limit_buckets (key, tokens, updated_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                        updates
+                    )
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            
+            if evicted:
+                with self.lock:
+                    self.evicted += evicted
+            if now - self.last_sweep > self.sweep_interval:
+                self.sweep()
+            self._record("allowed")
+            return True, None, 0
+        
+        except Exception as e:
+            # 制限の判定に失敗してもサービスは止めない
+            logger.error(f"Error in rate limiter: {str(e)}")
+            self._record("errors")
+            return True, None, 0
+        
+    def sweep(self):
+        """満タンに戻るだけの時間使われていないキーを消す"""
+        self.last_sweep = time.time()
+        with self.pool.connection() as conn:
+            with conn:
+                idle = conn.execute(
+                    "DELETE FROM rate_limit_buckets WHERE updated_at < ?",
+                    (self.last_sweep - self.longest_period,)
+                )
+        with self.lock:
+            self.evicted += idle.rowcount
+            
+    def _record(self, decision):
+        with self.lock:
+            self.decisions[decision] += 1
+            
+    def stats(self):
+        with self.pool.connection() as conn:
+            keys = conn.execute("SELECT total FROM rate_limit_key_count WHERE id = 1").fetchone()['total']
+        with self.lock:
+            return {
+                "keys": keys,
+                "max_keys": self.max_keys,
+                "evicted": self.evicted,
+                "decisions": dict(self.decisions),
+                "pool": self.pool.stats()
+            }
+
+rate_limiter = RateLimiter(
+    os.getenv('RATE_LIMIT_DB_PATH') or os.path.join(os.getenv('RENDER_DISK_PATH', '.'), 'rate_limit.db'),
+    max_keys=int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000)),
+    sweep_interval=int(os.getenv('RATE_LIMIT_SWEEP_SECONDS', 60)),
+    pool_size=int(os.getenv('RATE_LIMIT_POOL_SIZE', 8)),
+    busy_timeout_ms=int(os.getenv('RATE_LIMIT_BUSY_TIMEOUT_MS', 1000))
+)
+metrics.register_gauge('rate_limiter', rate_limiter.stats)
+
+# 解説キャッシュの phash（16進16桁）を類似検索の候補絞り込み用に分ける数
+PHASH_SEGMENTS = 4
+
+def add_column_if_missing(conn, table, column, definition):
+    """既存テーブルに列がなければ追加する（簡易マイグレーション）"""
+    columns = [row['name'] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
 
 def init_db():
     """データベースのテーブルを初期化"""
     with app.app_context():
-        conn = get_db_connection()
-        with conn:
-            # 履歴テーブル
-            conn.execute('''
-            CREATE TABLE IF NOT EXISTS history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT NOT NULL,
-                school_id TEXT,
-                image_base64 TEXT NOT NULL,
-                explanation TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-            ''')
-            
-            # 監視ログテーブル
-            conn.execute('''
-            CREATE TABLE IF NOT EXISTS monitoring_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                metrics TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-            ''')
-            
-            # エラーログテーブル
-            conn.execute('''
-            CREATE TABLE IF NOT EXISTS error_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                endpoint TEXT NOT NULL,
-                error_message TEXT NOT NULL,
-                stack_trace TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-            ''')
+        with get_db_connection() as conn:
+            with conn:
+                # 監視ログテーブル
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS monitoring_logs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    metrics TEXT NOT NULL,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+                ''')
+                
+                # エラーログテーブル
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS error_logs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    endpoint TEXT NOT NULL,
+                    error_message TEXT NOT NULL,
+                    stack_trace TEXT,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+                ''')
+                
+                # 解説キャッシュテーブル（画像ハッシュ → 解説）
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS explanation_cache (
+                    image_hash TEXT PRIMARY KEY,
+                    phash TEXT,
+                    explanation TEXT NOT NULL,
+                    hit_count INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    last_accessed REAL NOT NULL
+                )
+                ''')
+                
+                # 解析ジョブテーブル（ワーカーが再起動しても失われないようにDBに置く）
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    school_id TEXT,
+                    source_hash TEXT NOT NULL,
+                    phash TEXT,
+                    image_hash TEXT NOT NULL,
+                    thumbnail_hash TEXT,
+                    mimetype TEXT NOT NULL,
+                    explanation TEXT,
+                    error_message TEXT,
+                    history_id INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    claim_token TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+                ''')
+                
+                # インデックスの作成
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_monitoring_timestamp ON monitoring_logs(timestamp DESC)')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_error_timestamp ON error_logs(timestamp DESC)')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_last_accessed ON explanation_cache(last_accessed)')
+                # 類似画像の候補を絞るための phash の区切りごとの索引（16進4桁 = 16bit ずつ）
+                for segment in range(PHASH_SEGMENTS):
+                    conn.execute(
+                        f'CREATE INDEX IF NOT EXISTS idx_cache_phash_{segment} '
+                        f'ON explanation_cache(substr(phash, {segment * 4 + 1}, 4))'
+                    )
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs(status, created_at)')
+                # 最後にキューへ入った時刻（再試行で戻したジョブの待ち時間を前回の実行分から数えない）
+                add_column_if_missing(conn, 'jobs', 'queued_at', 'REAL')
             
-            # インデックスの作成
-            conn.execute('CREATE INDEX IF NOT EXISTS idx_history_user_timestamp ON history(user_id, timestamp DESC)')
-            conn.execute('CREATE INDEX IF NOT EXISTS idx_monitoring_timestamp ON monitoring_logs(timestamp DESC)')
-            conn.execute('CREATE INDEX IF NOT EXISTS idx_error_timestamp ON error_logs(timestamp DESC)')
+                # レイテンシのヒストグラム（全ワーカー共通の集計先）
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS latency_histograms (
+                    window_start INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (window_start, name, bucket)
+                ) WITHOUT ROWID
+                ''')
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS latency_summaries (
+                    window_start INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    total REAL NOT NULL,
+                    max REAL NOT NULL,
+                    PRIMARY KEY (window_start, name)
+                ) WITHOUT ROWID
+                ''')
+            
+                # 時系列メトリクス（1行1値）と、5分/1時間/1日単位の集計テーブル
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS metric_samples (
+                    ts INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    value REAL NOT NULL
+                )
+                ''')
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS metric_rollups (
+                    resolution INTEGER NOT NULL,
+                    bucket_start INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    total REAL NOT NULL,
+                    min REAL NOT NULL,
+                    max REAL NOT NULL,
+                    PRIMARY KEY (resolution, bucket_start, name, labels)
+                ) WITHOUT ROWID
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_metric_samples_ts ON metric_samples(ts)')
+                
+                # レート制限のトークンバケットは専用のファイルへ移した（一時的な状態なので本体DBの分は捨てる）
+                conn.execute('DROP TABLE IF EXISTS rate_limit_buckets')
+                
+                # 保守作業（保持期間による削除など）の実行記録
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS maintenance_runs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    progress TEXT NOT NULL,
+                    started_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    finished_at REAL
+                )
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_maintenance_kind_started ON maintenance_runs(kind, started_at DESC)')
+                # 遅かったリクエストの段階ごとの内訳
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS slow_requests (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    endpoint TEXT NOT NULL,
+                    method TEXT,
+                    path TEXT,
+                    status TEXT,
+                    duration REAL NOT NULL,
+                    spans TEXT NOT NULL,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_slow_requests_timestamp ON slow_requests(timestamp)')
+                
+                # 全ワーカーで共有する管理用の設定（プロファイリングの有効化など）
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS admin_settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+                ''')
+                
+                # 学校ごとの履歴シャードの対応表と、ユーザーが履歴を持つシャード
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS history_shards (
+                    shard_no INTEGER PRIMARY KEY AUTOINCREMENT,
+                    school_key TEXT NOT NULL UNIQUE,
+                    created_at REAL NOT NULL
+                )
+                ''')
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS history_user_shards (
+                    user_id TEXT NOT NULL,
+                    shard_no INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, shard_no)
+                ) WITHOUT ROWID
+                ''')
             
-        conn.close()
+            # 分割前の履歴（シャードへ移し終わるまで読む）
+            init_history_schema(conn)
+
+def init_history_schema(conn):
+    """履歴テーブルと件数・全文検索用のテーブルを作成する（本体DBと学校ごとのシャードで共通）"""
+    with conn:
+        # 履歴テーブル
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            school_id TEXT,
+            image_base64 TEXT NOT NULL DEFAULT '',
+            explanation TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            image_hash TEXT,
+            thumbnail_hash TEXT
+        )
+        ''')
+        # 旧スキーマのDBには画像ハッシュ列を追加する
+        add_column_if_missing(conn, 'history', 'image_hash', 'TEXT')
+        add_column_if_missing(conn, 'history', 'thumbnail_hash', 'TEXT')
+        
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_history_user_timestamp ON history(user_id, timestamp DESC)')
+        # 削除した履歴の画像が他で使われていないかを調べるため
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_history_image_hash ON history(image_hash)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_history_thumbnail_hash ON history(thumbnail_hash)')
+    
+    init_history_counts(conn)
+    init_history_search(conn)
+
+def create_history_count_triggers(conn):
+    """件数と、内容が変わるたびに増える version を保つトリガー（version は履歴APIの ETag に使う）"""
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_history_count_insert AFTER INSERT ON history
+    BEGIN
+        INSERT INTO history_counts (user_id, total, version) VALUES (NEW.user_id, 1, 1)
+        ON CONFLICT(user_id) DO UPDATE SET total = total + 1, version = version + 1;
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_history_count_delete AFTER DELETE ON history
+    BEGIN
+        UPDATE history_counts SET total = total - 1, version = version + 1 WHERE user_id = OLD.user_id;
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_history_count_update AFTER UPDATE OF user_id ON history
+    WHEN OLD.user_id != NEW.user_id
+    BEGIN
+        UPDATE history_counts SET total = total - 1, version = version + 1 WHERE user_id = OLD.user_id;
+        INSERT INTO history_counts (user_id, total, version) VALUES (NEW.user_id, 1, 1)
+        ON CONFLICT(user_id) DO UPDATE SET total = total + 1, version = version + 1;
+    END
+    ''')
+    # 画像の移行などで返す内容が変わったときも version を進める
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_history_count_touch AFTER UPDATE OF explanation, timestamp, image_hash, thumbnail_hash ON history
+    BEGIN
+        UPDATE history_counts SET version = version + 1 WHERE user_id = NEW.user_id;
+    END
+    ''')
+
+def init_history_counts(conn):
+    """ユーザーごとの履歴件数テーブルとトリガーを作成する（初回は既存データから集計）"""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history_counts'"
+    ).fetchone()
+    if exists:
+        upgrade_history_counts(conn)
+        return
+    
+    # 作成と集計の間に件数がずれないよう、書き込みロックを取ってまとめて行う
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS history_counts (
+            user_id TEXT PRIMARY KEY,
+            total INTEGER NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        create_history_count_triggers(conn)
+        conn.execute("DELETE FROM history_counts")
+        conn.execute(
+            "INSERT INTO history_counts (user_id, total) SELECT user_id, COUNT(*) FROM history GROUP BY user_id"
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def upgrade_history_counts(conn):
+    """version 列がない件数テーブルに列を足し、トリガーを作り直す"""
+    if 'version' in [row['name'] for row in conn.execute("PRAGMA table_info(history_counts)")]:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # 他のワーカーが先に済ませていれば何もしない
+        if 'version' not in [row['name'] for row in conn.execute("PRAGMA table_info(history_counts)")]:
+            conn.execute("ALTER TABLE history_counts ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            for trigger in ('trg_history_count_insert', 'trg_history_count_delete', 'trg_history_count_update'):
+                conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            create_history_count_triggers(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def init_history_search(conn):
+    """解説文の全文検索用のFTS5テーブルとトリガーを作成する（既存データは backfill_history_search で少しずつ登録）"""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history_fts'"
+    ).fetchone()
+    if exists:
+        return
+    
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # trigram なので形態素解析なしで日本語の部分一致ができる（rowid = history.id）
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(explanation, tokenize='trigram')")
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_history_fts_insert AFTER INSERT ON history
+        BEGIN
+            INSERT INTO history_fts (rowid, explanation) VALUES (NEW.id, NEW.explanation);
+        END
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_history_fts_delete AFTER DELETE ON history
+        BEGIN
+            DELETE FROM history_fts WHERE rowid = OLD.id;
+        END
+        ''')
+        conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_history_fts_update AFTER UPDATE OF explanation ON history
+        BEGIN
+            DELETE FROM history_fts WHERE rowid = OLD.id;
+            INSERT INTO history_fts (rowid, explanation) VALUES (NEW.id, NEW.explanation);
+        END
+        ''')
+        # トリガー作成前の行だけを後から登録する（新しいシャードは空なので不要）
+        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM history").fetchone()[0]
+        if max_id:
+            conn.execute(
+                "INSERT INTO admin_settings (key, value) VALUES ('history_fts_backfill', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (json.dumps({"last_id": 0, "max_id": max_id}),)
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def backfill_history_search(batch_size=500, pause=0.05):
+    """既存の履歴を検索用テーブルに登録する。進み具合はDBに置くので複数ワーカーで同時に動いても重複しない"""
+    while True:
+        with get_db_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT value FROM admin_settings WHERE key = 'history_fts_backfill'").fetchone()
+                state = json.loads(row['value']) if row else None
+                if not state or state["last_id"] >= state["max_id"]:
+                    conn.rollback()
+                    return
+                
+                upper = min(state["max_id"], state["last_id"] + batch_size)
+                inserted = conn.execute(
+                    "INSERT INTO history_fts (rowid, explanation) SELECT id, explanation FROM history WHERE id > ? AND id <= ?",
+                    (state["last_id"], upper)
+                ).rowcount
+                state["last_id"] = upper
+                conn.execute(
+                    "UPDATE admin_settings SET value = ? WHERE key = 'history_fts_backfill'",
+                    (json.dumps(state),)
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        
+        if upper >= state["max_id"]:
+            logger.info("History search backfill finished")
+        elif inserted:
+            logger.info(f"History search backfill: {upper}/{state['max_id']}")
+        time.sleep(pause)
 
 # --- ここからが修正点 ---
 # アプリケーション起動時にデータベースを初期化する
 init_db()
 # --- ここまでが修正点 ---
 
-# 定期的なメトリクス保存
-def save_metrics_periodically():
-    while True:
-        try:
-            time.sleep(300)  # 5分ごと
-            metrics_data = metrics.get_metrics()
-            
-            conn = get_db_connection()
-            with conn:
-                conn.execute(
-                    "INSERT INTO monitoring_logs (metrics) VALUES (?)",
-                    (json.dumps(metrics_data),)
-                )
-            conn.close()
-            
-            logger.info("Metrics saved to database")
-        except Exception as e:
-            logger.error(f"Error saving metrics: {str(e)}")
+def run_history_search_backfill():
+    try:
+        backfill_history_search()
+    except Exception as e:
+        logger.error(f"Error in history search backfill: {str(e)}")
 
-# バックグラウンドスレッドでメトリクス保存を開始
-threading.Thread(target=save_metrics_periodically, daemon=True).start()
+threading.Thread(target=run_history_search_backfill, name="history-fts-backfill", daemon=True).start()
 
-# ルートページ
-@app.route('/')
-@monitor_performance('index')
-def index():
-    return render_template('main.html')
+# 解説キャッシュ（同じプリントの写真はOpenAIを呼ばずに返す）
+def compute_image_hash(image_data):
+    """画像バイト列のSHA-256を返す"""
+    return hashlib.sha256(image_data).hexdigest()
 
-# Service Worker
-@app.route('/sw.js')
-def service_worker():
-    return send_from_directory('static', 'sw.js', mimetype='application/javascript')
+def compute_stream_hash(stream, chunk_size=256 * 1024):
+    """ファイルを少しずつ読んでSHA-256を返す（全体をメモリに載せない）"""
+    stream.seek(0)
+    digest = hashlib.sha256()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
 
-# Manifest
-@app.route('/manifest.json')
-def manifest():
-    return send_from_directory('static', 'manifest.json', mimetype='application/manifest+json')
+def encode_data_url(stream, mimetype, chunk_size=3 * 64 * 1024):
+    """ファイルを少しずつbase64にして data URL を作る
+    bytearray に直接追記し、最後に1回だけ文字列にするので、元画像・base64・f-string の全体コピーを同時に持たない"""
+    buffer = bytearray(f"data:{mimetype};base64,".encode('ascii'))
+    remainder = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        chunk = remainder + chunk
+        # 3バイト単位で区切れば途中にパディングが入らない
+        usable = len(chunk) - len(chunk) % 3
+        buffer += base64.b64encode(chunk[:usable])
+        remainder = chunk[usable:]
+    buffer += base64.b64encode(remainder)
+    return buffer.decode('ascii')
 
-# 静的ファイル配信
-@app.route('/static/<path:filename>')
-def serve_static(filename):
-    return send_from_directory('static', filename)
+def detect_image_mimetype(header):
+    """先頭バイト（マジックナンバー）から画像のMIMEタイプを判定する"""
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
 
-# 画像アップロードと解析
-@app.route('/upload', methods=['POST'])
-@monitor_performance('upload')
-@rate_limit(max_calls=5, period=60)  # 1分間に5回まで
-def upload():
-    try:
-        # フォームデータ取得
-        school_id = request.form.get('school_id', 'default_school')
-        user_id = request.form.get('user_id', 'default_user')
-        
-        # バリデーション
-        if 'file' not in request.files:
-            return jsonify({"error": "ファイルがありません"}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({"error": "ファイルが選択されていません"}), 400
-        
-        # ファイル形式の確認
-        allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
-        if '.' in file.filename:
-            ext = file.filename.rsplit('.', 1)[1].lower()
-            if ext not in allowed_extensions:
-                return jsonify({"error": f"許可されていないファイル形式です。{', '.join(allowed_extensions)}のみ対応しています"}), 400
-        
-        # 画像データを読み込み
-        image_data = file.read()
+# 画像ストア（内容のハッシュをファイル名にして生のバイト列をディスクに保存）
+class BlobStore:
+    HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+    
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
         
-        # ファイルサイズの再確認
-        if len(image_data) > 16 * 1024 * 1024:
-            return jsonify({"error": "ファイルサイズが大きすぎます"}), 413
+    def path_for(self, blob_hash):
+        return os.path.join(self.root, blob_hash[:2], blob_hash)
+    
+    def is_valid_hash(self, blob_hash):
+        return bool(self.HASH_PATTERN.match(blob_hash))
+    
+    def exists(self, blob_hash):
+        return os.path.exists(self.path_for(blob_hash))
+    
+    def put(self, data, blob_hash=None):
+        """バイト列を保存してハッシュを返す。同じ内容は一度しか書き込まない"""
+        blob_hash = blob_hash or compute_image_hash(data)
+        path = self.path_for(blob_hash)
+        try:
+            # 既にあれば更新日時だけ新しくする（保持期間の削除が使い始めたばかりのファイルを消さないように）
+            os.utime(path)
+            return blob_hash
+        except FileNotFoundError:
+            pass
         
-        # base64エンコード
-        base64_image = base64.b64encode(image_data).decode('utf-8')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 一時ファイルに書いてからリネームし、書きかけのファイルを見せない
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return blob_hash
+    
+    def delete(self, blob_hash, min_age=0):
+        """削除する。min_age 秒以内に保存・再利用されたファイルは、まだ履歴に書かれる前かもしれないので残す"""
+        path = self.path_for(blob_hash)
+        try:
+            if min_age and time.time() - os.path.getmtime(path) < min_age:
+                return False
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+    
+    def read_header(self, blob_hash, size=16):
+        with open(self.path_for(blob_hash), 'rb') as f:
+            return f.read(size)
+
+IMAGE_STORE_PATH = os.path.join(os.getenv('RENDER_DISK_PATH', '.'), 'images')
+blob_store = BlobStore(IMAGE_STORE_PATH)
+
+def image_url(image_hash):
+    return f"/images/{image_hash}" if image_hash else None
+
+def incremental_vacuum_enabled():
+    with get_db_connection() as conn:
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+# 既存DBを INCREMENTAL にするにはファイル全体を書き直すVACUUMが必要で、その間は書き込みが止まる
+# 起動時には行わず、管理者が空いている時間に POST /api/maintenance/incremental-vacuum で1回だけ実行する
+try:
+    if not incremental_vacuum_enabled():
+        logger.warning("auto_vacuum is not INCREMENTAL; run POST /api/maintenance/incremental-vacuum once to enable it")
+except Exception as e:
+    logger.error(f"Error checking auto_vacuum: {str(e)}")
+
+# 学校ごとの履歴シャード（history を school_id ごとに別のSQLiteファイルに分け、書き込みロックとファイルの肥大化を学校間で共有しない）
+# 本体DB（DATABASE_PATH）はシャードの対応表と、ジョブ・キャッシュ・監視などの共有テーブルを持つ
+HISTORY_SHARD_DIR = os.getenv('HISTORY_SHARD_DIR') or os.path.join(os.getenv('RENDER_DISK_PATH', '.'), 'history_shards')
+# シャードごとに id の範囲を分けて全シャードで重ならないようにする（JavaScriptの安全な整数の範囲に収まる）
+HISTORY_ID_BLOCK = 10 ** 10
+# 分割前の本体DBの history（移し終わるまで読み取りの対象に含める）
+LEGACY_SHARD = 0
+
+# 学校IDはクライアントが送る値なので、シャードのファイルを無制限に作らせないよう形式と数を制限する
+# ALLOWED_SCHOOL_IDS（カンマ区切り）を設定すると、それ以外の学校は受け付けない
+SCHOOL_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+ALLOWED_SCHOOL_IDS = {s.strip() for s in os.getenv('ALLOWED_SCHOOL_IDS', '').split(',') if s.strip()}
+HISTORY_SHARD_MAX = int(os.getenv('HISTORY_SHARD_MAX', 500))
+
+def validate_school_id(school_id):
+    """新しく受け付ける学校IDを確認する。不正ならエラーメッセージを返す"""
+    if ALLOWED_SCHOOL_IDS:
+        if school_id not in ALLOWED_SCHOOL_IDS:
+            return "登録されていない学校IDです"
+    elif not school_id or not SCHOOL_ID_PATTERN.match(school_id):
+        return "学校IDの形式が不正です（英数字・-・_ の64文字以内）"
+    return None
+
+def merge_rows(rows, order):
+    """複数シャードの結果を並べ替える。order: (列名, 降順か) のリスト"""
+    rows = list(rows)
+    for column, descending in reversed(order):
+        rows.sort(key=lambda row: row[column], reverse=descending)
+    return rows
+
+class HistoryShards:
+    def __init__(self, shard_dir, pool_size, cache_size_kb, known_users_size, max_open, idle_seconds):
+        self.shard_dir = shard_dir
+        self.pool_size = pool_size
+        self.cache_size_kb = cache_size_kb
+        self.known_users_size = known_users_size
+        self.max_open = max_open
+        self.idle_seconds = idle_seconds
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.last_used = {}
+        self.init_locks = {}
+        self.last_sweep = time.time()
+        self.evicted = 0
+        self.school_shards = {}
+        # 対応表に書き込み済みの (user_id, shard_no)。毎回本体DBに書かないため
+        self.known_users = OrderedDict()
+        self.legacy_pending = True
+        self.migrated = 0
+        os.makedirs(shard_dir, exist_ok=True)
+        
+    def path_for(self, shard_no):
+        return os.path.join(self.shard_dir, f"school-{shard_no:05d}.db")
+    
+    def _pool(self, shard_no):
+        if shard_no == LEGACY_SHARD:
+            return db_pool
+        with self.lock:
+            pool = self.pools.get(shard_no)
+            if pool is not None:
+                self.last_used[shard_no] = time.time()
+            else:
+                init_lock = self.init_locks.setdefault(shard_no, threading.Lock())
+        if pool is not None:
+            self._evict_idle()
+            return pool
+        
+        # 初めて開くシャードはスキーマを作る（作成済みなら何もしない）
+        # 時間がかかるので全体のロックは持たず、同じシャードを開く呼び出しだけを待たせる
+        with init_lock:
+            with self.lock:
+                pool = self.pools.get(shard_no)
+            if pool is None:
+                pool = ConnectionPool(
+                    self.path_for(shard_no),
+                    size=self.pool_size,
+                    timeout=db_pool.timeout,
+                    busy_timeout_ms=db_pool.busy_timeout_ms,
+                    mmap_size=db_pool.mmap_size,
+                    cache_size_kb=self.cache_size_kb
+                )
+                with pool.connection() as conn:
+                    self._init_shard(conn, shard_no)
+                with self.lock:
+                    self.pools[shard_no] = pool
+                    self.last_used[shard_no] = time.time()
+        
+        self._evict_idle()
+        return pool
+    
+    def _evict_idle(self):
+        """しばらく使われていないシャードの接続を閉じる。開いている数が上限を超えたら古い順に閉じる"""
+        now = time.time()
+        evicted = []
+        with self.lock:
+            if len(self.pools) <= self.max_open and now - self.last_sweep < 60:
+                return
+            self.last_sweep = now
+            excess = len(self.pools) - self.max_open
+            for shard_no in sorted(self.pools, key=lambda n: self.last_used[n]):
+                pool = self.pools[shard_no]
+                if pool.in_use == 0 and (excess > 0 or now - self.last_used[shard_no] > self.idle_seconds):
+                    del self.pools[shard_no]
+                    del self.last_used[shard_no]
+                    evicted.append(pool)
+                    excess -= 1
+            self.evicted += len(evicted)
+        for pool in evicted:
+            pool.close()
+    
+    def _init_shard(self, conn, shard_no):
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # 作ったばかりの空のファイルなのでVACUUMはすぐ終わる
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        init_history_schema(conn)
+        # 新しい行の id はこのシャードの範囲から振る（移した分割前の行は元の id のまま）
+        with conn:
+            conn.execute(
+                "INSERT INTO sqlite_sequence (name, seq) SELECT 'history', ? "
+                "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'history')",
+                (shard_no * HISTORY_ID_BLOCK,)
+            )
+    
+    def connection(self, shard_no):
+        """シャードの接続を取得する（with文で使う）"""
+        return self._pool(shard_no).connection()
+    
+    def shard_for_school(self, school_id, create=True, trusted=False):
+        """学校のシャード番号を返す。create=False で未作成なら None
+        新しく作る場合は学校IDと学校数の上限を確認し、受け付けられなければ ValueError（trusted は分割前のデータの移行用）"""
+        school_key = school_id or ''
+        shard_no = self.school_shards.get(school_key)
+        if shard_no is not None:
+            return shard_no
+        
+        with get_db_connection() as conn:
+            row = conn.execute("SELECT shard_no FROM history_shards WHERE school_key = ?", (school_key,)).fetchone()
+            if row is None:
+                if not create:
+                    return None
+                # 学校IDなしの履歴（分割前のデータ）はシャード1つにまとまるので確認しない
+                if not trusted and school_key:
+                    error = validate_school_id(school_id)
+                    if error:
+                        raise ValueError(error)
+                    if conn.execute("SELECT COUNT(*) FROM history_shards").fetchone()[0] >= HISTORY_SHARD_MAX:
+                        raise ValueError("登録できる学校の数が上限に達しています")
+                # 同時に作ろうとしたワーカーがいても番号は1つに決まる
+                with conn:
+                    conn.execute(
+                        "INSERT INTO history_shards (school_key, created_at) VALUES (?, ?) ON CONFLICT(school_key) DO NOTHING",
+                        (school_key, time.time())
+                    )
+                row = conn.execute("SELECT shard_no FROM history_shards WHERE school_key = ?", (school_key,)).fetchone()
+        
+        shard_no = row['shard_no']
+        self._pool(shard_no)
+        with self.lock:
+            self.school_shards[school_key] = shard_no
+        return shard_no
+    
+    def remember_user(self, user_id, shard_no):
+        """ユーザーがこのシャードに履歴を持つことを記録する（学校を指定しない履歴取得で使う）"""
+        key = (user_id, shard_no)
+        with self.lock:
+            if key in self.known_users:
+                self.known_users.move_to_end(key)
+                return
+        with get_db_connection() as conn:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO history_user_shards (user_id, shard_no) VALUES (?, ?)", key)
+        with self.lock:
+            self.known_users[key] = True
+            while len(self.known_users) > self.known_users_size:
+                self.known_users.popitem(last=False)
+    
+    def shards_for(self, user_id=None, school_id=None):
+        """読み取り対象のシャード番号のリスト（学校の指定があればその学校だけ）"""
+        if school_id is not None:
+            shard_no = self.shard_for_school(school_id, create=False)
+            shards = [shard_no] if shard_no is not None else []
+        else:
+            with get_db_connection() as conn:
+                rows = conn.execute(
+                    "SELECT shard_no FROM history_user_shards WHERE user_id = ? ORDER BY shard_no",
+                    (user_id,)
+                ).fetchall()
+            shards = [row['shard_no'] for row in rows]
+        if self.legacy_pending:
+            shards.append(LEGACY_SHARD)
+        return shards
+    
+    def all_shards(self):
+        with get_db_connection() as conn:
+            rows = conn.execute("SELECT shard_no FROM history_shards ORDER BY shard_no").fetchall()
+        shards = [row['shard_no'] for row in rows]
+        if self.legacy_pending:
+            shards.append(LEGACY_SHARD)
+        return shards
+    
+    def query(self, shards, sql, params, order, limit=None):
+        """同じSQLを各シャードで実行して、order の順に limit 件にまとめる"""
+        rows = []
+        for shard_no in shards:
+            with self.connection(shard_no) as conn:
+                rows.extend(conn.execute(sql, params).fetchall())
+        if len(shards) > 1:
+            rows = merge_rows(rows, order)
+        return rows[:limit] if limit is not None else rows
+    
+    def image_in_use(self, blob_hash):
+        """どれかのシャードの履歴がこの画像を参照しているか"""
+        for shard_no in self.all_shards():
+            with self.connection(shard_no) as conn:
+                row = conn.execute(
+                    "SELECT 1 FROM history WHERE image_hash = ? OR thumbnail_hash = ? LIMIT 1",
+                    (blob_hash, blob_hash)
+                ).fetchone()
+            if row:
+                return True
+        return False
+    
+    def migrate_legacy(self, batch_size=500, pause=0.05):
+        """本体DBに残っている分割前の履歴を学校ごとのシャードへ移す
+        元の id のまま INSERT OR IGNORE で入れてから本体DBの行を消すので、途中で止まっても複数ワーカーが同時に動いても重複しない"""
+        while True:
+            with get_db_connection() as conn:
+                rows = conn.execute(
+                    "SELECT id, user_id, school_id, image_base64, explanation, timestamp, image_hash, thumbnail_hash "
+                    "FROM history ORDER BY id LIMIT ?",
+                    (batch_size,)
+                ).fetchall()
+            if not rows:
+                break
+            
+            by_shard = defaultdict(list)
+            for row in rows:
+                by_shard[self.shard_for_school(row['school_id'], trusted=True)].append(row)
+            
+            for shard_no, shard_rows in by_shard.items():
+                for user_id in {row['user_id'] for row in shard_rows}:
+                    self.remember_user(user_id, shard_no)
+                with self.connection(shard_no) as conn:
+                    with conn:
+                        conn.executemany(
+                            "INSERT OR IGNORE INTO history (id, user_id, school_id, image_base64, explanation, timestamp, image_hash, thumbnail_hash) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            [tuple(row) for row in shard_rows]
+                        )
+            
+            with get_db_connection() as conn:
+                with conn:
+                    conn.executemany("DELETE FROM history WHERE id = ?", [(row['id'],) for row in rows])
+            self.migrated += len(rows)
+            logger.info(f"Moved {self.migrated} history rows into school shards")
+            time.sleep(pause)
+        
+        self.legacy_pending = False
+    
+    def shard_stats(self):
+        """シャードごとの学校・行数・ファイルサイズ"""
+        with get_db_connection() as conn:
+            rows = conn.execute("SELECT shard_no, school_key, created_at FROM history_shards ORDER BY shard_no").fetchall()
+        shards = []
+        for row in rows:
+            with self.connection(row['shard_no']) as conn:
+                total = conn.execute("SELECT COALESCE(SUM(total), 0) FROM history_counts").fetchone()[0]
+            shards.append({
+                "shard_no": row['shard_no'],
+                "school_id": row['school_key'] or None,
+                "rows": total,
+                "db_size_mb": self._file_size(self.path_for(row['shard_no'])) / 1024 / 1024,
+                "created_at": datetime.fromtimestamp(row['created_at']).isoformat(),
+                "pool": self.pools[row['shard_no']].stats() if row['shard_no'] in self.pools else None
+            })
+        return shards
+    
+    def _file_size(self, path):
+        size = 0
+        for suffix in ('', '-wal'):
+            try:
+                size += os.path.getsize(path + suffix)
+            except OSError:
+                pass
+        return size
+    
+    def stats(self):
+        with self.lock:
+            open_shards = list(self.pools)
+            evicted = self.evicted
+        return {
+            "open_shards": len(open_shards),
+            "max_open_shards": self.max_open,
+            "evicted_pools": evicted,
+            "total_size_mb": sum(self._file_size(os.path.join(self.shard_dir, name))
+                                 for name in os.listdir(self.shard_dir) if name.endswith('.db')) / 1024 / 1024,
+            "legacy_pending": self.legacy_pending,
+            "migrated_rows": self.migrated
+        }
+
+history_shards = HistoryShards(
+    HISTORY_SHARD_DIR,
+    pool_size=int(os.getenv('HISTORY_SHARD_POOL_SIZE', 4)),
+    cache_size_kb=int(os.getenv('HISTORY_SHARD_CACHE_SIZE_KB', 4 * 1024)),
+    known_users_size=int(os.getenv('HISTORY_SHARD_USER_CACHE', 50000)),
+    # 学校ごとの接続を開いたままにする数と時間（ファイルディスクリプタを使い切らないように）
+    max_open=int(os.getenv('HISTORY_SHARD_MAX_OPEN', 64)),
+    idle_seconds=int(os.getenv('HISTORY_SHARD_IDLE_SECONDS', 600))
+)
+metrics.register_gauge('history_shards', history_shards.stats)
+
+# 旧形式の画像の移行を担当するワーカーの持ち時間（この間に進み具合を更新しないと他のワーカーが引き継ぐ）
+IMAGE_MIGRATION_LEASE_SECONDS = 300
+
+def claim_history_image_migration(owner):
+    """画像の移行を1つのワーカーだけが行うよう、本体DBに担当と期限を書く。済んでいるか他が担当中なら False"""
+    now = time.time()
+    with get_db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM admin_settings WHERE key = 'history_image_migration'").fetchone()
+            state = json.loads(row['value']) if row else {}
+            if state.get("done") or (state.get("owner") != owner and state.get("lease_until", 0) > now):
+                conn.rollback()
+                return False
+            state.update({"owner": owner, "lease_until": now + IMAGE_MIGRATION_LEASE_SECONDS})
+            conn.execute(
+                "INSERT INTO admin_settings (key, value) VALUES ('history_image_migration', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (json.dumps(state),)
+            )
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+
+def finish_history_image_migration(migrated):
+    with get_db_connection() as conn:
+        with conn:
+            conn.execute(
+                "UPDATE admin_settings SET value = ? WHERE key = 'history_image_migration'",
+                (json.dumps({"done": True, "migrated": migrated, "finished_at": time.time()}),)
+            )
+
+def migrate_history_images(batch_size=200, pause=0.05):
+    """history.image_base64 に残っている旧形式の画像を画像ストアへ移す（全ワーカーで一度だけ実行される）
+    空いたページは incremental vacuum（保持期間の処理）で返すので、ここではVACUUMしない"""
+    owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    if not claim_history_image_migration(owner):
+        return
+    
+    migrated = 0
+    for shard_no in history_shards.all_shards():
+        last_id = 0
+        while True:
+            with history_shards.connection(shard_no) as conn:
+                rows = conn.execute(
+                    "SELECT id, image_base64 FROM history WHERE id > ? AND image_hash IS NULL AND image_base64 != '' ORDER BY id LIMIT ?",
+                    (last_id, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+                
+                updates = []
+                for row in rows:
+                    try:
+                        image_data = base64.b64decode(row['image_base64'], validate=True)
+                    except Exception:
+                        # デコードできない行は image_hash を NULL のまま残す（空の画像のハッシュを付けない）
+                        logger.warning(f"history id={row['id']} の画像をデコードできませんでした")
+                        continue
+                    updates.append((blob_store.put(image_data), row['id']))
+                
+                with conn:
+                    conn.executemany(
+                        "UPDATE history SET image_hash = ?, image_base64 = '' WHERE id = ?",
+                        updates
+                    )
+            migrated += len(updates)
+            
+            # 担当の期限を延ばす（取られていたら他のワーカーに任せる）
+            if not claim_history_image_migration(owner):
+                return
+            time.sleep(pause)
+    
+    finish_history_image_migration(migrated)
+    if migrated:
+        logger.info(f"Migrated {migrated} history images to blob store")
+
+def run_history_shard_migration():
+    try:
+        history_shards.migrate_legacy()
+    except Exception as e:
+        logger.error(f"Error moving history into shards: {str(e)}")
+        return
+    # 旧形式の画像はシャードへ移し終えてから、シャードごとに画像ストアへ移す
+    try:
+        migrate_history_images()
+    except Exception as e:
+        logger.error(f"Error migrating history images: {str(e)}")
+
+threading.Thread(target=run_history_shard_migration, name="history-shard-migration", daemon=True).start()
+
+def compute_perceptual_hash(img):
+    """差分ハッシュ(dHash, 64bit)を16進文字列で返す"""
+    pixels = list(img.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return f"{bits:016x}"
+
+# 画像の前処理（向き補正・縮小・白黒化・再圧縮・サムネイル作成）
+class ImagePreprocessor:
+    def __init__(self, max_edge, jpeg_quality, grayscale, thumbnail_edge):
+        self.max_edge = max_edge
+        self.jpeg_quality = jpeg_quality
+        self.grayscale = grayscale
+        self.thumbnail_edge = thumbnail_edge
+        
+    def _encode_jpeg(self, img, quality):
+        buf = io.BytesIO()
+        img.save(buf, 'JPEG', quality=quality, optimize=True)
+        return buf.getvalue()
+    
+    def process(self, source):
+        """前処理済みの画像を返す。Pillowで読めない画像はそのまま通す
+        source はバイト列かファイル（アップロードの一時ファイルなど）。ファイルは必要なときだけ全体を読む"""
+        stage_times = {}
+        stream = io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+        stream.seek(0, os.SEEK_END)
+        size_in = stream.tell()
+        stream.seek(0)
+        header = stream.read(16)
+        stream.seek(0)
+        
+        def read_all():
+            stream.seek(0)
+            data = stream.read()
+            hold_buffer(len(data))
+            return data
+        
+        def timed(stage, func, *args):
+            start = time.perf_counter()
+            value = func(*args)
+            stage_times[stage] = time.perf_counter() - start
+            return value
+        
+        try:
+            img = timed('decode', self._decode, stream)
+        except Exception as e:
+            logger.warning(f"Image preprocessing skipped: {str(e)}")
+            image_data = read_all()
+            return {
+                "data": image_data,
+                "mimetype": detect_image_mimetype(header) or 'image/jpeg',
+                "thumbnail": None,
+                "phash": None,
+                "stats": {"bytes_in": size_in, "bytes_out": len(image_data), "stage_times": stage_times}
+            }
+        
+        # デコード後の画素データ（処理が終われば解放される）
+        pixel_bytes = img.width * img.height * len(img.getbands())
+        with track_buffer(pixel_bytes):
+            # 長辺で判定するので、向き補正より先に縮小して回転する画素数を減らす
+            resized = max(img.size) > self.max_edge
+            if resized:
+                img = timed('resize', self._resize, img, self.max_edge)
+            
+            rotated = img.getexif().get(0x0112, 1) != 1
+            if rotated:
+                img = timed('orientation', ImageOps.exif_transpose, img)
+            
+            if self.grayscale:
+                img = timed('enhance', self._enhance, img)
+            
+            phash = timed('phash', compute_perceptual_hash, img)
+            processed = timed('encode', self._encode_jpeg, img, self.jpeg_quality)
+            
+            # 変形していないJPEGで再圧縮しても小さくならない場合は元のまま使う
+            if (not resized and not rotated and not self.grayscale
+                    and len(processed) >= size_in
+                    and detect_image_mimetype(header) == 'image/jpeg'):
+                processed = read_all()
+            else:
+                hold_buffer(len(processed))
+            
+            thumbnail = timed('thumbnail', self._make_thumbnail, img)
+            hold_buffer(len(thumbnail))
+            
+            return {
+                "data": processed,
+                "mimetype": 'image/jpeg',
+                "thumbnail": thumbnail,
+                "phash": phash,
+                "stats": {"bytes_in": size_in, "bytes_out": len(processed), "stage_times": stage_times}
+            }
+    
+    def _decode(self, stream):
+        img = Image.open(stream)
+        # JPEGは縮小を前提にデコードしてメモリと時間を節約する
+        img.draft('RGB', (self.max_edge, self.max_edge))
+        img.load()
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.convert('RGBA').getchannel('A'))
+            return background
+        return img.convert('RGB') if img.mode not in ('RGB', 'L') else img
+    
+    def _resize(self, img, edge):
+        scale = edge / max(img.size)
+        if scale >= 1:
+            return img
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        resized = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        resized.info = img.info
+        return resized
+    
+    def _enhance(self, img):
+        # 印刷されたプリント向け：白黒にしてコントラストを強める
+        return ImageOps.autocontrast(img.convert('L'), cutoff=1)
+    
+    def _make_thumbnail(self, img):
+        return self._encode_jpeg(self._resize(img, self.thumbnail_edge), 70)
+
+image_preprocessor = ImagePreprocessor(
+    max_edge=int(os.getenv('IMAGE_MAX_EDGE', 2048)),
+    jpeg_quality=int(os.getenv('IMAGE_JPEG_QUALITY', 85)),
+    grayscale=os.getenv('IMAGE_GRAYSCALE', 'false').lower() in ('1', 'true', 'yes'),
+    thumbnail_edge=int(os.getenv('THUMBNAIL_MAX_EDGE', 320))
+)
+
+class ExplanationCache:
+    def __init__(self, ttl_seconds, max_entries, phash_distance, max_candidates):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.phash_distance = phash_distance
+        self.max_candidates = max_candidates
         
-        # GPT Vision APIで画像解析
-        prompt = """
+    def lookup(self, image_hash, phash=None):
+        """キャッシュを検索し (解説, 種別) を返す。種別は "exact" / "similar" / "miss" """
+        now = time.time()
+        min_created = now - self.ttl_seconds
+        
+        with get_db_connection() as conn:
+            row = conn.execute(
+                "SELECT image_hash, explanation FROM explanation_cache WHERE image_hash = ? AND created_at > ?",
+                (image_hash, min_created)
+            ).fetchone()
+            result = "exact"
+            
+            # 完全一致しない場合は見た目が近い画像を探す
+            if row is None and phash and self.phash_distance > 0:
+                target = int(phash, 16)
+                best = None
+                # 全件は見ずに、16bitの区切りのどれかが一致するものだけを最近使われた順に上限まで比べる
+                # （距離が区切りの数より小さければ、どれか1つは必ず一致する）
+                segments = [phash[i * 4:i * 4 + 4] for i in range(PHASH_SEGMENTS)]
+                where = " OR ".join(f"substr(phash, {i * 4 + 1}, 4) = ?" for i in range(PHASH_SEGMENTS))
+                for candidate in conn.execute(
+                    f"SELECT image_hash, phash FROM explanation_cache WHERE ({where}) AND created_at > ? "
+                    "ORDER BY last_accessed DESC LIMIT ?",
+                    (*segments, min_created, self.max_candidates)
+                ):
+                    distance = bin(target ^ int(candidate['phash'], 16)).count('1')
+                    if distance <= self.phash_distance and (best is None or distance < best[0]):
+                        best = (distance, candidate['image_hash'])
+                if best is not None:
+                    row = conn.execute(
+                        "SELECT image_hash, explanation FROM explanation_cache WHERE image_hash = ?",
+                        (best[1],)
+                    ).fetchone()
+                    result = "similar"
+            
+            if row is None:
+                return None, "miss"
+            
+            with conn:
+                conn.execute(
+                    "UPDATE explanation_cache SET hit_count = hit_count + 1, last_accessed = ? WHERE image_hash = ?",
+                    (now, row['image_hash'])
+                )
+            return row['explanation'], result
+            
+    def store(self, image_hash, phash, explanation):
+        """解説を保存し、期限切れ・上限超過のエントリを削除する"""
+        now = time.time()
+        with get_db_connection() as conn:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO explanation_cache (image_hash, phash, explanation, hit_count, created_at, last_accessed) VALUES (?, ?, ?, 0, ?, ?)",
+                    (image_hash, phash, explanation, now, now)
+                )
+                # TTL切れを削除
+                conn.execute(
+                    "DELETE FROM explanation_cache WHERE created_at <= ?",
+                    (now - self.ttl_seconds,)
+                )
+                # 上限を超えた分は最終アクセスが古い順に削除（LRU）
+                conn.execute(
+                    "DELETE FROM explanation_cache WHERE image_hash IN ("
+                    "SELECT image_hash FROM explanation_cache ORDER BY last_accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+
+explanation_cache = ExplanationCache(
+    ttl_seconds=int(os.getenv('EXPLANATION_CACHE_TTL_DAYS', 30)) * 86400,
+    max_entries=int(os.getenv('EXPLANATION_CACHE_MAX_ENTRIES', 5000)),
+    # 似た画像の解説を流用するハミング距離（0 で無効。違う問題に別の解説を返さないよう既定は無効）
+    phash_distance=int(os.getenv('EXPLANATION_CACHE_PHASH_DISTANCE', 0)),
+    max_candidates=int(os.getenv('EXPLANATION_CACHE_PHASH_CANDIDATES', 200))
+)
+
+# GPT Vision APIに渡す指示文
+VISION_PROMPT = """
         この画像に写っている問題を分析して、中学生から高校生の学習者に適した教育的な指導をしてください。
 
 【絶対に守ること】
@@ -285,78 +2166,1795 @@ def upload():
 - 行列：$\\begin{pmatrix} a & b \\\\ c & d \\end{pmatrix}$
 - 不等号：$\\leq$, $\\geq$, $\\neq$
 
-【表示形式】
-- 考え方と手順のみ表示
-- 重要な数式は $$...$$ で中央揃え表示
+【表示形式】
+- 考え方と手順のみ表示
+- 重要な数式は $$...$$ で中央揃え表示
+
+まず画像の内容を詳しく分析し、問題文を正確に読み取ってから指導を開始してください。
+"""
+
+def build_vision_messages(data_url):
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": VISION_PROMPT
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": data_url,
+                        "detail": "auto"
+                    }
+                }
+            ]
+        }
+    ]
+
+# OpenAI APIへの同時呼び出しの制御（遅延が増えたら同時数を絞り、あふれた分はすぐ503で断る）
+class OverloadedError(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# 再試行すれば成功する可能性があるエラー（タイムアウト・接続エラー・429・5xx）
+RETRYABLE_API_ERRORS = (APITimeoutError, APIConnectionError, RateLimitError, InternalServerError)
+
+def is_breaker_failure(error):
+    """ブレーカーの失敗として数えるか（429は利用枠の制限で上流は正常なので、Retry-Afterを待つだけにする）"""
+    return isinstance(error, RETRYABLE_API_ERRORS) and not isinstance(error, RateLimitError)
+
+def parse_retry_after(value):
+    """Retry-After の秒数（日時形式や不正な値は0として扱う）"""
+    try:
+        return max(0.0, float(value or 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD: 目標時間内に返れば同時数を少しずつ増やし、遅延や失敗があれば一気に減らす"""
+    
+    def __init__(self, initial_limit, min_limit, max_limit, latency_target, backoff_ratio, queue_size, queue_timeout):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff_ratio = backoff_ratio
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.shed_count = 0
+        self.avg_latency = latency_target / 2
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+        
+    def retry_after(self):
+        # 待ち行列が1周するまでの目安
+        return max(1, math.ceil(self.avg_latency * (self.waiting + 1) / max(self.limit, 1)))
+        
+    def acquire(self):
+        with self.condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return
+            if self.waiting >= self.queue_size:
+                self.shed_count += 1
+                raise OverloadedError("同時に処理できる数を超えています", self.retry_after())
+            
+            self.waiting += 1
+            try:
+                deadline = time.time() + self.queue_timeout
+                while self.in_flight >= int(self.limit):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.shed_count += 1
+                        raise OverloadedError("混み合っているため処理を開始できませんでした", self.retry_after())
+                    self.condition.wait(remaining)
+                self.in_flight += 1
+            finally:
+                self.waiting -= 1
+                
+    def release(self, latency, overloaded):
+        with self.condition:
+            self.in_flight -= 1
+            self.avg_latency = self.avg_latency * 0.9 + latency * 0.1
+            if overloaded or latency > self.latency_target:
+                # 減らすのは1回の遅延の波につき1度だけ（同時に終わった呼び出しで何度も半減させない）
+                if time.time() - self.last_decrease > self.latency_target:
+                    self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                    self.last_decrease = time.time()
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify()
+            
+    def stats(self):
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queue_length": self.waiting,
+            "queue_size": self.queue_size,
+            "shed": self.shed_count,
+            "avg_latency": self.avg_latency
+        }
+
+class CircuitBreaker:
+    """連続して失敗したら一定時間APIを呼ばずに即座に断る。時間が経ったら1件だけ試して復帰を確認する"""
+    
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_in_flight = False
+        self.rejected_count = 0
+        self.lock = threading.Lock()
+        
+    def allow(self):
+        with self.lock:
+            if self.state == "open" and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self.trial_in_flight = False
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            self.rejected_count += 1
+            return False
+        
+    def retry_after(self):
+        return max(1, math.ceil(self.reset_timeout - (time.time() - self.opened_at)))
+    
+    def is_open(self):
+        with self.lock:
+            return self.state == "open" and time.time() - self.opened_at < self.reset_timeout
+    
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                logger.info("Circuit breaker closed")
+            self.state = "closed"
+            self.failures = 0
+            self.trial_in_flight = False
+            
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning(f"Circuit breaker opened after {self.failures} failures")
+                self.state = "open"
+                self.opened_at = time.time()
+                self.trial_in_flight = False
+                
+    def release_trial(self):
+        """成功とも失敗とも言えない結果（画像の不備や接続前の切断など）で試行枠だけを返す"""
+        with self.lock:
+            self.trial_in_flight = False
+                
+    def stats(self):
+        return {
+            "state": "half_open" if self.state == "open" and not self.is_open() else self.state,
+            "consecutive_failures": self.failures,
+            "rejected": self.rejected_count
+        }
+
+class UpstreamSlot:
+    """同時実行枠を1つ確保した状態。期限内の再試行と、終了時の結果の記録を行う"""
+    
+    def __init__(self, guard):
+        self.guard = guard
+        self.start_time = time.time()
+        self.deadline = self.start_time + guard.deadline
+        self.response_started_at = None
+        self.failed = False
+        self.throttled = False
+        self.finished = False
+        self.lock = threading.Lock()
+        
+    def call(self, fn):
+        """fn(timeout) を呼ぶ。再試行できるエラーなら、期限内でジッター付きの指数バックオフで再試行する"""
+        attempt = 0
+        while True:
+            remaining = self.deadline - time.time()
+            try:
+                result = fn(max(1.0, min(self.guard.attempt_timeout, remaining)))
+                self.guard.breaker.record_success()
+                return result
+            except RETRYABLE_API_ERRORS as e:
+                if is_breaker_failure(e):
+                    self.guard.breaker.record_failure()
+                    self.failed = True
+                else:
+                    self.throttled = True
+                attempt += 1
+                # full jitter: 0〜上限のランダムな時間待つ（一斉に再試行しないように）
+                backoff = random.uniform(0, min(self.guard.backoff_cap, self.guard.backoff_base * 2 ** attempt))
+                if isinstance(e, RateLimitError) and e.response is not None:
+                    backoff = max(backoff, parse_retry_after(e.response.headers.get('retry-after')))
+                if attempt >= self.guard.max_attempts or time.time() + backoff >= self.deadline or self.guard.breaker.is_open():
+                    raise
+                self.guard.retry_count += 1
+                logger.warning(f"Retrying OpenAI call in {backoff:.2f}s after {type(e).__name__} (attempt {attempt})")
+                time.sleep(backoff)
+                
+    def mark_response_started(self):
+        """ストリーミングで応答が始まった時刻を記録する（遅延は最後まで読む時間ではなくここまでで測る）"""
+        if self.response_started_at is None:
+            self.response_started_at = time.time()
+            
+    def finish(self, error=None):
+        # 接続を閉じたときとジェネレーターの終了の両方から呼ばれるので、1回だけ実行する
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        breaker_failure = is_breaker_failure(error)
+        if breaker_failure and not self.failed:
+            # ストリーミングの途中で切れた場合など
+            self.guard.breaker.record_failure()
+        elif not breaker_failure:
+            # 上流の不調ではない終わり方（429を含む）でも half_open の試行枠は必ず返す（返さないと以後ずっと断り続ける）
+            self.guard.breaker.release_trial()
+        # 同時数を減らすのは上流の遅延・障害・429のときだけ（1枚の不正な画像では減らさない）
+        latency = (self.response_started_at or time.time()) - self.start_time
+        overloaded = self.failed or self.throttled or isinstance(error, RETRYABLE_API_ERRORS)
+        self.guard.limiter.release(latency, overloaded=overloaded)
+
+class UpstreamGuard:
+    def __init__(self, limiter, breaker, deadline, attempt_timeout, max_attempts, backoff_base, backoff_cap):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.retry_count = 0
+        
+    def acquire(self):
+        """実行枠を取る。ブレーカーが開いている・待ち行列が一杯のときは OverloadedError"""
+        if not self.breaker.allow():
+            raise OverloadedError("AIサービスが不安定なため一時的に受付を停止しています", self.breaker.retry_after())
+        try:
+            self.limiter.acquire()
+        except OverloadedError:
+            # half_open の試行枠を取ったまま断った場合は返しておく
+            self.breaker.release_trial()
+            raise
+        return UpstreamSlot(self)
+    
+    @contextmanager
+    def slot(self):
+        slot = self.acquire()
+        try:
+            yield slot
+        except Exception as e:
+            slot.finish(e)
+            raise
+        else:
+            slot.finish()
+            
+    def stats(self):
+        return {
+            "concurrency": self.limiter.stats(),
+            "circuit_breaker": self.breaker.stats(),
+            "retries": self.retry_count
+        }
+
+vision_guard = UpstreamGuard(
+    limiter=AdaptiveConcurrencyLimiter(
+        initial_limit=int(os.getenv('OPENAI_CONCURRENCY_INITIAL', 8)),
+        min_limit=int(os.getenv('OPENAI_CONCURRENCY_MIN', 2)),
+        max_limit=int(os.getenv('OPENAI_CONCURRENCY_MAX', 32)),
+        latency_target=float(os.getenv('OPENAI_LATENCY_TARGET', 30)),
+        backoff_ratio=0.7,
+        queue_size=int(os.getenv('OPENAI_QUEUE_SIZE', 16)),
+        queue_timeout=float(os.getenv('OPENAI_QUEUE_TIMEOUT', 10))
+    ),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv('OPENAI_BREAKER_FAILURES', 5)),
+        reset_timeout=float(os.getenv('OPENAI_BREAKER_RESET_SECONDS', 30))
+    ),
+    deadline=float(os.getenv('OPENAI_DEADLINE_SECONDS', 90)),
+    attempt_timeout=50,
+    max_attempts=int(os.getenv('OPENAI_MAX_ATTEMPTS', 3)),
+    backoff_base=0.5,
+    backoff_cap=8.0
+)
+metrics.register_gauge('openai', vision_guard.stats)
+
+def analyze_image(data_url):
+    """GPT Vision APIで画像を解析して解説文を返す（data_url は encode_data_url で作ったもの）"""
+    # API呼び出しの記録
+    metrics.record_api_call('openai_vision')
+    
+    start_time = time.time()
+    try:
+        # data URL と、SDKがそれをJSONにしたリクエスト本文の分
+        with trace_span('openai'), track_buffer(len(data_url) * 2), vision_guard.slot() as slot:
+            gpt_response = slot.call(lambda timeout: client.chat.completions.create(
+                model="gpt-4.1",
+                messages=build_vision_messages(data_url),
+                max_tokens=1500,
+                temperature=0.7,
+                timeout=timeout
+            ))
+    finally:
+        metrics.record_api_latency('openai_vision', time.time() - start_time)
+    
+    return gpt_response.choices[0].message.content.strip()
+
+def stream_image_analysis(data_url, slot=None):
+    """GPT Vision APIをストリーミングで呼び出し、生成された文字列を順に返す
+    slot を渡すとその実行枠を使い、最後まで読み終えたら解放する（再試行は最初のトークンまで）"""
+    metrics.record_api_call('openai_vision')
+    
+    slot = slot or vision_guard.acquire()
+    start_time = time.time()
+    error = None
+    try:
+        with trace_span('openai'), track_buffer(len(data_url) * 2):
+            stream = slot.call(lambda timeout: client.chat.completions.create(
+                model="gpt-4.1",
+                messages=build_vision_messages(data_url),
+                max_tokens=1500,
+                temperature=0.7,
+                timeout=timeout,
+                stream=True
+            ))
+        slot.mark_response_started()
+        
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        slot.finish(error)
+        metrics.record_api_latency('openai_vision_stream', time.time() - start_time)
+
+def save_history(user_id, school_id, image_hash, thumbnail_hash, explanation_text):
+    """履歴を学校のシャードに1件保存する（画像本体は画像ストアに置き、ハッシュだけを記録）"""
+    shard_no = history_shards.shard_for_school(school_id)
+    history_shards.remember_user(user_id, shard_no)
+    with trace_span('db_insert'), history_shards.connection(shard_no) as conn:
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO history (user_id, school_id, image_base64, image_hash, thumbnail_hash, explanation, timestamp) VALUES (?, ?, '', ?, ?, ?, ?)",
+                (user_id, school_id, image_hash, thumbnail_hash, explanation_text, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            )
+    return cursor.lastrowid
+
+def save_history_batch(entries):
+    """複数の履歴を1つのトランザクションで保存し、それぞれの id を返す
+    entries: (user_id, school_id, image_hash, thumbnail_hash, explanation_text) のリスト"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    history_ids = [None] * len(entries)
+    # シャードごとに1トランザクション
+    by_shard = defaultdict(list)
+    for index, entry in enumerate(entries):
+        by_shard[history_shards.shard_for_school(entry[1])].append((index, entry))
+    
+    with trace_span('db_insert'):
+        for shard_no, shard_entries in by_shard.items():
+            for user_id in {entry[0] for _, entry in shard_entries}:
+                history_shards.remember_user(user_id, shard_no)
+            with history_shards.connection(shard_no) as conn:
+                with conn:
+                    for index, (user_id, school_id, image_hash, thumbnail_hash, explanation_text) in shard_entries:
+                        cursor = conn.execute(
+                            "INSERT INTO history (user_id, school_id, image_base64, image_hash, thumbnail_hash, explanation, timestamp) VALUES (?, ?, '', ?, ?, ?, ?)",
+                            (user_id, school_id, image_hash, thumbnail_hash, explanation_text, timestamp)
+                        )
+                        history_ids[index] = cursor.lastrowid
+    return history_ids
+
+def save_error_log(endpoint, error):
+    """エラーログをDBに保存する（保存自体の失敗は無視）"""
+    try:
+        with get_db_connection() as conn:
+            with conn:
+                conn.execute(
+                    "INSERT INTO error_logs (endpoint, error_message, stack_trace) VALUES (?, ?, ?)",
+                    (endpoint, str(error), traceback.format_exc())
+                )
+    except:
+        pass
+
+def validate_upload_file(file):
+    """アップロードされた1ファイルを検証する。(ファイル, エラーメッセージ, ステータス) を返す
+    大きなファイルはWerkzeugが一時ファイルに書き出しているので、中身はメモリに読み込まずファイルのまま渡す"""
+    if file.filename == '':
+        return None, "ファイルが選択されていません", 400
+    
+    stream = file.stream
+    with trace_span('read_file'):
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        header = stream.read(16)
+        stream.seek(0)
+    
+    # ファイルサイズの再確認
+    if size > MAX_UPLOAD_BYTES:
+        return None, "ファイルサイズが大きすぎます", 413
+    if size == 0:
+        return None, "ファイルが空です", 400
+    
+    # ファイル形式は拡張子ではなく先頭バイトで確認する
+    if detect_image_mimetype(header) is None:
+        return None, "対応していないファイル形式です。JPEG, PNG, GIF, WebPのみ対応しています", 400
+    
+    # 小さいファイルはメモリ上にある
+    if isinstance(stream, io.BytesIO):
+        hold_buffer(size)
+    
+    return stream, None, None
+
+def check_school_id(school_id):
+    """アップロードを受け付ける前に学校のシャードを用意する。受け付けられなければエラーレスポンスを返す"""
+    try:
+        history_shards.shard_for_school(school_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return None
+
+def read_upload_image():
+    """フォームから画像を取り出して検証する。(アップロードファイル, エラーレスポンス) を返す"""
+    # バリデーション
+    if 'file' not in request.files:
+        return None, (jsonify({"error": "ファイルがありません"}), 400)
+    
+    upload, error, status = validate_upload_file(request.files['file'])
+    if error:
+        return None, (jsonify({"error": error}), status)
+    return upload, None
+
+def prepare_image(upload):
+    """前処理・キャッシュ検索・画像ストアへの保存をまとめて行う（upload はファイルかバイト列）"""
+    stream = io.BytesIO(upload) if isinstance(upload, (bytes, bytearray)) else upload
+    
+    # キャッシュのキーは元画像のハッシュ
+    with trace_span('hash'):
+        source_hash = compute_stream_hash(stream)
+    
+    # 前処理（縮小・再圧縮など）してから送る
+    with trace_span('preprocess'):
+        processed = image_preprocessor.process(stream)
+    metrics.record_preprocessing(processed["stats"])
+    
+    # 同じ（または見た目がほぼ同じ）画像の解説がキャッシュにあればAPIを呼ばない
+    with trace_span('cache_lookup'):
+        explanation_text, cache_result = explanation_cache.lookup(source_hash, processed["phash"])
+    metrics.record_cache_lookup(cache_result)
+    
+    # 画像はDBではなく画像ストアに保存
+    with trace_span('blob_store'):
+        image_hash = blob_store.put(processed["data"])
+        thumbnail_hash = blob_store.put(processed["thumbnail"]) if processed["thumbnail"] else None
+    
+    return {
+        "source_hash": source_hash,
+        "phash": processed["phash"],
+        "data": processed["data"],
+        "mimetype": processed["mimetype"],
+        "image_hash": image_hash,
+        "thumbnail_hash": thumbnail_hash,
+        "explanation": explanation_text,
+        "cache_result": cache_result
+    }
+
+def format_sse(event, data):
+    """Server-Sent Events の1イベント分の文字列を作る"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# 時系列メトリクスの保存と集計（長期間でも集計済みの行数だけ読めばよいようにする）
+class MetricStore:
+    # 集計の単位（秒）と保持期間（秒, Noneは無期限）
+    RESOLUTIONS = {300: 14 * 86400, 3600: 180 * 86400, 86400: None}
+    MAX_POINTS = 300
+    NICE_STEPS = [300, 900, 1800, 3600, 7200, 10800, 21600, 43200, 86400, 172800, 604800]
+    # ワーカーごとの値を合計する項目（カウンターの増分とプロセスごとの値）
+    # それ以外（DBから読む共通の値やマシン全体の値）は各ワーカーが同じ値を書くので、合計せず最大の値を使う
+    SUM_ACROSS_WORKERS = {
+        "requests", "errors", "api_calls", "cache_hits", "cache_misses",
+        "system_process_rss_mb", "system_open_fds", "system_threads", "process_peak_rss_mb"
+    }
+    
+    def __init__(self, raw_retention_seconds):
+        self.raw_retention_seconds = raw_retention_seconds
+        self.last_prune = 0
+        
+    def labels_key(self, labels):
+        return json.dumps(labels or {}, sort_keys=True, ensure_ascii=False)
+    
+    def write(self, points, ts=None):
+        """points: (名前, ラベルdict, 値) のリスト。ワーカーごとに別の系列として書き、読むときにまとめる"""
+        ts = int(ts or time.time())
+        worker = str(os.getpid())
+        rows = [(ts, name, self.labels_key(dict(labels, worker=worker)), float(value))
+                for name, labels, value in points if value is not None]
+        if not rows:
+            return
+        
+        with get_db_connection() as conn:
+            with conn:
+                conn.executemany("INSERT INTO metric_samples (ts, name, labels, value) VALUES (?, ?, ?, ?)", rows)
+                for resolution in self.RESOLUTIONS:
+                    bucket_start = ts - ts % resolution
+                    conn.executemany(
+                        "INSERT INTO metric_rollups (resolution, bucket_start, name, labels, count, total, min, max) "
+                        "VALUES (?, ?, ?, ?, 1, ?, ?, ?) "
+                        "ON CONFLICT(resolution, bucket_start, name, labels) DO UPDATE SET "
+                        "count = count + 1, total = total + excluded.total, "
+                        "min = MIN(min, excluded.min), max = MAX(max, excluded.max)",
+                        [(resolution, bucket_start, name, labels, value, value, value) for _, name, labels, value in rows]
+                    )
+                
+                # 古い生データ・集計は時々まとめて消す
+                if ts - self.last_prune > 3600:
+                    self.last_prune = ts
+                    conn.execute("DELETE FROM metric_samples WHERE ts < ?", (ts - self.raw_retention_seconds,))
+                    for resolution, retention in self.RESOLUTIONS.items():
+                        if retention:
+                            conn.execute(
+                                "DELETE FROM metric_rollups WHERE resolution = ? AND bucket_start < ?",
+                                (resolution, ts - retention)
+                            )
+                            
+    def choose_step(self, hours, step=None):
+        """要求された間隔（なければ点数が上限に収まる間隔）と、読む集計テーブルを決める"""
+        span = hours * 3600
+        step = max(step or 0, math.ceil(span / self.MAX_POINTS), min(self.RESOLUTIONS))
+        if step not in self.NICE_STEPS:
+            # 区切りのよい間隔に切り上げる（長い期間ほど粗い集計テーブルを読む）
+            step = next((s for s in self.NICE_STEPS if s >= step), math.ceil(step / 86400) * 86400)
+        resolution = max(r for r in self.RESOLUTIONS if r <= step and step % r == 0)
+        return step, resolution
+    
+    def query(self, hours, step=None, names=None):
+        step, resolution = self.choose_step(hours, step)
+        since = int(time.time() - hours * 3600)
+        since -= since % step
+        
+        sql = (
+            "SELECT name, labels, (bucket_start / ?) * ? AS t, SUM(count) AS count, SUM(total) AS total, "
+            "MIN(min) AS min, MAX(max) AS max FROM metric_rollups WHERE resolution = ? AND bucket_start >= ?"
+        )
+        params = [step, step, resolution, since]
+        if names:
+            sql += f" AND name IN ({', '.join('?' for _ in names)})"
+            params.extend(names)
+        sql += " GROUP BY name, labels, t ORDER BY name, labels, t"
+        
+        # ワーカーごとの行を (名前, ラベル, 時刻) ごとにまとめる
+        buckets = {}
+        with get_db_connection() as conn:
+            for row in conn.execute(sql, params):
+                labels = json.loads(row['labels'])
+                labels.pop('worker', None)
+                key = (row['name'], self.labels_key(labels))
+                buckets.setdefault(key, (labels, {}))[1].setdefault(row['t'], []).append(row)
+        
+        series = []
+        for (name, _), (labels, by_time) in sorted(buckets.items()):
+            combine = sum if name in self.SUM_ACROSS_WORKERS else max
+            series.append({"name": name, "labels": labels, "points": [
+                {
+                    "t": datetime.fromtimestamp(t).isoformat(),
+                    "avg": combine(row['total'] / row['count'] for row in rows),
+                    "sum": combine(row['total'] for row in rows),
+                    "min": combine(row['min'] for row in rows),
+                    "max": combine(row['max'] for row in rows)
+                }
+                for t, rows in sorted(by_time.items())
+            ]})
+        
+        return {
+            "hours": hours,
+            "step": step,
+            "resolution": resolution,
+            "series": series
+        }
+
+metric_store = MetricStore(raw_retention_seconds=int(os.getenv('METRICS_RAW_RETENTION_HOURS', 48)) * 3600)
+
+def collect_metric_points(metrics_data, previous_totals):
+    """get_metrics() の結果を (名前, ラベル, 値) の行に変換する。カウンターは前回からの増分にする"""
+    points = []
+    
+    def counter(name, labels, total):
+        key = (name, json.dumps(labels, sort_keys=True))
+        delta = total - previous_totals.get(key, 0)
+        previous_totals[key] = total
+        points.append((name, labels, max(delta, 0)))
+    
+    for endpoint, count in metrics_data["request_counts"].items():
+        counter("requests", {"endpoint": endpoint}, count)
+    for endpoint, count in metrics_data["error_counts"].items():
+        counter("errors", {"endpoint": endpoint}, count)
+    for api_name, count in metrics_data["api_calls"].items():
+        counter("api_calls", {"api": api_name}, count)
+    counter("cache_hits", {}, metrics_data["explanation_cache"]["hits"])
+    counter("cache_misses", {}, metrics_data["explanation_cache"]["misses"])
+    
+    # パーセンタイルは全ワーカー共通の値なので平均しても変わらない
+    for group, entries in metrics_data["latency_percentiles"].items():
+        for label, summary in entries.items():
+            for quantile in ("p50", "p90", "p99", "max"):
+                points.append(("latency_seconds", {"group": group, "name": label, "quantile": quantile}, summary[quantile]))
+    
+    for key in ("cpu_percent", "memory_percent", "process_rss_mb", "open_fds", "threads", "db_size_mb"):
+        if key in metrics_data["system"]:
+            points.append((f"system_{key}", {}, metrics_data["system"][key]))
+    
+    for name, summary in metrics_data["memory"]["requests"].items():
+        for quantile in ("p95_mb", "max_mb"):
+            points.append(("request_peak_memory_mb", {"endpoint": name, "quantile": quantile}, summary[quantile]))
+    if metrics_data["memory"]["process_peak_rss_mb"] is not None:
+        points.append(("process_peak_rss_mb", {}, metrics_data["memory"]["process_peak_rss_mb"]))
+    
+    job_queue_stats = metrics_data["gauges"].get("job_queue") or {}
+    if "queue_depth" in job_queue_stats:
+        points.append(("job_queue_depth", {}, job_queue_stats["queue_depth"]))
+    
+    return points
+
+# 定期的なメトリクス保存
+def save_metrics_periodically():
+    interval = float(os.getenv('METRICS_SAVE_INTERVAL', 300))  # 既定は5分ごと
+    previous_totals = {}
+    while True:
+        try:
+            time.sleep(interval)
+            metrics_data = metrics.get_metrics()
+            
+            metric_store.write(collect_metric_points(metrics_data, previous_totals))
+            
+            logger.info("Metrics saved to database")
+        except Exception as e:
+            logger.error(f"Error saving metrics: {str(e)}")
+
+# バックグラウンドスレッドでメトリクス保存を開始
+threading.Thread(target=save_metrics_periodically, daemon=True).start()
+
+# レイテンシのヒストグラムを数秒ごとにDBへ書き出す
+def flush_histograms_periodically():
+    interval = float(os.getenv('METRICS_FLUSH_SECONDS', 5))
+    while True:
+        time.sleep(interval)
+        try:
+            metrics.latency.flush()
+            request_profiler.flush()
+        except Exception as e:
+            logger.error(f"Error flushing latency histograms: {str(e)}")
+
+threading.Thread(target=flush_histograms_periodically, daemon=True).start()
+
+# 監視画面へのプッシュ配信（プロセス内のイベントバス）
+class EventSubscriber:
+    def __init__(self, queue_size):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflowed = False
+        
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            # 読むのが遅い閲覧者は差分を取りこぼしたので、全体を読み直してもらう
+            self.overflowed = True
+            return False
+        
+    def get(self, timeout):
+        if self.overflowed:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.overflowed = False
+            return 'resync', {}
+        return self.queue.get(timeout=timeout)
+
+class EventBus:
+    def __init__(self, queue_size, max_subscribers):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+        
+    def subscribe(self):
+        """購読を始める。上限に達していれば None"""
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            subscriber = EventSubscriber(self.queue_size)
+            self.subscribers.add(subscriber)
+            return subscriber
+        
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            
+    def subscriber_count(self):
+        with self.lock:
+            return len(self.subscribers)
+        
+    def publish(self, event, data):
+        with self.lock:
+            subscribers = list(self.subscribers)
+            self.published += 1
+        for subscriber in subscribers:
+            if not subscriber.put((event, data)):
+                with self.lock:
+                    self.dropped += 1
+                    
+    def stats(self):
+        with self.lock:
+            return {
+                "subscribers": len(self.subscribers),
+                "max_subscribers": self.max_subscribers,
+                "published": self.published,
+                "dropped": self.dropped
+            }
+
+event_bus = EventBus(
+    queue_size=int(os.getenv('METRICS_STREAM_QUEUE_SIZE', 100)),
+    # 接続中のSSEはそれぞれgunicornのスレッドを1つ占有する（1ワーカー8スレッド）
+    # 監視画面のためにアップロードを処理するスレッドが足りなくならないよう、既定は2つまでにする
+    max_subscribers=int(os.getenv('METRICS_STREAM_MAX_SUBSCRIBERS', 2))
+)
+metrics.register_gauge('event_bus', event_bus.stats)
+
+def diff_metrics(previous, current):
+    """前回からの変化分だけを返す（消えた項目は None）。変化がなければ空の dict"""
+    delta = {}
+    for key, value in current.items():
+        if key not in previous:
+            delta[key] = value
+        elif isinstance(value, dict) and isinstance(previous[key], dict):
+            nested = diff_metrics(previous[key], value)
+            if nested:
+                delta[key] = nested
+        elif value != previous[key]:
+            delta[key] = value
+    for key in previous:
+        if key not in current:
+            delta[key] = None
+    return delta
+
+class MetricsFeed:
+    """閲覧者がいるときだけ、数秒ごとにメトリクスの差分と新しいエラーなどをイベントバスに流す
+    計算とDBの確認は閲覧者の人数によらず1プロセスにつき1回"""
+    HISTORY_NAMES = ['latency_seconds', 'requests', 'errors']
+    
+    def __init__(self, bus, interval, history_hours):
+        self.bus = bus
+        self.interval = interval
+        self.history_step = metric_store.choose_step(history_hours)[0]
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.last_error_id = 0
+        self.last_slow_id = 0
+        self.last_sample_ts = None
+        
+    def start(self):
+        threading.Thread(target=self._run, name="metrics-feed", daemon=True).start()
+        
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self.bus.subscriber_count() == 0:
+                    # 誰も見ていない間は何もせず、次の閲覧者には最新の全体を渡す
+                    with self.lock:
+                        self.snapshot = None
+                    continue
+                self.tick()
+            except Exception as e:
+                logger.error(f"Error in metrics feed: {str(e)}")
+                
+    def current_snapshot(self):
+        """新しい閲覧者に最初に送る全体"""
+        with self.lock:
+            if self.snapshot is None:
+                self._reset()
+            return self.snapshot
+        
+    def _collect(self):
+        # タプルや日時を JSON と同じ形にそろえてから比べる
+        return json.loads(json.dumps(metrics.get_metrics(), default=str))
+    
+    def _reset(self):
+        self.snapshot = self._collect()
+        with get_db_connection() as conn:
+            row = conn.execute(
+                "SELECT (SELECT COALESCE(MAX(id), 0) FROM error_logs) AS error_id, "
+                "(SELECT COALESCE(MAX(id), 0) FROM slow_requests) AS slow_id, "
+                "(SELECT MAX(ts) FROM metric_samples) AS sample_ts"
+            ).fetchone()
+        self.last_error_id = row['error_id']
+        self.last_slow_id = row['slow_id']
+        self.last_sample_ts = row['sample_ts']
+        
+    def tick(self):
+        with self.lock:
+            if self.snapshot is None:
+                self._reset()
+                return
+            
+            current = self._collect()
+            delta = diff_metrics(self.snapshot, current)
+            self.snapshot = current
+            if delta:
+                self.bus.publish('metrics', delta)
+            
+            # エラーと遅いリクエストは全ワーカーが同じテーブルに書くので、DBから新しい行を拾う
+            with get_db_connection() as conn:
+                errors = conn.execute(
+                    "SELECT id, endpoint, error_message, timestamp FROM error_logs WHERE id > ? ORDER BY id LIMIT 50",
+                    (self.last_error_id,)
+                ).fetchall()
+                slow = conn.execute(
+                    "SELECT id, endpoint, path, status, duration, spans, timestamp FROM slow_requests WHERE id > ? ORDER BY id LIMIT 50",
+                    (self.last_slow_id,)
+                ).fetchall()
+                sample_ts = conn.execute("SELECT MAX(ts) FROM metric_samples").fetchone()[0]
+            
+            for row in errors:
+                self.bus.publish('error', dict(row))
+                self.last_error_id = row['id']
+            for row in slow:
+                self.bus.publish('slow_request', dict(row, spans=json.loads(row['spans'])))
+                self.last_slow_id = row['id']
+            
+            # 新しいサンプルが書き込まれたら、グラフの最新の区間だけを送る
+            if sample_ts != self.last_sample_ts:
+                self.last_sample_ts = sample_ts
+                latest = metric_store.query(self.history_step * 2 / 3600, self.history_step, self.HISTORY_NAMES)
+                self.bus.publish('history', {"step": latest["step"], "series": latest["series"]})
+
+metrics_feed = MetricsFeed(
+    event_bus,
+    interval=float(os.getenv('METRICS_STREAM_INTERVAL', 5)),
+    history_hours=24
+)
+metrics_feed.start()
+
+# 1つの接続を開いておく最長の秒数（過ぎたらクライアントがつなぎ直す）
+METRICS_STREAM_MAX_SECONDS = int(os.getenv('METRICS_STREAM_MAX_SECONDS', 600))
+METRICS_STREAM_KEEPALIVE_SECONDS = 15
+
+# 解析ジョブキュー（/upload は登録だけして即座に返し、Vision APIはワーカースレッドで呼ぶ）
+class JobQueue:
+    def __init__(self, workers, stale_seconds, max_attempts, poll_interval=1.0):
+        self.workers = workers
+        self.stale_seconds = stale_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        # 同じプロセス内の登録・完了はすぐに通知する（他プロセス分はポーリングで拾う）
+        self.new_job = threading.Condition()
+        self.job_finished = threading.Condition()
+        self.running = 0
+        self.lock = threading.Lock()
+        
+    def start(self):
+        self.requeue_stale()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True).start()
+            
+    def enqueue(self, user_id, school_id, image):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with trace_span('enqueue'), get_db_connection() as conn:
+            with conn:
+                conn.execute(
+                    "INSERT INTO jobs (id, status, user_id, school_id, source_hash, phash, image_hash, thumbnail_hash, mimetype, created_at, queued_at) "
+                    "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, user_id, school_id, image["source_hash"], image["phash"],
+                     image["image_hash"], image["thumbnail_hash"], image["mimetype"], now, now)
+                )
+        
+        with self.new_job:
+            self.new_job.notify()
+        return job_id
+    
+    def get(self, job_id):
+        with get_db_connection() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def wait(self, job_id, timeout):
+        """ジョブが終わるか timeout 秒経つまで待ってから状態を返す（ロングポーリング用）"""
+        deadline = time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.time()
+            if job is None or job['status'] in ('done', 'error') or remaining <= 0:
+                return job
+            with self.job_finished:
+                self.job_finished.wait(min(remaining, 0.5))
+                
+    def queue_depth(self):
+        with get_db_connection() as conn:
+            row = conn.execute("SELECT COUNT(*) AS total FROM jobs WHERE status = 'queued'").fetchone()
+        return row['total']
+    
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "running_in_process": self.running,
+            "workers": self.workers
+        }
+    
+    def requeue_stale(self):
+        """実行中のままワーカーが落ちたジョブをキューに戻す（規定回数を使い切ったジョブは失敗にする）"""
+        now = time.time()
+        with get_db_connection() as conn:
+            with conn:
+                requeued = conn.execute(
+                    "UPDATE jobs SET status = 'queued', claim_token = NULL, queued_at = ? WHERE status = 'running' AND started_at < ? AND attempts < ?",
+                    (now, now - self.stale_seconds, self.max_attempts)
+                ).rowcount
+                # 毎回ワーカーを落とすような画像を何度も実行し続けないようにする
+                failed = conn.execute(
+                    "UPDATE jobs SET status = 'error', error_message = ?, claim_token = NULL, finished_at = ? "
+                    "WHERE status = 'running' AND started_at < ? AND attempts >= ?",
+                    ("処理中にワーカーが停止したため、解析を中断しました", now, now - self.stale_seconds, self.max_attempts)
+                ).rowcount
+        if requeued:
+            logger.info(f"Requeued {requeued} stale jobs")
+        if failed:
+            logger.warning(f"Marked {failed} stale jobs as failed after {self.max_attempts} attempts")
+            
+    def _claim(self):
+        """待ち行列の先頭のジョブを1件取得して実行中にする"""
+        token = uuid.uuid4().hex
+        with get_db_connection() as conn:
+            with conn:
+                # 1文のUPDATEなので複数のワーカー（プロセス）が同じジョブを取ることはない
+                cursor = conn.execute(
+                    "UPDATE jobs SET status = 'running', claim_token = ?, started_at = ?, attempts = attempts + 1 "
+                    "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1) AND status = 'queued'",
+                    (token, time.time())
+                )
+            job = None
+            if cursor.rowcount:
+                row = conn.execute("SELECT * FROM jobs WHERE claim_token = ?", (token,)).fetchone()
+                job = dict(row) if row else None
+        return job
+    
+    def _worker_loop(self):
+        last_stale_check = time.time()
+        while True:
+            try:
+                if time.time() - last_stale_check > 60:
+                    self.requeue_stale()
+                    last_stale_check = time.time()
+                
+                job = self._claim()
+                if job is None:
+                    with self.new_job:
+                        self.new_job.wait(self.poll_interval)
+                    continue
+                
+                with self.lock:
+                    self.running += 1
+                try:
+                    self._run(job)
+                finally:
+                    with self.lock:
+                        self.running -= 1
+                    with self.job_finished:
+                        self.job_finished.notify_all()
+            except Exception as e:
+                logger.error(f"Error in job worker: {str(e)}\n{traceback.format_exc()}")
+                time.sleep(self.poll_interval)
+                
+    def _run(self, job):
+        # 今回キューに入ってから取られるまでの時間（前回までの実行時間は含めない）
+        wait_time = job['started_at'] - (job['queued_at'] or job['created_at'])
+        try:
+            with background_trace('job'):
+                with trace_span('base64'), open(blob_store.path_for(job['image_hash']), 'rb') as f:
+                    data_url = encode_data_url(f, job['mimetype'])
+                
+                explanation_text = analyze_image(data_url)
+                with trace_span('cache_store'):
+                    explanation_cache.store(job['source_hash'], job['phash'], explanation_text)
+                history_id = save_history(job['user_id'], job['school_id'], job['image_hash'], job['thumbnail_hash'], explanation_text)
+            
+            with get_db_connection() as conn:
+                with conn:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'done', explanation = ?, history_id = ?, finished_at = ? WHERE id = ?",
+                        (explanation_text, history_id, time.time(), job['id'])
+                    )
+            
+            metrics.record_job('done', wait_time, time.time() - job['started_at'])
+            logger.info(f"Job {job['id']} done for user: {job['user_id']}")
+            
+        except OverloadedError as e:
+            # APIが混んでいる・止まっているだけなので失敗回数には数えずにキューへ戻し、少し待ってから次を取る
+            with get_db_connection() as conn:
+                with conn:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'queued', attempts = attempts - 1, claim_token = NULL, queued_at = ? WHERE id = ?",
+                        (time.time(), job['id'])
+                    )
+            metrics.record_job('deferred', wait_time, time.time() - job['started_at'])
+            time.sleep(min(e.retry_after, 5))
+            
+        except Exception as e:
+            logger.error(f"Error in job {job['id']}: {str(e)}\n{traceback.format_exc()}")
+            save_error_log('job', e)
+            
+            # 規定回数まではキューに戻して再実行する
+            status = 'queued' if job['attempts'] < self.max_attempts else 'error'
+            with get_db_connection() as conn:
+                with conn:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, error_message = ?, claim_token = NULL, finished_at = ?, queued_at = ? WHERE id = ?",
+                        (status, str(e), time.time() if status == 'error' else None, time.time(), job['id'])
+                    )
+            
+            metrics.record_job('retry' if status == 'queued' else 'error', wait_time, time.time() - job['started_at'])
+
+job_queue = JobQueue(
+    workers=int(os.getenv('JOB_WORKERS', 4)),
+    stale_seconds=int(os.getenv('JOB_STALE_SECONDS', 180)),
+    max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', 2))
+)
+metrics.register_gauge('job_queue', job_queue.stats)
+job_queue.start()
+
+def serialize_job(job):
+    result = {
+        "job_id": job['id'],
+        "status": job['status'],
+        "status_url": f"/jobs/{job['id']}",
+        "created_at": datetime.fromtimestamp(job['created_at']).isoformat()
+    }
+    if job['status'] == 'done':
+        result["explanation"] = job['explanation']
+        result["history_id"] = job['history_id']
+    elif job['status'] == 'error':
+        result["error"] = "画像の解析に失敗しました。もう一度お試しください。"
+        result["details"] = job['error_message'] if app.debug else None
+    return result
+
+# ビルド済みの静的ファイル（build_assets.py の出力）。起動時に1回だけ読み込み、リクエストごとにハッシュは計算しない
+ASSET_DIST_DIR = os.path.join(app.root_path, 'static', 'dist')
+
+class AssetManifest:
+    def __init__(self, dist_dir, sw_path):
+        self.dist_dir = dist_dir
+        self.version = 'dev'
+        self.files = {}
+        self.by_hashed_name = {}
+        self.load()
+        self.service_worker_source = self.render_service_worker(sw_path)
+        self.service_worker_etag = hashlib.sha1(self.service_worker_source.encode('utf-8')).hexdigest()
+        
+    def load(self):
+        path = os.path.join(self.dist_dir, 'asset-manifest.json')
+        try:
+            with open(path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            logger.info("Asset manifest not found, serving unhashed /static files")
+            return
+        self.version = manifest["version"]
+        self.files = manifest["files"]
+        self.by_hashed_name = {entry["file"]: entry for entry in self.files.values()}
+        logger.info(f"Loaded asset manifest {self.version} ({len(self.files)} files)")
+        
+    def url(self, name):
+        entry = self.files.get(name)
+        return f"/assets/{entry['file']}" if entry else f"/static/{name}"
+    
+    def mimetype_for(self, hashed_name):
+        return mimetypes.guess_type(hashed_name)[0] or 'application/octet-stream'
+    
+    def render_service_worker(self, sw_path):
+        """sw.js の版とファイルURLの行をマニフェストの値に置き換える"""
+        with open(sw_path, encoding='utf-8') as f:
+            source = f.read()
+        urls = {name: self.url(name) for name in self.files}
+        source = source.replace("const ASSET_VERSION = 'dev';", f"const ASSET_VERSION = {json.dumps(self.version)};", 1)
+        source = source.replace("const ASSET_URLS = {};", f"const ASSET_URLS = {json.dumps(urls)};", 1)
+        return source
+
+asset_manifest = AssetManifest(ASSET_DIST_DIR, os.path.join(app.root_path, 'static', 'sw.js'))
+
+@app.context_processor
+def inject_asset_url():
+    return {"asset_url": asset_manifest.url}
+
+# ルートページ
+@app.route('/')
+@monitor_performance('index')
+def index():
+    return render_template('main.html')
+
+# Service Worker（キャッシュ名とファイルのURLはアセットマニフェストから埋め込む）
+@app.route('/sw.js')
+def service_worker():
+    response = Response(asset_manifest.service_worker_source, mimetype='application/javascript')
+    # 更新をすぐ検知できるよう毎回確認させる
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(asset_manifest.service_worker_etag)
+    return response.make_conditional(request)
+
+# Manifest
+@app.route('/manifest.json')
+def manifest():
+    response = send_from_directory('static', 'manifest.json', mimetype='application/manifest+json')
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
+
+# ハッシュ付きの静的ファイル（内容が変わればURLも変わるので永久にキャッシュできる）
+@app.route('/assets/<path:filename>')
+def serve_asset(filename):
+    entry = asset_manifest.by_hashed_name.get(filename)
+    if entry is None:
+        return jsonify({"error": "ファイルが見つかりません"}), 404
+    
+    # 事前に圧縮したファイルがあれば、実際にあるものの中から対応している形式を選ぶ（同じ重みなら br を優先）
+    path = os.path.join(ASSET_DIST_DIR, filename)
+    encodings = sorted(entry["encodings"], key=lambda e: e != 'br')
+    encoding = request.accept_encodings.best_match(encodings) if encodings else None
+    if encoding:
+        path += '.br' if encoding == 'br' else '.gz'
+    
+    # 圧縮形式ごとに中身が違うので、ETag も形式ごとに分ける
+    response = send_file(path, mimetype=asset_manifest.mimetype_for(filename),
+                         etag=f'{entry["file"]}-{encoding or "identity"}', conditional=True, max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+# 静的ファイル配信（build_assets.py を実行していない開発環境用）
+@app.route('/static/<path:filename>')
+def serve_static(filename):
+    return send_from_directory('static', filename)
+
+# 保持期間による古いデータの削除（少しずつ消してロックを長く持たない）
+class RetentionManager:
+    # テーブルごとの日時の列と、削除対象に加える条件
+    TABLES = {
+        'history': {"column": "timestamp", "kind": "datetime"},
+        'monitoring_logs': {"column": "timestamp", "kind": "datetime"},
+        'error_logs': {"column": "timestamp", "kind": "datetime"},
+        'slow_requests': {"column": "timestamp", "kind": "datetime"},
+        'jobs': {"column": "created_at", "kind": "epoch", "condition": "status IN ('done', 'error')"}
+    }
+    
+    def __init__(self, policies, batch_size, batch_pause, vacuum_pages, interval_seconds, stale_seconds, blob_grace_seconds):
+        self.policies = policies
+        self.blob_grace_seconds = blob_grace_seconds
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.vacuum_pages = vacuum_pages
+        self.interval_seconds = interval_seconds
+        self.stale_seconds = stale_seconds
+        
+    def start_scheduler(self):
+        threading.Thread(target=self._schedule_loop, name="retention", daemon=True).start()
+        
+    def _schedule_loop(self):
+        while True:
+            time.sleep(min(self.interval_seconds, 3600))
+            try:
+                last = self.latest_run()
+                if last is None or time.time() - last['started_at'] >= self.interval_seconds:
+                    run_id = self.try_start(self.policies)
+                    if run_id:
+                        self.run(run_id, self.policies)
+            except Exception as e:
+                logger.error(f"Error in retention scheduler: {str(e)}")
+                
+    def try_start(self, policies):
+        """実行中のものがなければ実行記録を作ってIDを返す（複数ワーカーで同時に走らないように）"""
+        progress = {"policies": policies, "tables": {}, "deleted": 0, "rows_per_second": 0.0,
+                    "blobs_removed": 0, "pages_reclaimed": 0, "current_table": None}
+        return self._try_start_kind('retention', progress)
+    
+    def _try_start_kind(self, kind, progress):
+        run_id = uuid.uuid4().hex
+        now = time.time()
+        with get_db_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # VACUUM と保持期間の削除も同時には走らせない
+                running = conn.execute(
+                    "SELECT id FROM maintenance_runs WHERE status = 'running' AND updated_at > ?",
+                    (now - self.stale_seconds,)
+                ).fetchone()
+                if running:
+                    conn.rollback()
+                    return None
+                conn.execute(
+                    "INSERT INTO maintenance_runs (id, kind, status, progress, started_at, updated_at) VALUES (?, ?, 'running', ?, ?, ?)",
+                    (run_id, kind, json.dumps(progress), now, now)
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return run_id
+    
+    def get_run(self, run_id):
+        with get_db_connection() as conn:
+            row = conn.execute("SELECT * FROM maintenance_runs WHERE id = ?", (run_id,)).fetchone()
+        return self._serialize(row) if row else None
+    
+    def latest_run(self, kind='retention'):
+        with get_db_connection() as conn:
+            row = conn.execute(
+                "SELECT * FROM maintenance_runs WHERE kind = ? ORDER BY started_at DESC LIMIT 1",
+                (kind,)
+            ).fetchone()
+        return self._serialize(row) if row else None
+    
+    def running_run(self):
+        with get_db_connection() as conn:
+            row = conn.execute(
+                "SELECT * FROM maintenance_runs WHERE status = 'running' ORDER BY started_at DESC LIMIT 1"
+            ).fetchone()
+        return self._serialize(row) if row else None
+    
+    def try_start_vacuum_conversion(self):
+        return self._try_start_kind('incremental_vacuum', {"enabled_before": incremental_vacuum_enabled()})
+    
+    def convert_to_incremental_vacuum(self, run_id):
+        """本体DBを auto_vacuum=INCREMENTAL にする（ファイル全体を書き直すので一度だけ、管理者の操作で実行する）"""
+        progress = self.get_run(run_id)['progress']
+        started = time.time()
+        try:
+            with get_db_connection() as conn:
+                if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                    conn.execute("VACUUM")
+            progress["enabled"] = incremental_vacuum_enabled()
+            progress["elapsed_seconds"] = time.time() - started
+            self._save_progress(run_id, progress, status='done')
+            logger.info("Enabled incremental auto_vacuum")
+        except Exception as e:
+            logger.error(f"Error enabling incremental vacuum: {str(e)}")
+            save_error_log('incremental_vacuum', e)
+            progress["error"] = str(e)
+            self._save_progress(run_id, progress, status='error')
+    
+    def _serialize(self, row):
+        run = dict(row)
+        run['progress'] = json.loads(run['progress'])
+        return run
+    
+    def _save_progress(self, run_id, progress, status='running'):
+        now = time.time()
+        with get_db_connection() as conn:
+            with conn:
+                conn.execute(
+                    "UPDATE maintenance_runs SET progress = ?, status = ?, updated_at = ?, finished_at = ? WHERE id = ?",
+                    (json.dumps(progress), status, now, now if status != 'running' else None, run_id)
+                )
+                
+    def _cutoff(self, table, days):
+        cutoff = datetime.now() - timedelta(days=days)
+        if self.TABLES[table]["kind"] == "epoch":
+            return cutoff.timestamp()
+        return cutoff.strftime("%Y-%m-%d %H:%M:%S")
+    
+    def run(self, run_id, policies):
+        progress = self.get_run(run_id)['progress']
+        started = time.time()
+        try:
+            for table, days in policies.items():
+                if days is None or table not in self.TABLES:
+                    continue
+                progress["current_table"] = table
+                table_progress = progress["tables"].setdefault(table, {"deleted": 0, "batches": 0, "days": days})
+                
+                spec = self.TABLES[table]
+                where = f"{spec['column']} < ?"
+                if spec.get("condition"):
+                    where += f" AND {spec['condition']}"
+                cutoff = self._cutoff(table, days)
+                
+                # 履歴は学校のシャードごとに削除して、それぞれのファイルを縮める
+                shards = history_shards.all_shards() if table == 'history' else [None]
+                for shard_no in shards:
+                    while True:
+                        deleted, blobs_removed = self._delete_batch(table, where, cutoff, shard_no)
+                        if deleted == 0:
+                            break
+                        table_progress["deleted"] += deleted
+                        table_progress["batches"] += 1
+                        if shard_no is not None:
+                            shard_progress = table_progress.setdefault("shards", {})
+                            shard_progress[str(shard_no)] = shard_progress.get(str(shard_no), 0) + deleted
+                        progress["deleted"] += deleted
+                        progress["blobs_removed"] += blobs_removed
+                        progress["rows_per_second"] = progress["deleted"] / max(time.time() - started, 0.001)
+                        self._save_progress(run_id, progress)
+                        # 他のリクエストが書き込めるよう、バッチごとに少し休む
+                        time.sleep(self.batch_pause)
+                    
+                    progress["pages_reclaimed"] += self._incremental_vacuum(shard_no)
+                    self._save_progress(run_id, progress)
+            
+            progress["current_table"] = None
+            progress["elapsed_seconds"] = time.time() - started
+            self._save_progress(run_id, progress, status='done')
+            logger.info(f"Retention run {run_id} deleted {progress['deleted']} rows")
+            
+        except Exception as e:
+            logger.error(f"Error in retention run {run_id}: {str(e)}\n{traceback.format_exc()}")
+            save_error_log('retention', e)
+            progress["error"] = str(e)
+            self._save_progress(run_id, progress, status='error')
+            
+    def _connection(self, shard_no):
+        return get_db_connection() if shard_no is None else history_shards.connection(shard_no)
+    
+    def _delete_batch(self, table, where, cutoff, shard_no=None):
+        with self._connection(shard_no) as conn:
+            with conn:
+                if table != 'history':
+                    cursor = conn.execute(
+                        f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT ?)",
+                        (cutoff, self.batch_size)
+                    )
+                    return cursor.rowcount, 0
+                
+                # 履歴は画像ストアのファイルも参照が無くなれば消す
+                rows = conn.execute(
+                    f"SELECT id, image_hash, thumbnail_hash FROM history WHERE {where} LIMIT ?",
+                    (cutoff, self.batch_size)
+                ).fetchall()
+                if not rows:
+                    return 0, 0
+                conn.executemany("DELETE FROM history WHERE id = ?", [(row['id'],) for row in rows])
+        
+        # 同じ画像を別の学校の履歴や解析待ちのジョブが使っていることもある
+        hashes = {h for row in rows for h in (row['image_hash'], row['thumbnail_hash']) if h}
+        removed = 0
+        for blob_hash in hashes:
+            with get_db_connection() as conn:
+                job_uses = conn.execute(
+                    "SELECT 1 FROM jobs WHERE image_hash = ? AND status IN ('queued', 'running') LIMIT 1",
+                    (blob_hash,)
+                ).fetchone()
+            if (not job_uses and not history_shards.image_in_use(blob_hash)
+                    and blob_store.delete(blob_hash, min_age=self.blob_grace_seconds)):
+                removed += 1
+        return len(rows), removed
+        
+    def _incremental_vacuum(self, shard_no=None):
+        """空きページを少しずつファイルから返す（auto_vacuum=INCREMENTAL のときだけ効く）"""
+        reclaimed = 0
+        with self._connection(shard_no) as conn:
+            while True:
+                free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if free_pages == 0:
+                    break
+                conn.execute(f"PRAGMA incremental_vacuum({self.vacuum_pages})").fetchall()
+                after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if after >= free_pages:
+                    break
+                reclaimed += free_pages - after
+                time.sleep(self.batch_pause)
+        return reclaimed
+
+def retention_days(name, default):
+    value = os.getenv(name, default)
+    return int(value) if value not in (None, '') else None
+
+retention_manager = RetentionManager(
+    policies={
+        # 履歴は既定では自動削除しない（RETENTION_HISTORY_DAYS を設定したときだけ）
+        'history': retention_days('RETENTION_HISTORY_DAYS', None),
+        'monitoring_logs': retention_days('RETENTION_MONITORING_DAYS', 30),
+        'error_logs': retention_days('RETENTION_ERROR_DAYS', 90),
+        'slow_requests': retention_days('RETENTION_SLOW_REQUEST_DAYS', 14),
+        'jobs': retention_days('RETENTION_JOBS_DAYS', 7)
+    },
+    batch_size=int(os.getenv('RETENTION_BATCH_SIZE', 500)),
+    batch_pause=float(os.getenv('RETENTION_BATCH_PAUSE', 0.05)),
+    vacuum_pages=int(os.getenv('RETENTION_VACUUM_PAGES', 1000)),
+    interval_seconds=int(os.getenv('RETENTION_INTERVAL_HOURS', 24)) * 3600,
+    stale_seconds=600,
+    # アップロード直後の画像は、同じ画像の古い履歴が消えても残す（履歴の保存より先に画像を保存するため）
+    blob_grace_seconds=int(os.getenv('RETENTION_BLOB_GRACE_SECONDS', 3600))
+)
+retention_manager.start_scheduler()
+
+# 解析待ちジョブの上限（これを超えたら /upload は503を返す）
+JOB_QUEUE_LIMIT = int(os.getenv('JOB_QUEUE_LIMIT', 200))
+
+def overloaded_response(error):
+    metrics.record_error('overloaded')
+    response = jsonify({"error": str(error), "retry_after": error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
+
+# 学校全体でのアップロード上限（1分あたり）
+SCHOOL_UPLOAD_LIMIT_PER_MINUTE = int(os.getenv('SCHOOL_UPLOAD_LIMIT_PER_MINUTE', 300))
+# まとめてアップロードのユーザーごとの上限（1分あたりの枚数。1回分の最大枚数は必ず送れるようにする）
+BATCH_PAGES_PER_MINUTE = max(BATCH_MAX_FILES, int(os.getenv('BATCH_PAGES_PER_MINUTE', 20)))
+
+# 画像アップロードと解析
+# 非同期を選ばなかった /upload がジョブの完了を待つ最長の秒数（過ぎたら 202 でジョブを返す）
+UPLOAD_SYNC_WAIT_SECONDS = float(os.getenv('UPLOAD_SYNC_WAIT_SECONDS', 100))
+
+def wants_async_response():
+    return request.args.get('async') == '1' or 'respond-async' in request.headers.get('Prefer', '')
+
+@app.route('/upload', methods=['POST'])
+@monitor_performance('upload')
+@rate_limit(max_calls=5, period=60, school_max_calls=SCHOOL_UPLOAD_LIMIT_PER_MINUTE)  # 1分間に5回まで
+def upload():
+    try:
+        # フォームデータ取得
+        school_id = request.form.get('school_id', 'default_school')
+        user_id = request.form.get('user_id', 'default_user')
+        error_response = check_school_id(school_id)
+        if error_response:
+            return error_response
+        
+        upload, error_response = read_upload_image()
+        if error_response:
+            return error_response
+        
+        image = prepare_image(upload)
+        
+        if image["explanation"] is not None:
+            # キャッシュヒットはその場で保存して返す
+            history_id = save_history(user_id, school_id, image["image_hash"], image["thumbnail_hash"], image["explanation"])
+            logger.info(f"Served cached explanation for user: {user_id}")
+            return jsonify({
+                "success": True,
+                "status": "done",
+                "explanation": image["explanation"],
+                "history_id": history_id,
+                "cached": True
+            })
+        
+        # APIが止まっている・待ちが多すぎるときは、待たせずにすぐ断る
+        if vision_guard.breaker.is_open():
+            return overloaded_response(OverloadedError("AIサービスが不安定なため一時的に受付を停止しています", vision_guard.breaker.retry_after()))
+        if job_queue.queue_depth() >= JOB_QUEUE_LIMIT:
+            return overloaded_response(OverloadedError("混み合っています。しばらくしてからもう一度お試しください", 30))
+        
+        # GPT Vision APIでの画像解析はジョブとして登録し、結果は /jobs/<id> で受け取る
+        job_id = job_queue.enqueue(user_id, school_id, image)
+        logger.info(f"Queued job {job_id} for user: {user_id}")
+        
+        # ?async=1 か Prefer: respond-async を送ったクライアントにだけすぐ 202 を返す
+        # 古い main.js（Service Workerのキャッシュに残っているもの）は従来どおり解説の入った応答を待つ
+        if not wants_async_response():
+            job = job_queue.wait(job_id, UPLOAD_SYNC_WAIT_SECONDS)
+            if job is not None and job['status'] == 'done':
+                return jsonify({
+                    "success": True,
+                    "status": "done",
+                    "explanation": job['explanation'],
+                    "history_id": job['history_id'],
+                    "cached": False
+                })
+            if job is not None and job['status'] == 'error':
+                return jsonify(serialize_job(job)), 500
+        
+        return jsonify({
+            "success": True,
+            "status": "queued",
+            "job_id": job_id,
+            "status_url": f"/jobs/{job_id}",
+            "cached": False
+        }), 202
+        
+    except Exception as e:
+        logger.error(f"Error in upload: {str(e)}\n{traceback.format_exc()}")
+        
+        # エラーログをDBに保存
+        save_error_log('upload', e)
+        
+        return jsonify({
+            "error": "画像の解析に失敗しました。もう一度お試しください。",
+            "details": str(e) if app.debug else None
+        }), 500
+
+# 画像アップロードと解析（ストリーミング版: 生成された文章をSSEで逐次返す）
+@app.route('/upload/stream', methods=['POST'])
+@monitor_performance('upload_stream')
+@rate_limit(max_calls=5, period=60, school_max_calls=SCHOOL_UPLOAD_LIMIT_PER_MINUTE)  # /upload と同じく1分間に5回まで
+def upload_stream():
+    try:
+        school_id = request.form.get('school_id', 'default_school')
+        user_id = request.form.get('user_id', 'default_user')
+        error_response = check_school_id(school_id)
+        if error_response:
+            return error_response
+        
+        upload, error_response = read_upload_image()
+        if error_response:
+            return error_response
+        
+        image = prepare_image(upload)
+        
+        # キャッシュにない場合は、レスポンスを返し始める前にAPIの実行枠を取る（取れなければ503）
+        slot = vision_guard.acquire() if image["explanation"] is None else None
+        
+    except OverloadedError as e:
+        return overloaded_response(e)
+    except Exception as e:
+        logger.error(f"Error in upload_stream: {str(e)}\n{traceback.format_exc()}")
+        save_error_log('upload_stream', e)
+        return jsonify({
+            "error": "画像の解析に失敗しました。もう一度お試しください。",
+            "details": str(e) if app.debug else None
+        }), 500
+    
+    def generate():
+        start_time = time.time()
+        try:
+            explanation_text = image["explanation"]
+            
+            if explanation_text is not None:
+                # キャッシュヒット時はまとめて1回で送る
+                metrics.record_time_to_first_token('upload_stream', time.time() - start_time)
+                yield format_sse('token', {"text": explanation_text})
+            else:
+                with trace_span('base64'):
+                    data_url = encode_data_url(io.BytesIO(image["data"]), image["mimetype"])
+                parts = []
+                for text in stream_image_analysis(data_url, slot):
+                    if not parts:
+                        metrics.record_time_to_first_token('upload_stream', time.time() - start_time)
+                    parts.append(text)
+                    yield format_sse('token', {"text": text})
+                
+                explanation_text = ''.join(parts).strip()
+                explanation_cache.store(image["source_hash"], image["phash"], explanation_text)
+            
+            # ストリーム完了後にまとめて保存
+            save_history(user_id, school_id, image["image_hash"], image["thumbnail_hash"], explanation_text)
+            logger.info(f"Successfully streamed explanation for user: {user_id}")
+            
+            yield format_sse('done', {
+                "success": True,
+                "explanation": explanation_text,
+                "cached": image["cache_result"] != "miss"
+            })
+            
+        except Exception as e:
+            metrics.record_error('upload_stream')
+            logger.error(f"Error in upload_stream: {str(e)}\n{traceback.format_exc()}")
+            save_error_log('upload_stream', e)
+            yield format_sse('error', {
+                "error": "画像の解析に失敗しました。もう一度お試しください。",
+                "details": str(e) if app.debug else None
+            })
+        finally:
+            metrics.record_response_time('upload_stream_complete', time.time() - start_time)
+    
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # プロキシでバッファリングさせない
+        }
+    )
+    if slot is not None:
+        # 送信前に接続が切れてストリームが始まらなかった場合も実行枠を返す
+        response.call_on_close(slot.finish)
+    return response
+
+# 複数ページの同時アップロード（前処理とAPI呼び出しは上限付きのスレッドプールで並列に行う）
+batch_executor = ThreadPoolExecutor(max_workers=int(os.getenv('BATCH_WORKERS', 4)), thread_name_prefix='batch')
+
+def analyze_batch_page(index, filename, upload, trace=None):
+    """1ページ分の前処理・キャッシュ確認・解析。結果の dict を返す（例外は結果に含める）"""
+    result = {"index": index, "filename": filename}
+    try:
+        with use_trace(trace):
+            image = prepare_image(upload)
+            if image["explanation"] is None:
+                data_url = encode_data_url(io.BytesIO(image["data"]), image["mimetype"])
+                explanation_text = analyze_image(data_url)
+                explanation_cache.store(image["source_hash"], image["phash"], explanation_text)
+                image["explanation"] = explanation_text
+        result.update({
+            "success": True,
+            "explanation": image["explanation"],
+            "cached": image["cache_result"] != "miss",
+            "image": image
+        })
+    except OverloadedError as e:
+        result.update({"success": False, "error": str(e), "retry_after": e.retry_after})
+    except Exception as e:
+        logger.error(f"Error in batch page {index}: {str(e)}\n{traceback.format_exc()}")
+        save_error_log('upload_batch', e)
+        result.update({"success": False, "error": "画像の解析に失敗しました。もう一度お試しください。"})
+    return result
+
+def get_batch_files():
+    return request.files.getlist('files') or request.files.getlist('file')
 
-まず画像の内容を詳しく分析し、問題文を正確に読み取ってから指導を開始してください。
-"""
+def serialize_batch_result(result):
+    return {key: value for key, value in result.items() if key != 'image'}
 
-        # API呼び出しの記録
-        metrics.record_api_call('openai_vision')
+@app.route('/upload/batch', methods=['POST'])
+@monitor_performance('upload_batch')
+@rate_limit(max_calls=BATCH_PAGES_PER_MINUTE, period=60, school_max_calls=SCHOOL_UPLOAD_LIMIT_PER_MINUTE,
+            cost=lambda: len(get_batch_files()), unit="枚")  # 1枚ずつのアップロードと同じく枚数分を数える
+def upload_batch():
+    school_id = request.form.get('school_id', 'default_school')
+    user_id = request.form.get('user_id', 'default_user')
+    error_response = check_school_id(school_id)
+    if error_response:
+        return error_response
+    files = get_batch_files()
+    
+    if not files:
+        return jsonify({"error": "ファイルがありません"}), 400
+    if len(files) > BATCH_MAX_FILES:
+        return jsonify({"error": f"一度に送れるのは{BATCH_MAX_FILES}枚までです"}), 400
+    
+    # 解析を始める前に全ファイルを検証する（1枚でも不正なら何もしない）
+    pages = []
+    for index, file in enumerate(files):
+        upload, error, status = validate_upload_file(file)
+        if error:
+            return jsonify({"error": f"{index + 1}枚目（{file.filename}）: {error}", "index": index}), status
+        pages.append((index, file.filename, upload))
+    
+    if vision_guard.breaker.is_open():
+        return overloaded_response(OverloadedError("AIサービスが不安定なため一時的に受付を停止しています", vision_guard.breaker.retry_after()))
+    
+    futures = [batch_executor.submit(analyze_batch_page, *page, g.trace) for page in pages]
+    
+    def save_results(results):
+        """成功したページの履歴をまとめて1トランザクションで保存する"""
+        succeeded = [r for r in results if r["success"]]
+        history_ids = save_history_batch([
+            (user_id, school_id, r["image"]["image_hash"], r["image"]["thumbnail_hash"], r["explanation"])
+            for r in succeeded
+        ])
+        for r, history_id in zip(succeeded, history_ids):
+            r["history_id"] = history_id
+        logger.info(f"Batch upload for user {user_id}: {len(succeeded)}/{len(results)} pages succeeded")
+        return succeeded
+    
+    # ?stream=1 または Accept: text/event-stream なら、終わったページから順に送る
+    if request.args.get('stream') == '1' or request.accept_mimetypes.best == 'text/event-stream':
+        def generate():
+            results = []
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                yield format_sse('result', serialize_batch_result(result))
+            try:
+                succeeded = save_results(results)
+                yield format_sse('done', {
+                    "success": len(succeeded) == len(results),
+                    "history_ids": {r["index"]: r["history_id"] for r in succeeded},
+                    "succeeded": len(succeeded),
+                    "failed": len(results) - len(succeeded)
+                })
+            except Exception as e:
+                logger.error(f"Error saving batch: {str(e)}\n{traceback.format_exc()}")
+                save_error_log('upload_batch', e)
+                yield format_sse('error', {"error": "履歴の保存に失敗しました"})
         
-        gpt_response = client.chat.completions.create(
-            model="gpt-4.1",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}",
-                                "detail": "auto"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=1500,
-            temperature=0.7,
-            timeout=50  # タイムアウト設定
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
         )
+    
+    try:
+        with trace_span('analyze'):
+            results = sorted((future.result() for future in futures), key=lambda r: r["index"])
+        save_results(results)
+    except Exception as e:
+        logger.error(f"Error in upload_batch: {str(e)}\n{traceback.format_exc()}")
+        save_error_log('upload_batch', e)
+        return jsonify({"error": "画像の解析に失敗しました。もう一度お試しください。"}), 500
+    
+    succeeded = sum(1 for r in results if r["success"])
+    response = jsonify({
+        "success": succeeded == len(results),
+        "results": [serialize_batch_result(r) for r in results],
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded
+    })
+    if succeeded:
+        return response
+    # 全ページが混雑で断られた場合は、/upload と同じく503と再試行までの秒数を返す
+    retry_after = max((r.get("retry_after", 0) for r in results), default=0)
+    if retry_after:
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 503
+    return response, 502
+
+# 解析ジョブの状態取得（?wait=秒 で完了までロングポーリング）
+@app.route('/jobs/<job_id>', methods=['GET'])
+@monitor_performance('jobs')
+def get_job(job_id):
+    try:
+        wait = min(float(request.args.get('wait', 0)), 30)  # 最大30秒まで
+        job = job_queue.wait(job_id, wait) if wait > 0 else job_queue.get(job_id)
         
-        explanation_text = gpt_response.choices[0].message.content.strip()
-        
-        # データベースに保存
-        conn = get_db_connection()
-        with conn:
-            conn.execute(
-                "INSERT INTO history (user_id, school_id, image_base64, explanation, timestamp) VALUES (?, ?, ?, ?, ?)",
-                (user_id, school_id, base64_image, explanation_text, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-            )
-        conn.close()
-        
-        logger.info(f"Successfully processed image for user: {user_id}")
+        if job is None:
+            return jsonify({"error": "ジョブが見つかりません"}), 404
         
-        return jsonify({
-            "success": True,
-            "explanation": explanation_text
-        })
+        return jsonify(serialize_job(job))
         
     except Exception as e:
-        logger.error(f"Error in upload: {str(e)}\n{traceback.format_exc()}")
-        
-        # エラーログをDBに保存
-        try:
-            conn = get_db_connection()
-            with conn:
-                conn.execute(
-                    "INSERT INTO error_logs (endpoint, error_message, stack_trace) VALUES (?, ?, ?)",
-                    ('upload', str(e), traceback.format_exc())
-                )
-            conn.close()
-        except:
-            pass
-        
-        return jsonify({
-            "error": "画像の解析に失敗しました。もう一度お試しください。",
-            "details": str(e) if app.debug else None
-        }), 500
+        logger.error(f"Error in jobs: {str(e)}")
+        return jsonify({"error": "ジョブの取得に失敗しました"}), 500
+
+# 履歴APIで返せる項目と、それを作るのに必要な列
+HISTORY_FIELD_COLUMNS = {
+    'id': ('id',),
+    'user_id': ('user_id',),
+    'school_id': ('school_id',),
+    'explanation': ('explanation',),
+    'timestamp': ('timestamp',),
+    'image_url': ('image_hash',),
+    'thumbnail_url': ('thumbnail_hash', 'image_hash')
+}
+HISTORY_FIELDS = list(HISTORY_FIELD_COLUMNS)
+
+def serialize_history_row(row, fields=HISTORY_FIELDS):
+    keys = row.keys()
+    item = {}
+    for field in fields:
+        if field == 'image_url':
+            item['image_url'] = image_url(row['image_hash'])
+        elif field == 'thumbnail_url':
+            # サムネイルがない旧データは元画像を使う
+            item['thumbnail_url'] = image_url(row['thumbnail_hash']) or image_url(row['image_hash'])
+        elif field in keys:
+            item[field] = row[field]
+    return item
+
+def encode_history_cursor(timestamp, row_id):
+    """(timestamp, id) を中身を意識させないカーソル文字列にする"""
+    return base64.urlsafe_b64encode(json.dumps([timestamp, row_id]).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_history_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    timestamp, row_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    return str(timestamp), int(row_id)
+
+# 条件付きGET（ETag / If-None-Match）
+# 圧縮の有無で本文のバイト列が変わるので弱いETagにする
+HISTORY_CACHE_CONTROL = 'private, no-cache'
+METRICS_CACHE_CONTROL = 'private, no-cache'
+
+def make_etag(*parts):
+    return hashlib.sha1(json.dumps([p.decode('utf-8') if isinstance(p, bytes) else p for p in parts]).encode('utf-8')).hexdigest()
+
+def with_etag(response, etag, cache_control):
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def not_modified(etag, cache_control):
+    metrics.record_request('not_modified')
+    return with_etag(Response(status=304), etag, cache_control)
 
 # 履歴取得
 @app.route('/history', methods=['GET'])
@@ -367,34 +3965,237 @@ def get_history():
         user_id = request.args.get('user_id', 'default_user')
         limit = min(int(request.args.get('limit', 20)), 100)  # 最大100件まで
         offset = int(request.args.get('offset', 0))
+        before = request.args.get('before')
         
-        conn = get_db_connection()
-        history_cursor = conn.execute(
-            "SELECT * FROM history WHERE user_id = ? ORDER BY timestamp DESC LIMIT ? OFFSET ?",
-            (user_id, limit, offset)
-        )
-        history = [dict(row) for row in history_cursor.fetchall()]
+        # fields=id,timestamp,... で返す項目を絞れる（一覧表示で重い列を省く用）
+        fields = HISTORY_FIELDS
+        if request.args.get('fields'):
+            fields = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+            unknown = [f for f in fields if f not in HISTORY_FIELDS]
+            if unknown:
+                return jsonify({"error": f"不明な項目です: {', '.join(unknown)}"}), 400
         
-        # 総件数も取得
-        count_cursor = conn.execute(
-            "SELECT COUNT(*) as total FROM history WHERE user_id = ?",
-            (user_id,)
-        )
-        total_count = count_cursor.fetchone()['total']
+        # ユーザーが履歴を持つ学校のシャードだけを読む
+        shards = history_shards.shards_for(user_id=user_id)
         
-        conn.close()
+        # 各シャードの件数テーブルの version（追加・削除・更新のたびにトリガーで増える）と件数が変わっていなければ304を返す
+        validators = []
+        for shard_no in shards:
+            with history_shards.connection(shard_no) as conn:
+                validator = conn.execute(
+                    "SELECT total, version FROM history_counts WHERE user_id = ?",
+                    (user_id,)
+                ).fetchone()
+            validators.append([shard_no, validator['version'] if validator else None, validator['total'] if validator else None])
+        etag = make_etag('history', user_id, validators, request.query_string)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag, HISTORY_CACHE_CONTROL)
+        # 総件数はトリガーで更新している件数テーブルの合計
+        total_count = sum(total or 0 for _, _, total in validators)
         
-        return jsonify({
+        # カーソル用に id と timestamp は常に取得する
+        columns = ['id', 'timestamp']
+        for field in fields:
+            columns.extend(HISTORY_FIELD_COLUMNS[field])
+        columns = list(dict.fromkeys(columns))
+        # 同じ秒のデータも新しい順（id 降順）にする
+        order_by = "ORDER BY timestamp DESC, id DESC"
+        merge_order = [('timestamp', True), ('id', True)]
+        
+        if before:
+            try:
+                cursor_timestamp, cursor_id = decode_history_cursor(before)
+            except Exception:
+                return jsonify({"error": "カーソルが不正です"}), 400
+            # timestamp <= ? をインデックスの範囲検索に使い、同じ秒の続きは id で絞る（(timestamp, id) の組で比べる）
+            rows = history_shards.query(
+                shards,
+                f"SELECT {', '.join(columns)} FROM history WHERE user_id = ? AND timestamp <= ? AND (timestamp < ? OR id < ?) {order_by} LIMIT ?",
+                (user_id, cursor_timestamp, cursor_timestamp, cursor_id, limit),
+                merge_order, limit
+            )
+        elif len(shards) == 1:
+            # 互換性のため offset 指定も残す
+            rows = history_shards.query(
+                shards,
+                f"SELECT {', '.join(columns)} FROM history WHERE user_id = ? {order_by} LIMIT ? OFFSET ?",
+                (user_id, limit, offset),
+                merge_order
+            )
+        else:
+            # 複数シャードにまたがるときは先頭から offset + limit 件ずつ集めて切り出す
+            rows = history_shards.query(
+                shards,
+                f"SELECT {', '.join(columns)} FROM history WHERE user_id = ? {order_by} LIMIT ?",
+                (user_id, offset + limit),
+                merge_order
+            )[offset:offset + limit]
+        
+        history = [serialize_history_row(row, fields) for row in rows]
+        next_cursor = encode_history_cursor(rows[-1]['timestamp'], rows[-1]['id']) if len(rows) == limit else None
+        
+        response = {
             "history": history,
             "total": total_count,
             "limit": limit,
-            "offset": offset
-        })
+            "next_cursor": next_cursor
+        }
+        if not before:
+            response["offset"] = offset
+        return with_etag(jsonify(response), etag, HISTORY_CACHE_CONTROL)
         
     except Exception as e:
         logger.error(f"Error in history: {str(e)}")
         return jsonify({"error": "履歴の取得に失敗しました"}), 500
 
+# 全文検索の抜粋で一致箇所を囲む記号（HTMLエスケープ後に <mark> に置き換える）
+SNIPPET_OPEN, SNIPPET_CLOSE = '\x02', '\x03'
+
+def build_fts_query(text):
+    """入力を空白で区切り、それぞれをフレーズとしてAND検索する（FTS5の演算子は解釈させない）"""
+    terms = [term for term in text.split() if term]
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+def format_snippet(snippet):
+    return html.escape(snippet).replace(SNIPPET_OPEN, '<mark>').replace(SNIPPET_CLOSE, '</mark>')
+
+def encode_search_cursor(rank, row_id):
+    return base64.urlsafe_b64encode(json.dumps([rank, row_id]).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_search_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    rank, row_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    return rank, int(row_id)
+
+# 過去の解説の全文検索（?q=二次関数&user_id=... または school_id=...）
+@app.route('/history/search', methods=['GET'])
+@monitor_performance('history_search')
+@rate_limit(max_calls=30, period=60)
+def search_history():
+    try:
+        query = request.args.get('q', '').strip()
+        user_id = request.args.get('user_id')
+        school_id = request.args.get('school_id')
+        limit = min(int(request.args.get('limit', 20)), 100)
+        order = request.args.get('order', 'rank')
+        after = request.args.get('after')
+        
+        if not query:
+            return jsonify({"error": "検索語を指定してください"}), 400
+        if not user_id and not school_id:
+            return jsonify({"error": "user_id か school_id を指定してください"}), 400
+        if order not in ('rank', 'recent'):
+            return jsonify({"error": "order は rank か recent を指定してください"}), 400
+        
+        terms = query.split()
+        # trigram は3文字未満の語を索引で引けないので、短い語を含むときは部分一致の全件走査にする
+        use_index = all(len(term) >= 3 for term in terms)
+        
+        conditions = []
+        params = []
+        if use_index:
+            conditions.append("history_fts MATCH ?")
+            params.append(build_fts_query(query))
+            rank_expr = "bm25(history_fts)"
+            snippet_expr = f"snippet(history_fts, 0, '{SNIPPET_OPEN}', '{SNIPPET_CLOSE}', '…', 24)"
+        else:
+            for term in terms:
+                conditions.append("history_fts.explanation LIKE ? ESCAPE '\\'")
+                params.append('%' + re.sub(r'([%_\\])', r'\\\1', term) + '%')
+            rank_expr = "0.0"
+            snippet_expr = "substr(history_fts.explanation, 1, 80)"
+            order = 'recent'
+        
+        if user_id:
+            conditions.append("h.user_id = ?")
+            params.append(user_id)
+        if school_id:
+            conditions.append("h.school_id = ?")
+            params.append(school_id)
+        
+        # 続きの取得は (順位, id) または (日時, id) のキーセット
+        if order == 'rank':
+            order_by = "ORDER BY rank, h.id"
+            if after:
+                try:
+                    cursor_rank, cursor_id = decode_search_cursor(after)
+                    cursor_rank = float(cursor_rank)
+                except Exception:
+                    return jsonify({"error": "カーソルが不正です"}), 400
+                conditions.append(f"({rank_expr} > ? OR ({rank_expr} = ? AND h.id > ?))")
+                params.extend([cursor_rank, cursor_rank, cursor_id])
+        else:
+            order_by = "ORDER BY h.timestamp DESC, h.id DESC"
+            if after:
+                try:
+                    cursor_timestamp, cursor_id = decode_history_cursor(after)
+                except Exception:
+                    return jsonify({"error": "カーソルが不正です"}), 400
+                conditions.append("h.timestamp <= ? AND (h.timestamp < ? OR h.id < ?)")
+                params.extend([cursor_timestamp, cursor_timestamp, cursor_id])
+        
+        sql = (
+            f"SELECT h.id, h.user_id, h.school_id, h.timestamp, h.image_hash, h.thumbnail_hash, "
+            f"{rank_expr} AS rank, {snippet_expr} AS snippet "
+            f"FROM history_fts JOIN history h ON h.id = history_fts.rowid "
+            f"WHERE {' AND '.join(conditions)} {order_by} LIMIT ?"
+        )
+        params.append(limit)
+        
+        # 学校の指定があればそのシャード、なければユーザーが履歴を持つシャードを検索する
+        # bm25 の値はシャードごとの統計で計算されるので、複数シャードをまたぐ順位は近似になる
+        shards = history_shards.shards_for(user_id=user_id, school_id=school_id)
+        merge_order = [('rank', False), ('id', False)] if order == 'rank' else [('timestamp', True), ('id', True)]
+        with trace_span('fts_query'):
+            rows = history_shards.query(shards, sql, params, merge_order, limit)
+        
+        results = []
+        for row in rows:
+            item = serialize_history_row(row, ['id', 'user_id', 'school_id', 'timestamp', 'thumbnail_url'])
+            item['snippet'] = format_snippet(row['snippet'] or '')
+            if order == 'rank':
+                item['score'] = -row['rank']  # bm25 は小さいほど関連が高いので符号を反転
+            results.append(item)
+        
+        next_cursor = None
+        if len(rows) == limit:
+            last = rows[-1]
+            next_cursor = encode_search_cursor(last['rank'], last['id']) if order == 'rank' else encode_history_cursor(last['timestamp'], last['id'])
+        
+        return jsonify({
+            "results": results,
+            "query": query,
+            "order": order,
+            "limit": limit,
+            "next_cursor": next_cursor
+        })
+        
+    except sqlite3.OperationalError as e:
+        logger.error(f"Error in history search: {str(e)}")
+        return jsonify({"error": "検索語を解釈できませんでした"}), 400
+    except Exception as e:
+        logger.error(f"Error in history search: {str(e)}")
+        return jsonify({"error": "検索に失敗しました"}), 500
+
+# 画像配信（内容ハッシュがURLなので永久にキャッシュできる）
+@app.route('/images/<image_hash>', methods=['GET'])
+@monitor_performance('images')
+def get_image(image_hash):
+    if not blob_store.is_valid_hash(image_hash) or not blob_store.exists(image_hash):
+        return jsonify({"error": "画像が見つかりません"}), 404
+    
+    mimetype = detect_image_mimetype(blob_store.read_header(image_hash)) or 'application/octet-stream'
+    response = send_file(
+        blob_store.path_for(image_hash),
+        mimetype=mimetype,
+        etag=image_hash,
+        conditional=True,
+        max_age=31536000
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 # 監視ダッシュボード
 @app.route('/monitoring')
 @monitor_performance('monitoring')
@@ -419,7 +4220,10 @@ def get_current_metrics():
     if auth_token != f"Bearer {expected_token}":
         return jsonify({"error": "Unauthorized"}), 401
     
-    return jsonify(metrics.get_metrics())
+    # 稼働時間やCPUなど値が毎回変わり ETag が一致することはないので、304 は返さずキャッシュもさせない
+    response = jsonify(metrics.get_metrics())
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 # 監視API - 過去のメトリクス
 @app.route('/api/metrics/history', methods=['GET'])
@@ -433,30 +4237,72 @@ def get_metrics_history():
         return jsonify({"error": "Unauthorized"}), 401
     
     try:
-        hours = int(request.args.get('hours', 24))
+        hours = float(request.args.get('hours', 24))
+        step = int(request.args['step']) if request.args.get('step') else None
+        names = [n.strip() for n in request.args.get('names', '').split(',') if n.strip()] or None
         
-        conn = get_db_connection()
-        since = datetime.now() - timedelta(hours=hours)
+        if hours <= 0 or hours > 24 * 400:
+            return jsonify({"error": "hours の指定が不正です"}), 400
         
-        cursor = conn.execute(
-            "SELECT metrics, timestamp FROM monitoring_logs WHERE timestamp > ? ORDER BY timestamp DESC",
-            (since.strftime("%Y-%m-%d %H:%M:%S"),)
-        )
-        
-        metrics_history = []
-        for row in cursor.fetchall():
-            metrics_data = json.loads(row['metrics'])
-            metrics_data['timestamp'] = row['timestamp']
-            metrics_history.append(metrics_data)
+        # 新しいサンプルが書き込まれていなければ304
+        with get_db_connection() as conn:
+            latest = conn.execute("SELECT MAX(ts) FROM metric_samples").fetchone()[0]
+        etag = make_etag('metrics-history', latest, request.query_string)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag, METRICS_CACHE_CONTROL)
         
-        conn.close()
-        
-        return jsonify(metrics_history)
+        # 期間に応じて5分/1時間/1日の集計テーブルから、点数が上限に収まる間隔で返す
+        return with_etag(jsonify(metric_store.query(hours, step, names)), etag, METRICS_CACHE_CONTROL)
         
     except Exception as e:
         logger.error(f"Error in metrics history: {str(e)}")
         return jsonify({"error": "メトリクス履歴の取得に失敗しました"}), 500
 
+# 監視API - メトリクスの差分・新しいエラーなどのプッシュ配信（Server-Sent Events）
+# 最初に snapshot で全体を送り、その後は metrics（差分）/ error / slow_request / history / resync を送る
+@app.route('/api/metrics/stream', methods=['GET'])
+def metrics_stream():
+    # 管理者認証
+    auth_token = request.headers.get('Authorization')
+    expected_token = os.getenv('MONITORING_TOKEN', 'your-monitoring-token')
+    
+    if auth_token != f"Bearer {expected_token}":
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    subscriber = event_bus.subscribe()
+    if subscriber is None:
+        response = jsonify({"error": "監視画面の同時接続数が上限に達しています"})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    
+    try:
+        snapshot = metrics_feed.current_snapshot()
+    except Exception:
+        event_bus.unsubscribe(subscriber)
+        raise
+    
+    def generate():
+        try:
+            yield format_sse('snapshot', snapshot)
+            deadline = time.time() + METRICS_STREAM_MAX_SECONDS
+            while time.time() < deadline:
+                try:
+                    event, data = subscriber.get(timeout=METRICS_STREAM_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # 切断を検知するため、何もなくても定期的に書き込む
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event, data)
+        finally:
+            event_bus.unsubscribe(subscriber)
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    # 本文を1度も読まずに切断された場合も購読を外す
+    response.call_on_close(lambda: event_bus.unsubscribe(subscriber))
+    return response
+
 # 監視API - エラーログ
 @app.route('/api/errors', methods=['GET'])
 @monitor_performance('errors')
@@ -471,14 +4317,13 @@ def get_error_logs():
     try:
         limit = min(int(request.args.get('limit', 50)), 200)
         
-        conn = get_db_connection()
-        cursor = conn.execute(
-            "SELECT * FROM error_logs ORDER BY timestamp DESC LIMIT ?",
-            (limit,)
-        )
-        
-        errors = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        with get_db_connection() as conn:
+            cursor = conn.execute(
+                "SELECT * FROM error_logs ORDER BY timestamp DESC LIMIT ?",
+                (limit,)
+            )
+            
+            errors = [dict(row) for row in cursor.fetchall()]
         
         return jsonify(errors)
         
@@ -486,15 +4331,112 @@ def get_error_logs():
         logger.error(f"Error in error logs: {str(e)}")
         return jsonify({"error": "エラーログの取得に失敗しました"}), 500
 
+# 遅かったリクエストの一覧（段階ごとの内訳付き）
+@app.route('/api/slow-requests', methods=['GET'])
+def get_slow_requests():
+    # 管理者認証
+    auth_token = request.headers.get('Authorization')
+    expected_token = os.getenv('MONITORING_TOKEN', 'your-monitoring-token')
+    
+    if auth_token != f"Bearer {expected_token}":
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    limit = min(int(request.args.get('limit', 20)), 200)
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT * FROM slow_requests ORDER BY id DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+    
+    return jsonify({
+        "threshold_ms": SLOW_REQUEST_THRESHOLD * 1000,
+        "requests": [dict(row, spans=json.loads(row['spans'])) for row in rows]
+    })
+
+# プロファイリングの開始・停止と状態確認
+@app.route('/api/profiling', methods=['GET', 'POST'])
+def profiling_settings():
+    # 管理者認証
+    auth_token = request.headers.get('Authorization')
+    expected_token = os.getenv('MONITORING_TOKEN', 'your-monitoring-token')
+    
+    if auth_token != f"Bearer {expected_token}":
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        try:
+            sample_rate = float(body.get('sample_rate', 0.1))
+            duration_seconds = int(body.get('duration_seconds', 600))
+        except (TypeError, ValueError):
+            return jsonify({"error": "sample_rate と duration_seconds は数値で指定してください"}), 400
+        if not 0 < sample_rate <= 1:
+            return jsonify({"error": "sample_rate は0より大きく1以下で指定してください"}), 400
+        
+        request_profiler.configure(
+            enabled=bool(body.get('enabled', True)),
+            sample_rate=sample_rate,
+            duration_seconds=min(duration_seconds, 3600),  # 計測は最長1時間まで
+            endpoints=body.get('endpoints') or None
+        )
+    
+    settings = request_profiler.get_settings() or {"enabled": False}
+    return jsonify({
+        "settings": settings,
+        "active": bool(settings.get("enabled")) and time.time() <= (settings.get("enabled_until") or 0),
+        "files": len(request_profiler.session_files()),
+        "download_url": "/api/profiling/download"
+    })
+
+# 全ワーカー分をまとめたプロファイル結果（format=pstats でバイナリ、text で上位の関数一覧）
+@app.route('/api/profiling/download', methods=['GET'])
+def download_profile():
+    # 管理者認証
+    auth_token = request.headers.get('Authorization')
+    expected_token = os.getenv('MONITORING_TOKEN', 'your-monitoring-token')
+    
+    if auth_token != f"Bearer {expected_token}":
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    # 自分のワーカーの分はまだ書き出していないことがあるので先に書き出す
+    request_profiler.flush()
+    stats = request_profiler.merged_stats()
+    if stats is None:
+        return jsonify({"error": "プロファイル結果がありません"}), 404
+    
+    if request.args.get('format', 'pstats') == 'text':
+        sort = request.args.get('sort', 'cumulative')
+        if sort not in ('cumulative', 'tottime', 'calls'):
+            return jsonify({"error": "sort は cumulative, tottime, calls のいずれかです"}), 400
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats(sort).print_stats(min(int(request.args.get('limit', 50)), 500))
+        return Response(output.getvalue(), mimetype='text/plain')
+    
+    with tempfile.NamedTemporaryFile(suffix='.prof', delete=False) as f:
+        path = f.name
+    stats.dump_stats(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    os.remove(path)
+    return send_file(io.BytesIO(data), mimetype='application/octet-stream',
+                     as_attachment=True, download_name='profile.prof')
+
 # ヘルスチェック（詳細版）
 @app.route('/health', methods=['GET'])
 @monitor_performance('health')
 def health_check():
+    # detail=live: ロードバランサー向けの生存確認（DBにも触らない）
+    # detail=basic（既定）: DBとAPIキーの確認 / detail=full: システム情報なども含める
+    detail = request.args.get('detail', 'basic')
+    
+    if detail == 'live':
+        return jsonify({"status": "ok"})
+    
     try:
         # データベース接続確認
-        conn = get_db_connection()
-        conn.execute("SELECT 1")
-        conn.close()
+        with get_db_connection() as conn:
+            conn.execute("SELECT 1")
         db_status = "healthy"
     except:
         db_status = "unhealthy"
@@ -502,19 +4444,22 @@ def health_check():
     # OpenAI API確認（環境変数のみチェック）
     api_status = "configured" if os.getenv("OPENAI_API_KEY") else "not configured"
     
-    # 現在のメトリクス
-    current_metrics = metrics.get_metrics()
-    
-    return jsonify({
+    result = {
         "status": "healthy" if db_status == "healthy" else "degraded",
         "message": "勉強サポートアプリは正常に動作しています",
         "components": {
             "database": db_status,
             "openai_api": api_status,
-            "uptime_seconds": current_metrics["uptime_seconds"]
+            "uptime_seconds": metrics.get_uptime_seconds()
         },
         "timestamp": datetime.now().isoformat()
-    })
+    }
+    
+    if detail == 'full':
+        result["system"] = system_sampler.latest()
+        result["gauges"] = metrics.get_gauges()
+    
+    return jsonify(result)
 
 # データベースのクリーンアップ（古いデータの削除）
 @app.route('/api/cleanup', methods=['POST'])
@@ -527,47 +4472,419 @@ def cleanup_old_data():
         return jsonify({"error": "Unauthorized"}), 401
     
     try:
-        days = int(request.json.get('days', 30))
-        cutoff_date = datetime.now() - timedelta(days=days)
+        body = request.get_json(silent=True) or {}
         
-        conn = get_db_connection()
-        with conn:
-            # 古い履歴を削除
-            history_result = conn.execute(
-                "DELETE FROM history WHERE timestamp < ?",
-                (cutoff_date.strftime("%Y-%m-%d %H:%M:%S"),)
-            )
-            
-            # 古い監視ログを削除
-            monitoring_result = conn.execute(
-                "DELETE FROM monitoring_logs WHERE timestamp < ?",
-                (cutoff_date.strftime("%Y-%m-%d %H:%M:%S"),)
-            )
-            
-            # 古いエラーログを削除
-            error_result = conn.execute(
-                "DELETE FROM error_logs WHERE timestamp < ?",
-                (cutoff_date.strftime("%Y-%m-%d %H:%M:%S"),)
-            )
+        # days を指定すると全テーブル共通、policies でテーブルごとに指定、どちらもなければ設定値
+        if 'days' in body:
+            policies = {table: int(body['days']) for table in RetentionManager.TABLES}
+        else:
+            policies = dict(retention_manager.policies)
+            for table, days in (body.get('policies') or {}).items():
+                if table not in RetentionManager.TABLES:
+                    return jsonify({"error": f"不明なテーブルです: {table}"}), 400
+                policies[table] = int(days) if days is not None else None
         
-        conn.close()
+        run_id = retention_manager.try_start(policies)
+        if run_id is None:
+            latest = retention_manager.running_run()
+            return jsonify({
+                "error": "クリーンアップは実行中です",
+                "job_id": latest['id'] if latest else None,
+                "status_url": f"/api/cleanup/{latest['id']}" if latest else None
+            }), 409
+        
+        # 削除は少しずつ進めるのでバックグラウンドで実行し、進捗は status_url で確認する
+        threading.Thread(target=retention_manager.run, args=(run_id, policies), daemon=True).start()
         
         return jsonify({
             "success": True,
-            "deleted": {
-                "history": history_result.rowcount,
-                "monitoring_logs": monitoring_result.rowcount,
-                "error_logs": error_result.rowcount
-            }
-        })
+            "job_id": run_id,
+            "status": "running",
+            "status_url": f"/api/cleanup/{run_id}"
+        }), 202
         
     except Exception as e:
         logger.error(f"Error in cleanup: {str(e)}")
         return jsonify({"error": "クリーンアップに失敗しました"}), 500
 
+# 本体DBを auto_vacuum=INCREMENTAL に切り替える（一度だけ。VACUUM の間は書き込みが止まるので空いている時間に）
+@app.route('/api/maintenance/incremental-vacuum', methods=['POST'])
+def enable_incremental_vacuum():
+    # 管理者認証
+    auth_token = request.headers.get('Authorization')
+    expected_token = os.getenv('MONITORING_TOKEN', 'your-monitoring-token')
+    
+    if auth_token != f"Bearer {expected_token}":
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    try:
+        if incremental_vacuum_enabled():
+            return jsonify({"success": True, "status": "done", "message": "既に有効です"})
+        
+        run_id = retention_manager.try_start_vacuum_conversion()
+        if run_id is None:
+            running = retention_manager.running_run()
+            return jsonify({
+                "error": "他の保守作業が実行中です",
+                "job_id": running['id'] if running else None,
+                "status_url": f"/api/cleanup/{running['id']}" if running else None
+            }), 409
+        
+        threading.Thread(target=retention_manager.convert_to_incremental_vacuum, args=(run_id,), daemon=True).start()
+        
+        return jsonify({
+            "success": True,
+            "job_id": run_id,
+            "status": "running",
+            "status_url": f"/api/cleanup/{run_id}"
+        }), 202
+        
+    except Exception as e:
+        logger.error(f"Error starting incremental vacuum: {str(e)}")
+        return jsonify({"error": "VACUUMの開始に失敗しました"}), 500
+
+# クリーンアップの進捗確認
+@app.route('/api/cleanup/<run_id>', methods=['GET'])
+def get_cleanup_status(run_id):
+    # 管理者認証
+    auth_token = request.headers.get('Authorization')
+    expected_token = os.getenv('MONITORING_TOKEN', 'your-monitoring-token')
+    
+    if auth_token != f"Bearer {expected_token}":
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    run = retention_manager.get_run(run_id)
+    if run is None:
+        return jsonify({"error": "クリーンアップが見つかりません"}), 404
+    
+    return jsonify({
+        "job_id": run['id'],
+        "status": run['status'],
+        "progress": run['progress'],
+        "started_at": datetime.fromtimestamp(run['started_at']).isoformat(),
+        "finished_at": datetime.fromtimestamp(run['finished_at']).isoformat() if run['finished_at'] else None
+    })
+
+# 学校ごとの履歴シャードの状況
+@app.route('/api/history-shards', methods=['GET'])
+def get_history_shards():
+    # 管理者認証
+    auth_token = request.headers.get('Authorization')
+    expected_token = os.getenv('MONITORING_TOKEN', 'your-monitoring-token')
+    
+    if auth_token != f"Bearer {expected_token}":
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    try:
+        return jsonify({
+            "summary": history_shards.stats(),
+            "shards": history_shards.shard_stats()
+        })
+    except Exception as e:
+        logger.error(f"Error getting history shards: {str(e)}")
+        return jsonify({"error": "シャードの情報の取得に失敗しました"}), 500
+
+# 履歴のエクスポート・インポート（NDJSON、1行1件）
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_MB', 1024)) * 1024 * 1024
+EXPORT_COLUMNS = ['id', 'user_id', 'school_id', 'timestamp', 'explanation', 'image_hash', 'thumbnail_hash']
+
+def encode_export_cursor(shard_no, row_id):
+    return base64.urlsafe_b64encode(json.dumps([shard_no, row_id]).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_export_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    shard_no, row_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    return int(shard_no), int(row_id)
+
+def parse_export_time(value):
+    """日付（2024-04-01）または日時を history.timestamp と同じ形式にする"""
+    return datetime.fromisoformat(value).strftime("%Y-%m-%d %H:%M:%S")
+
+def export_history_lines(shards, conditions, params, after):
+    """シャードごとに id 順で少しずつ読み、NDJSONの文字列を返すジェネレーター
+    読み取りはバッチごとに接続を返すので、遅いクライアントでもWALのチェックポイントを止めない"""
+    after_shard, after_id = after
+    for shard_no in sorted(shards):
+        if shard_no < after_shard:
+            continue
+        last_id = after_id if shard_no == after_shard else 0
+        while True:
+            lines = []
+            with history_shards.connection(shard_no) as conn:
+                cursor = conn.execute(
+                    f"SELECT {', '.join(EXPORT_COLUMNS)} FROM history WHERE {' AND '.join(conditions + ['id > ?'])} ORDER BY id LIMIT ?",
+                    params + [last_id, EXPORT_BATCH_SIZE]
+                )
+                # fetchall せずにカーソルから1行ずつ変換する
+                for row in cursor:
+                    record = dict(row)
+                    record['cursor'] = encode_export_cursor(shard_no, row['id'])
+                    lines.append(json.dumps(record, ensure_ascii=False))
+                    last_id = row['id']
+            if not lines:
+                break
+            yield '\n'.join(lines) + '\n'
+            if len(lines) < EXPORT_BATCH_SIZE:
+                break
+
+# 履歴のエクスポート（?school_id=&user_id=&since=&until=&after=<前回の最後の行の cursor>&gzip=1）
+@app.route('/api/export', methods=['GET'])
+def export_history():
+    # 管理者認証
+    auth_token = request.headers.get('Authorization')
+    expected_token = os.getenv('MONITORING_TOKEN', 'your-monitoring-token')
+    
+    if auth_token != f"Bearer {expected_token}":
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    school_id = request.args.get('school_id')
+    user_id = request.args.get('user_id')
+    use_gzip = request.args.get('gzip', 'false').lower() in ('1', 'true', 'yes')
+    
+    # 条件は since <= timestamp < until
+    conditions = ['1 = 1']
+    params = []
+    try:
+        if request.args.get('since'):
+            conditions.append('timestamp >= ?')
+            params.append(parse_export_time(request.args['since']))
+        if request.args.get('until'):
+            conditions.append('timestamp < ?')
+            params.append(parse_export_time(request.args['until']))
+    except ValueError:
+        return jsonify({"error": "since / until は 2024-04-01 のような日付で指定してください"}), 400
+    if school_id is not None:
+        conditions.append('school_id = ?')
+        params.append(school_id)
+    if user_id is not None:
+        conditions.append('user_id = ?')
+        params.append(user_id)
+    
+    after = (LEGACY_SHARD, 0)
+    if request.args.get('after'):
+        try:
+            after = decode_export_cursor(request.args['after'])
+        except Exception:
+            return jsonify({"error": "カーソルが不正です"}), 400
+    
+    if school_id is not None or user_id is not None:
+        shards = history_shards.shards_for(user_id=user_id, school_id=school_id)
+    else:
+        shards = history_shards.all_shards()
+    
+    def generate():
+        lines = export_history_lines(shards, conditions, params, after)
+        if not use_gzip:
+            for chunk in lines:
+                yield chunk.encode('utf-8')
+            return
+        # バッチごとに同期フラッシュするので、途中で切れてもそこまでは展開できる
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in lines:
+            yield compressor.compress(chunk.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    
+    filename = 'history-export.ndjson.gz' if use_gzip else 'history-export.ndjson'
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='application/gzip' if use_gzip else 'application/x-ndjson'
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def id_fits_shard(row_id, shard_no):
+    """その id をこのシャードにそのまま入れてよいか（シャード自身の範囲か、分割前の範囲）
+    範囲外の id を入れると sqlite_sequence が進み、別のシャードと同じ id を振ってしまう"""
+    if row_id < HISTORY_ID_BLOCK:
+        return True
+    return shard_no * HISTORY_ID_BLOCK < row_id < (shard_no + 1) * HISTORY_ID_BLOCK
+
+def flush_import_batch(batch, keep_ids):
+    """学校のシャードごとに1トランザクションで書き込み、(追加した件数, 既にあった件数) を返す"""
+    by_shard = defaultdict(list)
+    for record in batch:
+        by_shard[history_shards.shard_for_school(record['school_id'])].append(record)
+    
+    inserted = 0
+    for shard_no, records in by_shard.items():
+        for user_id in {record['user_id'] for record in records}:
+            history_shards.remember_user(user_id, shard_no)
+        if keep_ids:
+            # シャードの番号は環境ごとに違うので、範囲外の id は新しく振り直す
+            records = [
+                dict(record, id=None) if record['id'] is not None and not id_fits_shard(record['id'], shard_no) else record
+                for record in records
+            ]
+        with history_shards.connection(shard_no) as conn:
+            with conn:
+                if keep_ids:
+                    # 同じ id の行があっても、同じ履歴（ユーザー・日時・画像が一致）のときだけ重複として飛ばす
+                    # 別の環境から取り込んだ別の行と id がぶつかった場合は、消さずに新しい id を振る
+                    ids = [record['id'] for record in records if record['id'] is not None]
+                    existing = {}
+                    for start in range(0, len(ids), 500):
+                        chunk = ids[start:start + 500]
+                        for row in conn.execute(
+                            f"SELECT id, user_id, timestamp, image_hash FROM history WHERE id IN ({','.join('?' * len(chunk))})",
+                            chunk
+                        ):
+                            existing[row['id']] = (row['user_id'], row['timestamp'], row['image_hash'])
+                    new_records = []
+                    for record in records:
+                        if record['id'] in existing:
+                            if existing[record['id']] == (record['user_id'], record['timestamp'], record['image_hash']):
+                                continue
+                            record = dict(record, id=None)
+                        if record['id'] is not None:
+                            # 同じファイル内で同じ id が続いた場合も同じように扱う
+                            existing[record['id']] = (record['user_id'], record['timestamp'], record['image_hash'])
+                        new_records.append(record)
+                    records = new_records
+                # id が None の行は新しい id が振られる
+                cursor = conn.executemany(
+                    "INSERT INTO history (id, user_id, school_id, image_base64, explanation, timestamp, image_hash, thumbnail_hash) "
+                    "VALUES (:id, :user_id, :school_id, '', :explanation, :timestamp, :image_hash, :thumbnail_hash)",
+                    records
+                )
+                # rowcount はトリガー（件数・全文検索）の分を含まない
+                inserted += cursor.rowcount
+    return inserted, len(batch) - inserted
+
+def parse_import_record(line, keep_ids):
+    record = json.loads(line)
+    if not isinstance(record, dict) or not record.get('user_id') or not isinstance(record.get('explanation'), str):
+        raise ValueError("user_id と explanation が必要です")
+    # 新しい学校ならここで確認する（受け付けられない学校の行はエラーとして数える）
+    history_shards.shard_for_school(record.get('school_id'))
+    image_hash = record.get('image_hash')
+    thumbnail_hash = record.get('thumbnail_hash')
+    return {
+        "id": int(record['id']) if keep_ids and record.get('id') is not None else None,
+        "user_id": str(record['user_id']),
+        "school_id": record.get('school_id'),
+        "explanation": record['explanation'],
+        "timestamp": parse_export_time(record['timestamp']) if record.get('timestamp') else datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "image_hash": image_hash if image_hash and blob_store.is_valid_hash(image_hash) else None,
+        "thumbnail_hash": thumbnail_hash if thumbnail_hash and blob_store.is_valid_hash(thumbnail_hash) else None
+    }
+
+# 履歴のインポート（/api/export の出力をそのまま送る。gzip は Content-Encoding: gzip で）
+# 元の id は取り込み先のシャードの範囲内のときだけ使う。?keep_ids=0 ですべて新しい id を振る
+@app.route('/api/import', methods=['POST'])
+def import_history():
+    # 管理者認証
+    auth_token = request.headers.get('Authorization')
+    expected_token = os.getenv('MONITORING_TOKEN', 'your-monitoring-token')
+    
+    if auth_token != f"Bearer {expected_token}":
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    keep_ids = request.args.get('keep_ids', 'true').lower() not in ('0', 'false', 'no')
+    started = time.time()
+    result = {"imported": 0, "skipped": 0, "errors": 0, "batches": 0, "error_samples": []}
+    
+    try:
+        # 本文はアプリ全体の上限（MAX_CONTENT_LENGTH）ではなく取り込み用の上限で読む
+        stream = get_input_stream(request.environ, max_content_length=IMPORT_MAX_BYTES)
+        if request.headers.get('Content-Encoding', '').lower() == 'gzip' or request.mimetype == 'application/gzip':
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
+        else:
+            stream = io.BufferedReader(stream)
+        
+        batch = []
+        for line_no, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                batch.append(parse_import_record(line, keep_ids))
+            except Exception as e:
+                result["errors"] += 1
+                if len(result["error_samples"]) < 20:
+                    result["error_samples"].append({"line": line_no, "error": str(e)})
+                continue
+            
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                inserted, skipped = flush_import_batch(batch, keep_ids)
+                result["imported"] += inserted
+                result["skipped"] += skipped
+                result["batches"] += 1
+                batch = []
+        
+        if batch:
+            inserted, skipped = flush_import_batch(batch, keep_ids)
+            result["imported"] += inserted
+            result["skipped"] += skipped
+            result["batches"] += 1
+        
+    except (OSError, EOFError, zlib.error) as e:
+        logger.error(f"Error reading import: {str(e)}")
+        result["error"] = "ファイルを最後まで読めませんでした。取り込めた分は保存されています"
+        result["elapsed_seconds"] = time.time() - started
+        return jsonify(result), 400
+    except Exception as e:
+        logger.error(f"Error in import: {str(e)}\n{traceback.format_exc()}")
+        result["error"] = "取り込みに失敗しました。取り込めた分は保存されています"
+        result["elapsed_seconds"] = time.time() - started
+        return jsonify(result), 500
+    
+    result["success"] = True
+    result["elapsed_seconds"] = time.time() - started
+    logger.info(f"Imported {result['imported']} history rows ({result['skipped']} skipped, {result['errors']} errors)")
+    return jsonify(result)
+
+# レスポンス圧縮（Accept-Encoding を見て brotli / gzip、小さい本文やストリームは対象外）
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript')
+
+@app.after_request
+def compress_response(response):
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = request.accept_encodings.best_match(encodings)
+    if encoding is None:
+        return response
+    
+    with trace_span('compress'):
+        if encoding == 'br':
+            compressed = brotli.compress(data, quality=5)
+        else:
+            compressed = gzip.compress(data, compresslevel=6)
+    
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # 圧縮後は別の表現なので、強いETagは弱いETagにする
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+# まとめてアップロード以外は1ファイル分の大きさまで
+@app.before_request
+def limit_request_size():
+    # 履歴の取り込みはファイル全体を読み込まずに流し込むので、別の上限にする
+    if request.endpoint == 'import_history':
+        if request.content_length and request.content_length > IMPORT_MAX_BYTES:
+            return jsonify({"error": f"取り込むファイルが大きすぎます（最大{IMPORT_MAX_BYTES // 1024 // 1024}MB）"}), 413
+        return None
+    if request.content_length and request.content_length > MAX_UPLOAD_BYTES and request.endpoint != 'upload_batch':
+        return jsonify({"error": "ファイルサイズが大きすぎます（最大16MB）"}), 413
+
 # エラーハンドラー
 @app.errorhandler(413)
 def request_entity_too_large(error):
+    if request.endpoint == 'upload_batch':
+        return jsonify({"error": f"ファイルサイズが大きすぎます。合計{BATCH_MAX_BYTES // 1024 // 1024}MB以下にしてください。"}), 413
     return jsonify({"error": "ファイルサイズが大きすぎます。16MB以下のファイルを選択してください。"}), 413
 
 @app.errorhandler(429)
@@ -0,0 +1,74 @@
+"""2つのベンチマーク結果を比べて、悪化した項目を表示する
+
+    python bench/compare.py bench/results/before.json bench/results/after.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def change(before, after):
+    if before in (None, 0) or after is None:
+        return None
+    return (after - before) / before
+
+
+def compare(before, after, threshold):
+    """(表示用の行, 悪化した項目) を返す。レイテンシとエラー率は増加、スループットは減少を悪化とみなす"""
+    rows = []
+    regressions = []
+
+    def add(name, metric, old, new, higher_is_worse=True):
+        ratio = change(old, new)
+        worse = ratio is not None and (ratio > threshold if higher_is_worse else ratio < -threshold)
+        rows.append((name, metric, old, new, ratio, worse))
+        if worse:
+            regressions.append(f"{name}.{metric}")
+
+    for name in sorted(set(before["endpoints"]) | set(after["endpoints"])):
+        old = before["endpoints"].get(name, {})
+        new = after["endpoints"].get(name, {})
+        add(name, "throughput_rps", old.get("throughput_rps"), new.get("throughput_rps"), higher_is_worse=False)
+        for p in ("p50", "p90", "p99"):
+            add(name, p, old.get("latency_ms", {}).get(p), new.get("latency_ms", {}).get(p))
+        # エラー率は0からの増加も見たいので差で判定する
+        old_rate, new_rate = old.get("error_rate", 0.0), new.get("error_rate", 0.0)
+        worse = new_rate - old_rate > 0.01
+        rows.append((name, "error_rate", old_rate, new_rate, None, worse))
+        if worse:
+            regressions.append(f"{name}.error_rate")
+
+    add("storage", "db_growth_bytes", before["storage"].get("db_growth_bytes"), after["storage"].get("db_growth_bytes"))
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1, help='悪化とみなす変化の割合')
+    args = parser.parse_args(argv)
+
+    before, after = load(args.before), load(args.after)
+    if before.get("config") != after.get("config"):
+        print("warning: configs differ, results may not be comparable", file=sys.stderr)
+
+    print(f"before: {before['label']} ({before.get('revision')})  after: {after['label']} ({after.get('revision')})")
+    rows, regressions = compare(before, after, args.threshold)
+    for name, metric, old, new, ratio, worse in rows:
+        delta = f"{ratio:+.1%}" if ratio is not None else ""
+        print(f"{'!' if worse else ' '} {name:12s} {metric:16s} {old!s:>12} -> {new!s:>12} {delta:>8}")
+
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
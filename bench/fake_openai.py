@@ -0,0 +1,170 @@
+"""ベンチマーク用のOpenAI互換サーバー（/v1/chat/completions だけを返す）
+
+    python bench/fake_openai.py --port 8100 --latency 1.5 --tokens 400 --token-delay 0.01
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_TEXT = (
+    "この問題は二次関数の最大値を求める問題です。まず平方完成を行い、"
+    "頂点の座標を求めます。$y = (x - 2)^2 + 3$ となるので、定義域に注意して考えます。"
+)
+
+
+class FakeOpenAIConfig:
+    def __init__(self, latency=1.0, jitter=0.2, tokens=300, token_delay=0.005, error_rate=0.0):
+        self.latency = latency          # 最初のトークンまでの待ち時間（秒）
+        self.jitter = jitter            # 待ち時間のばらつき（割合）
+        self.tokens = tokens            # 生成するトークン数
+        self.token_delay = token_delay  # トークンごとの待ち時間（秒）
+        self.error_rate = error_rate    # 500を返す割合
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def first_token_delay(self):
+        return max(0.0, self.latency * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def token_texts(self):
+        # 1トークン≒2文字として文章を切り出す
+        text = (SAMPLE_TEXT * (self.tokens * 2 // len(SAMPLE_TEXT) + 1))[:self.tokens * 2]
+        return [text[i:i + 2] for i in range(0, len(text), 2)]
+
+
+def make_handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.rstrip('/') in ('', '/health'):
+                self._send_json(200, {"status": "ok", "requests": config.requests, "errors": config.errors})
+            else:
+                self._send_json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+
+            if not self.path.endswith('/chat/completions'):
+                self._send_json(404, {"error": {"message": "not found"}})
+                return
+
+            with config.lock:
+                config.requests += 1
+                fail = random.random() < config.error_rate
+                if fail:
+                    config.errors += 1
+
+            time.sleep(config.first_token_delay())
+            if fail:
+                self._send_json(500, {"error": {"message": "fake server error", "type": "server_error"}})
+                return
+
+            if body.get('stream'):
+                self._stream(body)
+            else:
+                time.sleep(config.tokens * config.token_delay)
+                self._send_json(200, {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get('model', 'fake'),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "".join(config.token_texts())},
+                        "finish_reason": "stop"
+                    }],
+                    "usage": {"prompt_tokens": 1000, "completion_tokens": config.tokens, "total_tokens": 1000 + config.tokens}
+                })
+
+        def _stream(self, body):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+            try:
+                for text in config.token_texts():
+                    self._write_chunk(completion_id, body, {"content": text}, None)
+                    time.sleep(config.token_delay)
+                self._write_chunk(completion_id, body, {}, "stop")
+                self._write_raw(b"data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def _write_chunk(self, completion_id, body, delta, finish_reason):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get('model', 'fake'),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+            self._write_raw(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+
+        def _write_raw(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def _send_json(self, status, payload):
+            data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+def start_server(config, host='127.0.0.1', port=0):
+    """バックグラウンドで起動して (サーバー, base_url) を返す"""
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, default=1.0, help='最初のトークンまでの秒数')
+    parser.add_argument('--jitter', type=float, default=0.2, help='待ち時間のばらつき（割合）')
+    parser.add_argument('--tokens', type=int, default=300, help='生成するトークン数')
+    parser.add_argument('--token-delay', type=float, default=0.005, help='トークンごとの秒数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='500を返す割合')
+
+
+def config_from_args(args):
+    return FakeOpenAIConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens=args.tokens,
+        token_delay=args.token_delay,
+        error_rate=args.error_rate
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server, base_url = start_server(config_from_args(args), args.host, args.port)
+    print(f"Fake OpenAI server: OPENAI_BASE_URL={base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
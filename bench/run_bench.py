@@ -0,0 +1,396 @@
+"""負荷テスト: 何人の生徒が同時に使えるかを gunicorn の設定ごとに測る
+
+ローカルの偽OpenAIサーバーを立ち上げ、app.py をそこに向けて起動し、
+/upload・/history・/health を実際に近い画像サイズと割合で叩いて結果をJSONに保存する。
+ネットワークに出ないのでオフラインで実行できる。
+
+    python bench/run_bench.py --students 50 --duration 60 --label baseline
+    python bench/run_bench.py --server-cmd "gunicorn app:app --workers 4 --bind 127.0.0.1:{port}"
+    python bench/compare.py bench/results/baseline-*.json bench/results/new-*.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_openai  # noqa: E402
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, 'bench', 'results')
+BENCH_TOKEN = 'bench-monitoring-token'
+DEFAULT_SERVER_CMD = "gunicorn app:app --worker-class gthread --workers 2 --threads 8 --timeout 120 --bind 127.0.0.1:{port}"
+
+# 生徒が送ってくる画像の大きさ（スマホ写真・スキャン・スクリーンショット）
+IMAGE_SIZES = {
+    'phone': (3024, 4032),
+    'scan': (1700, 2200),
+    'small': (800, 600)
+}
+
+
+def parse_weights(text):
+    """'upload=0.3,history=0.6' を {'upload': 0.3, 'history': 0.6} にする"""
+    weights = {}
+    for part in text.split(','):
+        name, _, value = part.partition('=')
+        weights[name.strip()] = float(value)
+    return weights
+
+
+def weighted_choice(rng, weights):
+    names = list(weights)
+    return rng.choices(names, weights=[weights[n] for n in names])[0]
+
+
+def make_problem_image(rng, size):
+    """ノートや問題集を撮ったような画像を作る（毎回違う内容になるのでハッシュも違う）"""
+    width, height = size
+    paper = tuple(rng.randint(225, 250) for _ in range(3))
+    img = Image.new('RGB', (width, height), paper)
+    draw = ImageDraw.Draw(img)
+
+    # 罫線と、文字の代わりの短い線の並び
+    line_gap = max(24, height // 40)
+    for y in range(line_gap * 2, height - line_gap, line_gap):
+        draw.line([(0, y), (width, y)], fill=(190, 200, 220), width=max(1, width // 1500))
+        x = rng.randint(width // 20, width // 8)
+        while x < width * 0.9 and rng.random() > 0.03:
+            w = rng.randint(line_gap // 3, line_gap)
+            ink = rng.randint(20, 70)
+            draw.rectangle([x, y - line_gap * 0.7, x + w, y - line_gap * 0.2], fill=(ink, ink, ink + 20))
+            x += w + rng.randint(4, line_gap // 2)
+
+    # 図形問題を想定した図
+    for _ in range(rng.randint(0, 3)):
+        x0, y0 = rng.randint(0, width - 200), rng.randint(0, height - 200)
+        draw.ellipse([x0, y0, x0 + rng.randint(100, 400), y0 + rng.randint(100, 400)], outline=(30, 30, 30), width=3)
+
+    # 手ブレと撮影時の明るさむら
+    img = img.rotate(rng.uniform(-4, 4), fillcolor=paper).filter(ImageFilter.GaussianBlur(rng.uniform(0.3, 1.2)))
+
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=rng.randint(80, 92))
+    return buf.getvalue()
+
+
+def build_image_pool(size_weights, pool_size, seed):
+    """同じ画像が繰り返し送られることもあるので、一定数の画像を使い回す"""
+    rng = random.Random(seed)
+    pool = []
+    for _ in range(pool_size):
+        kind = weighted_choice(rng, size_weights)
+        pool.append((kind, make_problem_image(rng, IMAGE_SIZES[kind])))
+    return pool
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class Recorder:
+    """リクエストごとの結果を集める（スレッドから呼ばれる）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.bytes_sent = 0
+
+    def record(self, name, seconds, status):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            self.statuses[name][str(status)] += 1
+
+    def summary(self, duration):
+        endpoints = {}
+        for name, values in self.latencies.items():
+            values = sorted(values)
+            statuses = dict(self.statuses[name])
+            total = sum(statuses.values())
+            rate_limited = statuses.get('429', 0)
+            errors = sum(count for status, count in statuses.items() if not status.startswith(('2', '3')) and status != '429')
+            endpoints[name] = {
+                "count": total,
+                "throughput_rps": round(total / duration, 3),
+                "errors": errors,
+                "error_rate": round(errors / total, 4) if total else 0.0,
+                "rate_limited": rate_limited,
+                "statuses": statuses,
+                "latency_ms": {
+                    "mean": round(sum(values) / len(values) * 1000, 2),
+                    "p50": round(percentile(values, 50) * 1000, 2),
+                    "p90": round(percentile(values, 90) * 1000, 2),
+                    "p99": round(percentile(values, 99) * 1000, 2),
+                    "max": round(values[-1] * 1000, 2)
+                }
+            }
+        return endpoints
+
+
+class Student(threading.Thread):
+    """1人の生徒: アップロードして解説を待つ・履歴を見る、を思考時間を挟みながら繰り返す"""
+
+    def __init__(self, index, args, base_url, pool, recorder, stop_at, record_from):
+        super().__init__(name=f"student-{index}", daemon=True)
+        self.rng = random.Random(args.seed + index)
+        self.args = args
+        self.base_url = base_url
+        self.pool = pool
+        self.recorder = recorder
+        self.stop_at = stop_at
+        self.record_from = record_from
+        self.user_id = f"bench-{args.run_id}-{index}"
+        self.school_id = f"bench-school-{index % args.schools}"
+        self.mix = parse_weights(args.mix)
+
+    def run(self):
+        with httpx.Client(base_url=self.base_url, timeout=self.args.request_timeout) as http:
+            # 全員が同時に始めないよう少しずらす
+            time.sleep(self.rng.uniform(0, self.args.think_time))
+            while time.time() < self.stop_at:
+                action = weighted_choice(self.rng, self.mix)
+                start = time.time()
+                try:
+                    getattr(self, f"do_{action}")(http)
+                except httpx.HTTPError as e:
+                    # タイムアウトなどは失敗までにかかった時間を記録する（0にするとパーセンタイルが良く見える）
+                    self.record(action, time.time() - start, type(e).__name__)
+                time.sleep(self.rng.expovariate(1 / self.args.think_time) if self.args.think_time > 0 else 0)
+
+    def record(self, name, seconds, status):
+        if time.time() >= self.record_from:
+            self.recorder.record(name, seconds, status)
+
+    def do_upload(self, http):
+        kind, data = self.rng.choice(self.pool)
+        start = time.time()
+        response = http.post('/upload', params={"async": "1"}, data={"user_id": self.user_id, "school_id": self.school_id},
+                             files={"file": (f"{kind}.jpg", data, "image/jpeg")})
+        self.record('upload', time.time() - start, response.status_code)
+        with self.recorder.lock:
+            self.recorder.bytes_sent += len(data)
+
+        if response.status_code == 202:
+            status_url = response.json()["status_url"]
+            while time.time() < self.stop_at + self.args.job_wait:
+                job = http.get(status_url, params={"wait": self.args.job_wait})
+                if job.status_code != 200 or job.json().get("status") in ("done", "error"):
+                    status = job.status_code if job.status_code != 200 else ("200" if job.json()["status"] == "done" else "job_error")
+                    self.record('upload_e2e', time.time() - start, status)
+                    return
+            self.record('upload_e2e', time.time() - start, 'timeout')
+        elif response.status_code == 200:
+            self.record('upload_e2e', time.time() - start, 200)
+
+    def do_history(self, http):
+        start = time.time()
+        response = http.get('/history', params={"user_id": self.user_id, "limit": 20})
+        self.record('history', time.time() - start, response.status_code)
+
+    def do_health(self, http):
+        start = time.time()
+        response = http.get('/health')
+        self.record('health', time.time() - start, response.status_code)
+
+
+def data_size(data_dir):
+    """DB（WAL含む、学校ごとの履歴シャードも合計）と画像ストアのサイズ"""
+    if not data_dir:
+        return None
+    db_bytes = sum(os.path.getsize(os.path.join(data_dir, name))
+                   for name in ('history.db', 'history.db-wal')
+                   if os.path.exists(os.path.join(data_dir, name)))
+    for root, _, files in os.walk(os.path.join(data_dir, 'history_shards')):
+        db_bytes += sum(os.path.getsize(os.path.join(root, name)) for name in files
+                        if name.endswith(('.db', '.db-wal')))
+    image_bytes = 0
+    for root, _, files in os.walk(os.path.join(data_dir, 'images')):
+        image_bytes += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return {"db_bytes": db_bytes, "image_bytes": image_bytes}
+
+
+def wait_until_ready(base_url, timeout, process=None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode}")
+        try:
+            if httpx.get(f"{base_url}/health", params={"detail": "live"}, timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server did not become ready within {timeout}s")
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def fetch_server_metrics(base_url):
+    try:
+        response = httpx.get(f"{base_url}/api/metrics/current", headers={"Authorization": f"Bearer {BENCH_TOKEN}"}, timeout=10)
+        if response.status_code == 200:
+            data = response.json()
+            return {key: data.get(key) for key in ('latency_percentiles', 'explanation_cache', 'image_preprocessing', 'jobs', 'gauges')}
+    except httpx.HTTPError:
+        pass
+    return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--label', default='run', help='結果ファイル名に付ける名前')
+    parser.add_argument('--output', help='結果JSONの保存先（既定は bench/results/<label>-<日時>.json）')
+    parser.add_argument('--target', help='起動済みのサーバーを使う場合のURL（偽OpenAIへの接続は自分で設定する）')
+    parser.add_argument('--data-dir', help='--target 使用時にサイズを測るデータディレクトリ')
+    parser.add_argument('--server-cmd', default=DEFAULT_SERVER_CMD, help='app.py の起動コマンド（{port} を置き換える）')
+    parser.add_argument('--port', type=int, default=8200)
+    parser.add_argument('--students', type=int, default=50, help='同時に使う生徒の数')
+    parser.add_argument('--schools', type=int, default=5)
+    parser.add_argument('--duration', type=float, default=60, help='計測する秒数')
+    parser.add_argument('--warmup', type=float, default=5, help='計測前の慣らし運転の秒数')
+    parser.add_argument('--think-time', type=float, default=5.0, help='操作の間隔の平均（秒）')
+    parser.add_argument('--mix', default='upload=0.25,history=0.65,health=0.1', help='操作の割合')
+    parser.add_argument('--image-sizes', default='phone=0.6,scan=0.3,small=0.1', help='画像サイズの割合')
+    parser.add_argument('--image-pool', type=int, default=40, help='使い回す画像の枚数（少ないほどキャッシュが効く）')
+    parser.add_argument('--job-wait', type=float, default=30, help='/jobs のロングポーリング秒数')
+    parser.add_argument('--request-timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    fake_openai.add_arguments(parser)
+    args = parser.parse_args(argv)
+    args.run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    print(f"Generating {args.image_pool} images...", flush=True)
+    pool = build_image_pool(parse_weights(args.image_sizes), args.image_pool, args.seed)
+
+    fake_config = fake_openai.config_from_args(args)
+    fake_server, openai_base_url = fake_openai.start_server(fake_config)
+
+    process = None
+    data_dir = args.data_dir
+    if args.target:
+        base_url = args.target.rstrip('/')
+    else:
+        data_dir = tempfile.mkdtemp(prefix='bench-data-')
+        env = dict(os.environ,
+                   OPENAI_BASE_URL=openai_base_url,
+                   OPENAI_API_KEY='bench',
+                   MONITORING_TOKEN=BENCH_TOKEN,
+                   RENDER_DISK_PATH=data_dir)
+        command = shlex.split(args.server_cmd.format(port=args.port))
+        print(f"Starting server: {' '.join(command)}", flush=True)
+        process = subprocess.Popen(command, cwd=REPO_ROOT, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        wait_until_ready(base_url, args.startup_timeout, process)
+        size_before = data_size(data_dir)
+
+        recorder = Recorder()
+        record_from = time.time() + args.warmup
+        stop_at = record_from + args.duration
+        students = [Student(i, args, base_url, pool, recorder, stop_at, record_from) for i in range(args.students)]
+        print(f"Running {args.students} students for {args.warmup}s warmup + {args.duration}s...", flush=True)
+        for student in students:
+            student.start()
+        for student in students:
+            student.join(timeout=max(0, stop_at - time.time()) + args.job_wait + args.request_timeout)
+
+        size_after = data_size(data_dir)
+        endpoints = recorder.summary(args.duration)
+        # upload_e2e は upload と同じリクエストを解説完了まで測ったものなので件数には含めない
+        requests_only = [e for name, e in endpoints.items() if name != 'upload_e2e']
+        total = sum(e["count"] for e in requests_only)
+        errors = sum(e["errors"] for e in requests_only)
+
+        result = {
+            "label": args.label,
+            "timestamp": datetime.now().isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "config": {
+                "server_cmd": None if args.target else args.server_cmd,
+                "target": args.target,
+                "students": args.students,
+                "schools": args.schools,
+                "duration": args.duration,
+                "warmup": args.warmup,
+                "think_time": args.think_time,
+                "mix": parse_weights(args.mix),
+                "image_sizes": parse_weights(args.image_sizes),
+                "image_pool": args.image_pool,
+                "fake_openai": {
+                    "latency": args.latency, "jitter": args.jitter, "tokens": args.tokens,
+                    "token_delay": args.token_delay, "error_rate": args.error_rate
+                }
+            },
+            "totals": {
+                "requests": total,
+                "throughput_rps": round(total / args.duration, 3),
+                "errors": errors,
+                "error_rate": round(errors / total, 4) if total else 0.0,
+                "upload_bytes": recorder.bytes_sent,
+                "openai_requests": fake_config.requests
+            },
+            "endpoints": endpoints,
+            "storage": {
+                "before": size_before,
+                "after": size_after,
+                "db_growth_bytes": size_after["db_bytes"] - size_before["db_bytes"] if size_before else None,
+                "image_growth_bytes": size_after["image_bytes"] - size_before["image_bytes"] if size_before else None
+            },
+            "server_metrics": fetch_server_metrics(base_url)
+        }
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        fake_server.shutdown()
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{args.label}-{args.run_id}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    for name, e in sorted(endpoints.items()):
+        print(f"{name:12s} n={e['count']:6d} rps={e['throughput_rps']:8.2f} "
+              f"p50={e['latency_ms']['p50']:9.1f}ms p99={e['latency_ms']['p99']:9.1f}ms "
+              f"err={e['error_rate']:.2%} 429={e['rate_limited']}")
+    print(f"Results written to {output}")
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""静的ファイルのビルド: 内容ハッシュ付きのファイル名でコピーし、.gz / .br を作ってマニフェストを書き出す
+
+    python build_assets.py
+
+出力は static/dist/ 以下。app.py は起動時に static/dist/asset-manifest.json を1回だけ読み込み、
+テンプレートの asset_url() とService Workerのキャッシュ名に使う。
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_NAME = 'asset-manifest.json'
+
+# Service Workerとマニフェストは決まったURLで配信する必要があるのでハッシュを付けない
+EXCLUDED = {'sw.js', 'manifest.json'}
+# 圧縮すると小さくなる種類（画像はすでに圧縮済み）
+COMPRESSIBLE_EXTENSIONS = {'.js', '.css', '.html', '.json', '.svg', '.txt'}
+MIN_COMPRESS_BYTES = 512
+
+
+def hashed_name(name, data):
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{digest}{ext}"
+
+
+def write_compressed(path, data):
+    """圧縮版のうち、元より小さくなったものだけを書き出して、その種類を返す"""
+    encodings = []
+    compressed = gzip.compress(data, compresslevel=9)
+    if len(compressed) < len(data):
+        with open(path + '.gz', 'wb') as f:
+            f.write(compressed)
+        encodings.append('gzip')
+    if brotli is not None:
+        compressed = brotli.compress(data, quality=11)
+        if len(compressed) < len(data):
+            with open(path + '.br', 'wb') as f:
+                f.write(compressed)
+            encodings.append('br')
+    return encodings
+
+
+def build():
+    if os.path.isdir(DIST_DIR):
+        shutil.rmtree(DIST_DIR)
+    os.makedirs(DIST_DIR)
+
+    files = {}
+    for root, dirs, names in os.walk(STATIC_DIR):
+        # 出力先は対象外
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != DIST_DIR]
+        for name in sorted(names):
+            source = os.path.join(root, name)
+            logical = os.path.relpath(source, STATIC_DIR).replace(os.sep, '/')
+            if logical in EXCLUDED or name.startswith('.'):
+                continue
+
+            with open(source, 'rb') as f:
+                data = f.read()
+
+            output = hashed_name(logical, data)
+            target = os.path.join(DIST_DIR, output)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+
+            encodings = []
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE_EXTENSIONS and len(data) >= MIN_COMPRESS_BYTES:
+                encodings = write_compressed(target, data)
+
+            files[logical] = {"file": output, "size": len(data), "encodings": encodings}
+
+    # 全ファイルのハッシュから版を決める（どれか1つでも変われば Service Worker のキャッシュ名が変わる）
+    version = hashlib.sha256(json.dumps(
+        {name: entry["file"] for name, entry in files.items()}, sort_keys=True
+    ).encode('utf-8')).hexdigest()[:12]
+
+    manifest = {"version": version, "files": files}
+    with open(os.path.join(DIST_DIR, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    return manifest
+
+
+if __name__ == '__main__':
+    manifest = build()
+    for name, entry in sorted(manifest["files"].items()):
+        print(f"{name} -> {entry['file']} {' '.join(entry['encodings'])}")
+    print(f"Asset version: {manifest['version']}")
@@ -6,6 +6,15 @@ window.onload = function() {
     loadHistory();
 };
 
+// Service Workerが裏で取り直した履歴が変わっていたら表示し直す
+if ('serviceWorker' in navigator) {
+    navigator.serviceWorker.addEventListener('message', event => {
+        if (event.data && event.data.type === 'history-updated') {
+            loadHistory();
+        }
+    });
+}
+
 // フォーム送信処理
 document.getElementById('qform').addEventListener('submit', async function(e) {
     e.preventDefault();
@@ -18,6 +27,12 @@ document.getElementById('qform').addEventListener('submit', async function(e) {
         return;
     }
     
+    // 複数ページはまとめて送る
+    if (fileInput.files.length > 1) {
+        await uploadBatch(e.target, fileInput);
+        return;
+    }
+    
     const formData = new FormData();
     formData.append('file', file);
     formData.append('school_id', 'default_school');
@@ -30,21 +45,27 @@ document.getElementById('qform').addEventListener('submit', async function(e) {
     submitBtn.disabled = true;
     
     try {
-        const response = await fetch('/upload', {
+        const response = await fetch('/upload/stream', {
             method: 'POST',
             body: formData
         });
         
-        const data = await response.json();
+        const contentType = response.headers.get('Content-Type') || '';
+        if (!response.ok || !contentType.includes('text/event-stream')) {
+            const data = await response.json();
+            alert('エラー: ' + (data.error || '解析に失敗しました'));
+            return;
+        }
         
-        if (data.success) {
-            // 履歴を再読み込み
-            loadHistory();
+        const result = await readExplanationStream(response, createLiveAnswer());
+        
+        if (result && result.success) {
+            // 履歴を再読み込み（キャッシュではなく最新を取る）
+            loadHistory({ fresh: true });
             // フォームをリセット
             fileInput.value = '';
-            alert('解析が完了しました！');
         } else {
-            alert('エラー: ' + (data.error || '解析に失敗しました'));
+            alert('エラー: ' + ((result && result.error) || '解析に失敗しました'));
         }
     } catch (error) {
         alert('通信エラーが発生しました');
@@ -55,11 +76,128 @@ document.getElementById('qform').addEventListener('submit', async function(e) {
     }
 });
 
+// 複数ページのアップロード（サーバー側で並列に解析し、全ページ分をまとめて保存する）
+async function uploadBatch(form, fileInput) {
+    const formData = new FormData();
+    Array.from(fileInput.files).forEach(file => formData.append('files', file));
+    formData.append('school_id', 'default_school');
+    formData.append('user_id', 'default_user');
+    
+    const submitBtn = form.querySelector('button[type="submit"]');
+    const originalText = submitBtn.textContent;
+    submitBtn.textContent = `${fileInput.files.length}ページを解析中...`;
+    submitBtn.disabled = true;
+    
+    try {
+        const response = await fetch('/upload/batch', {
+            method: 'POST',
+            body: formData
+        });
+        const data = await response.json();
+        
+        if (!data.results) {
+            alert('エラー: ' + (data.error || '解析に失敗しました'));
+            return;
+        }
+        
+        const failed = data.results.filter(result => !result.success);
+        if (failed.length > 0) {
+            alert(failed.map(result => `${result.index + 1}ページ目: ${result.error}`).join('\n'));
+        }
+        
+        loadHistory({ fresh: true });
+        if (failed.length === 0) {
+            fileInput.value = '';
+        }
+    } catch (error) {
+        alert('通信エラーが発生しました');
+        console.error(error);
+    } finally {
+        submitBtn.textContent = originalText;
+        submitBtn.disabled = false;
+    }
+}
+
+// 解説を逐次表示するための枠を履歴の先頭に作る
+function createLiveAnswer() {
+    const historyDiv = document.getElementById('history');
+    const itemDiv = document.createElement('div');
+    itemDiv.innerHTML = `
+        <div style="margin-bottom: 15px;">
+            <strong>解説を作成中...</strong>
+        </div>
+        <div class="explanation"></div>
+    `;
+    historyDiv.prepend(itemDiv);
+    return itemDiv.querySelector('.explanation');
+}
+
+// SSEを読みながら解説を表示する。完了時は done イベントの内容を返す
+async function readExplanationStream(response, explanationDiv) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let text = '';
+    let renderedParagraphs = 0;
+    
+    // 段落が確定するたびにその段落だけMathJaxで描画する
+    const pendingDiv = document.createElement('div');
+    explanationDiv.appendChild(pendingDiv);
+    
+    function render(final) {
+        const paragraphs = text.split('\n\n');
+        const completeCount = final ? paragraphs.length : paragraphs.length - 1;
+        
+        while (renderedParagraphs < completeCount) {
+            const paragraphDiv = document.createElement('div');
+            paragraphDiv.textContent = paragraphs[renderedParagraphs] + '\n\n';
+            explanationDiv.insertBefore(paragraphDiv, pendingDiv);
+            if (window.MathJax && MathJax.typesetPromise) {
+                MathJax.typesetPromise([paragraphDiv]);
+            }
+            renderedParagraphs++;
+        }
+        pendingDiv.textContent = final ? '' : paragraphs[paragraphs.length - 1];
+    }
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            
+            let eventName = 'message';
+            let data = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                else if (line.startsWith('data:')) data += line.slice(5).trim();
+            });
+            const payload = data ? JSON.parse(data) : {};
+            
+            if (eventName === 'token') {
+                text += payload.text;
+                render(false);
+            } else if (eventName === 'done' || eventName === 'error') {
+                render(true);
+                return payload;
+            }
+        }
+    }
+    return null;
+}
+
 // 履歴読み込み関数
-async function loadHistory() {
+async function loadHistory(options = {}) {
     try {
-        const response = await fetch('/history?user_id=default_user');
-        const history = await response.json();
+        const response = await fetch('/history?user_id=default_user', {
+            cache: options.fresh ? 'no-cache' : 'default'
+        });
+        const data = await response.json();
+        const history = data.history || [];
         
         const historyDiv = document.getElementById('history');
         historyDiv.innerHTML = '';
@@ -73,11 +211,13 @@ async function loadHistory() {
             const itemDiv = document.createElement('div');
             itemDiv.innerHTML = `
                 <div style="margin-bottom: 15px;">
-                    <strong>質問 ${history.length - index}</strong> 
+                    <strong>質問 ${(data.total || history.length) - index}</strong> 
                     <small>(${item.timestamp})</small>
                 </div>
-                <img src="data:image/jpeg;base64,${item.image_base64}" 
-                     style="max-width: 300px; margin-bottom: 10px;">
+                <a href="${item.image_url}" target="_blank">
+                    <img src="${item.thumbnail_url}" loading="lazy"
+                         style="max-width: 300px; margin-bottom: 10px;">
+                </a>
                 <div class="explanation">${item.explanation}</div>
             `;
             historyDiv.appendChild(itemDiv);
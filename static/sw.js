@@ -1,10 +1,21 @@
 // Service Worker - sw.js
-const CACHE_NAME = 'study-support-v1';
+// 以下の2行は配信時に app.py が build_assets.py のマニフェストの値に置き換える
+const ASSET_VERSION = 'dev';
+const ASSET_URLS = {};
+
+function assetUrl(name) {
+  return ASSET_URLS[name] || '/static/' + name;
+}
+
+// デプロイでファイルが変わるとキャッシュ名も変わり、古いキャッシュは activate で消える
+const CACHE_NAME = 'study-support-' + ASSET_VERSION;
+// 履歴APIの応答（stale-while-revalidate 用）
+const API_CACHE_NAME = 'study-support-api-v1';
 const urlsToCache = [
   '/',
-  '/static/main.js',
-  '/static/icon-192.png',
-  '/static/icon-512.png',
+  assetUrl('main.js'),
+  assetUrl('icon-192.png'),
+  assetUrl('icon-512.png'),
   'https://polyfill.io/v3/polyfill.min.js?features=es6',
   'https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js'
 ];
@@ -20,9 +31,54 @@ self.addEventListener('install', event => {
   );
 });
 
+// 履歴: キャッシュがあればすぐ返し、裏で取り直して変わっていればページに知らせる
+// ブラウザのHTTPキャッシュ経由で取り直すので、変化がなければ If-None-Match で304になる
+function staleWhileRevalidate(event) {
+  const request = event.request;
+  
+  const networkFetch = caches.open(API_CACHE_NAME).then(async cache => {
+    const cached = await cache.match(request);
+    const response = await fetch(request);
+    if (response.ok) {
+      await cache.put(request, response.clone());
+      const previousEtag = cached && cached.headers.get('ETag');
+      if (cached && previousEtag !== response.headers.get('ETag')) {
+        const clients = await self.clients.matchAll();
+        clients.forEach(client => client.postMessage({ type: 'history-updated', url: request.url }));
+      }
+    }
+    return response;
+  });
+  
+  // アップロード直後など、最新が必要なときは cache: 'no-cache' で呼ばれるのでネットワークを待つ
+  if (request.cache === 'no-cache' || request.cache === 'reload') {
+    event.respondWith(networkFetch);
+    return;
+  }
+  
+  event.respondWith(
+    caches.open(API_CACHE_NAME)
+      .then(cache => cache.match(request))
+      .then(cached => {
+        if (cached) {
+          event.waitUntil(networkFetch.catch(() => {}));
+          return cached;
+        }
+        return networkFetch;
+      })
+  );
+}
+
 // リクエスト時の処理
 self.addEventListener('fetch', event => {
-  // APIリクエストはキャッシュしない
+  const url = new URL(event.request.url);
+  
+  if (event.request.method === 'GET' && url.pathname === '/history') {
+    staleWhileRevalidate(event);
+    return;
+  }
+  
+  // その他のAPIリクエストはキャッシュしない
   if (event.request.url.includes('/upload') || 
       event.request.url.includes('/history') ||
       event.request.method !== 'GET') {
@@ -44,7 +100,7 @@ self.addEventListener('fetch', event => {
 
 // 古いキャッシュの削除
 self.addEventListener('activate', event => {
-  const cacheWhitelist = [CACHE_NAME];
+  const cacheWhitelist = [CACHE_NAME, API_CACHE_NAME];
   event.waitUntil(
     caches.keys().then(cacheNames => {
       return Promise.all(